@@ -0,0 +1,176 @@
+"""Стресс-тест параллельного приема данных
+
+Запускает обработчик server.handler на локальном порту и отправляет пакеты
+сэмплов из сотен потоков (несколько потоков на каждую лодку, время сэмплов
+перемешано), одновременно читая /api/data и файлы device_<name>.txt.
+Проверяет, что читатели никогда не видят недописанное состояние, а после
+остановки: время в файле состояния - самое позднее из отправленных, число
+строк в логах и записей в бинарной истории совпадает с числом сэмплов.
+
+    python bench/concurrency_stress.py [--writers 300] [--devices 30] [--batches 20]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+TIMESTAMP_RE = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=300, help='число потоков-писателей')
+    parser.add_argument('--devices', type=int, default=30, help='число лодок')
+    parser.add_argument('--batches', type=int, default=20, help='пакетов на писателя')
+    parser.add_argument('--batch-size', type=int, default=10, help='сэмплов в пакете')
+    parser.add_argument('--readers', type=int, default=8, help='число потоков-читателей')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='speed_stress_')
+    os.environ['SPEED_DATA_DIR'] = data_dir
+    os.environ.setdefault('EXCEL_EXPORT_INTERVAL', '3600')
+    os.environ.setdefault('LOG_LEVEL', 'error')
+    # Сэмплы датированы фиксированным днем в прошлом - правила хранения их бы удалили
+    os.environ.setdefault('LOG_RETENTION_DAYS', '0')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import server
+
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), server.handler, args.writers + args.readers + 16)
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    start = moscow_tz.localize(datetime(2025, 10, 18, 10, 0, 0))
+    devices = [f'Boat_{number:03d}' for number in range(args.devices)]
+
+    # Каждый писатель получает свою долю секунд лодки, порядок пакетов перемешан
+    sent = {device: [] for device in devices}
+    sent_lock = threading.Lock()
+    failures = []
+    failures_lock = threading.Lock()
+    stop_readers = threading.Event()
+
+    def fail(message):
+        with failures_lock:
+            if len(failures) < 20:
+                failures.append(message)
+
+    def writer(number):
+        device = devices[number % len(devices)]
+        slot = number // len(devices)
+        slots = (args.writers + len(devices) - 1) // len(devices)
+        rng = random.Random(number)
+        batches = list(range(args.batches))
+        rng.shuffle(batches)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        for batch in batches:
+            seconds = [(batch * args.batch_size + i) * slots + slot for i in range(args.batch_size)]
+            samples = [[int((start + timedelta(seconds=second)).timestamp()), f'{rng.uniform(0, 40):.1f}'] for second in seconds]
+            try:
+                connection.request('POST', '/api/batch', body=json.dumps(samples),
+                                   headers={'X-Device-Name': device, 'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    fail(f'{device}: HTTP {response.status}')
+                    continue
+            except (OSError, http.client.HTTPException) as e:
+                fail(f'{device}: {e}')
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+                continue
+            with sent_lock:
+                sent[device].extend(seconds)
+        connection.close()
+
+    reads = {'api': 0, 'files': 0}
+
+    def reader(number):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        rng = random.Random(1000 + number)
+        while not stop_readers.is_set():
+            if number % 2:
+                connection.request('GET', '/api/data')
+                response = connection.getresponse()
+                payload = json.loads(response.read())
+                for device in payload['devices']:
+                    if not device['last_speed'] or not TIMESTAMP_RE.match(device['timestamp']):
+                        fail(f"/api/data: несогласованное состояние {device['safe_name']}: {device['last_speed']!r} {device['timestamp']!r}")
+                reads['api'] += 1
+            else:
+                path = os.path.join(data_dir, f'device_{rng.choice(devices)}.txt')
+                try:
+                    with open(path) as f:
+                        content = f.read()
+                except FileNotFoundError:
+                    continue
+                lines = content.split('\n')
+                if len(lines) != 2 or not lines[0] or not TIMESTAMP_RE.match(lines[1]):
+                    fail(f'{os.path.basename(path)}: недописанный файл состояния {content!r}')
+                reads['files'] += 1
+        connection.close()
+
+    print(f'🚤 {args.writers} писателей, {args.devices} лодок, {args.batches} x {args.batch_size} сэмплов на писателя, {args.readers} читателей')
+    readers = [threading.Thread(target=reader, args=(number,)) for number in range(args.readers)]
+    writers = [threading.Thread(target=writer, args=(number,)) for number in range(args.writers)]
+    started = time.perf_counter()
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop_readers.set()
+    for thread in readers:
+        thread.join()
+    server.flush_logs()
+
+    # Проверка итогового состояния
+    total = 0
+    for device in devices:
+        seconds = sent[device]
+        total += len(seconds)
+        if not seconds:
+            continue
+        expected = (start + timedelta(seconds=max(seconds))).strftime('%Y-%m-%d %H:%M:%S')
+        with open(os.path.join(data_dir, f'device_{device}.txt')) as f:
+            state_timestamp = f.read().split('\n')[1]
+        if state_timestamp != expected:
+            fail(f'{device}: в файле состояния {state_timestamp}, ожидалось {expected}')
+        registry_timestamp = server.get_device_state(device)['timestamp']
+        if registry_timestamp != expected:
+            fail(f'{device}: в реестре {registry_timestamp}, ожидалось {expected}')
+        with open(os.path.join(data_dir, f'device_{device}_log.txt')) as f:
+            log_lines = sum(1 for _ in f)
+        if log_lines != len(seconds):
+            fail(f'{device}: в логе {log_lines} строк, отправлено {len(seconds)}')
+        history = server.query_history(device)
+        if len(history) != len(seconds):
+            fail(f'{device}: в истории {len(history)} записей, отправлено {len(seconds)}')
+    with open(os.path.join(data_dir, 'all_devices.txt')) as f:
+        all_lines = sum(1 for _ in f)
+    if all_lines != total:
+        fail(f'all_devices.txt: {all_lines} строк, отправлено {total}')
+
+    httpd.shutdown()
+    httpd.server_close()
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+    print(f"📊 {total} сэмплов за {elapsed:.2f} с ({total / elapsed:.0f} сэмплов/с), "
+          f"чтений /api/data: {reads['api']}, чтений файлов состояния: {reads['files']}")
+    if failures:
+        for message in failures:
+            print(f'❌ {message}')
+        sys.exit(1)
+    print('✅ Нарушений не найдено')
+
+if __name__ == '__main__':
+    main()
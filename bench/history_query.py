@@ -0,0 +1,84 @@
+"""Сравнение поиска по текстовому логу и по бинарной истории скорости
+
+Генерирует историю одного устройства (по умолчанию 1 000 000 сэмплов, 2 Гц)
+в текстовом формате device_<name>_log.txt и в бинарных сегментах, затем
+измеряет выборку скоростей за интервал полным сканированием текста и через
+разреженный индекс.
+
+    python bench/history_query.py [--samples 1000000] [--queries 20]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=20)
+    parser.add_argument('--window', type=float, default=300, help='ширина интервала запроса, секунды')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='speed_bench_')
+    os.environ['SPEED_DATA_DIR'] = data_dir
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import server
+
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    start = moscow_tz.localize(datetime(2025, 10, 18, 10, 0, 0))
+    start_ms = int(start.timestamp() * 1000)
+    step_ms = 500
+
+    # Генерация данных
+    print(f'⏳ Генерация {args.samples} сэмплов в {data_dir}')
+    log_file = os.path.join(data_dir, 'device_Bench_log.txt')
+    chunk = 100_000
+    with open(log_file, 'w') as f:
+        for offset in range(0, args.samples, chunk):
+            records = [(start_ms + i * step_ms, 10 + (i % 200) / 10) for i in range(offset, min(offset + chunk, args.samples))]
+            server.append_history('Bench', records)
+            f.write(''.join(
+                f"{datetime.fromtimestamp(epoch_ms / 1000, moscow_tz).strftime('%Y-%m-%d %H:%M:%S')} - {speed:.1f} км/ч\n"
+                for epoch_ms, speed in records
+            ))
+
+    duration_ms = args.samples * step_ms
+    window_ms = int(args.window * 1000)
+    rng = random.Random(42)
+    windows = [(t, t + window_ms) for t in (start_ms + rng.randrange(0, max(1, duration_ms - window_ms)) for _ in range(args.queries))]
+
+    # Полное сканирование текстового лога
+    def scan_text(t1, t2):
+        low = datetime.fromtimestamp(t1 / 1000, moscow_tz).strftime('%Y-%m-%d %H:%M:%S')
+        high = datetime.fromtimestamp(t2 / 1000, moscow_tz).strftime('%Y-%m-%d %H:%M:%S')
+        result = []
+        with open(log_file, 'r') as f:
+            for line in f:
+                timestamp, _, rest = line.partition(' - ')
+                if low <= timestamp <= high:
+                    result.append((timestamp, float(rest.split()[0])))
+        return result
+
+    started = time.perf_counter()
+    text_rows = sum(len(scan_text(t1, t2)) for t1, t2 in windows)
+    text_time = (time.perf_counter() - started) / len(windows)
+
+    # Выборка через разреженный индекс
+    started = time.perf_counter()
+    indexed_rows = sum(len(server.query_history('Bench', t1, t2)) for t1, t2 in windows)
+    indexed_time = (time.perf_counter() - started) / len(windows)
+
+    print(f'📄 Сканирование текста: {text_time * 1000:.2f} мс/запрос ({text_rows} строк)')
+    print(f'📊 Индекс + чтение:     {indexed_time * 1000:.3f} мс/запрос ({indexed_rows} записей)')
+    print(f'🚀 Ускорение: {text_time / indexed_time:.0f}x')
+
+    shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,291 @@
+"""Нагрузочный тест приема скорости и чтения данных
+
+Запускает обработчик server.handler на локальном порту и имитирует N лодок,
+присылающих скорость каждые K мс, вместе с M панелями мониторинга, которые
+опрашивают /api/data. Для каждого сценария измеряются задержки p50/p95/p99,
+пропускная способность, число открытых файлов на запрос и время сборки Excel.
+Результаты пишутся в JSON для сравнения версий между собой.
+
+    python bench/load_test.py [--scenarios small,medium,large,seeded] [--duration 10]
+                              [--interval 500] [--pollers 5] [--output results.json]
+"""
+import argparse
+import builtins
+import contextlib
+import http.client
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+# Сценарии: число лодок и объем заранее записанной истории на каждую лодку
+SCENARIOS = {
+    'small': {'devices': 5, 'seed_samples': 0},
+    'medium': {'devices': 50, 'seed_samples': 0},
+    'large': {'devices': 500, 'seed_samples': 0},
+    'seeded': {'devices': 50, 'seed_samples': 100_000},
+}
+
+class FileCounter:
+    """Считает открытия файлов в процессе (builtins.open и os.open)"""
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+        self.original_open = builtins.open
+        self.original_os_open = os.open
+
+    def wrap(self, function):
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.count += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        builtins.open = self.wrap(self.original_open)
+        os.open = self.wrap(self.original_os_open)
+        return self
+
+    def __exit__(self, *exc):
+        builtins.open = self.original_open
+        os.open = self.original_os_open
+
+def percentile(values, fraction):
+    """Перцентиль по ближайшему рангу, в миллисекундах"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return round(ordered[rank] * 1000, 3)
+
+def summarize(latencies, errors, duration):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+    }
+
+class Worker(threading.Thread):
+    """Клиент с постоянным соединением, выполняющий запрос каждые interval секунд"""
+
+    def __init__(self, port, interval, deadline, make_request):
+        super().__init__(daemon=True)
+        self.port = port
+        self.interval = interval
+        self.deadline = deadline
+        self.make_request = make_request
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+        next_time = time.perf_counter()
+        sequence = 0
+        while next_time < self.deadline:
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            method, path, body, headers = self.make_request(sequence)
+            started = time.perf_counter()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    self.errors += 1
+                else:
+                    self.latencies.append(time.perf_counter() - started)
+            except (OSError, http.client.HTTPException):
+                self.errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            sequence += 1
+            next_time += self.interval
+        connection.close()
+
+def seed_history(server, devices, samples):
+    """Заранее записывает историю устройств (текстовые логи и бинарные сегменты)"""
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    start = moscow_tz.localize(datetime(2025, 10, 18, 10, 0, 0))
+    chunk = 10_000
+    for number in range(devices):
+        name = f'Boat_{number:03d}'
+        for offset in range(0, samples, chunk):
+            batch = [
+                {'time': start + timedelta(milliseconds=500 * i), 'speed': f'{10 + (i % 200) / 10:.1f}'}
+                for i in range(offset, min(offset + chunk, samples))
+            ]
+            server.ingest_samples(name, name, '127.0.0.1', batch)
+    server.flush_logs()
+
+def quiet(args):
+    """Скрывает вывод сервера (print и журнал запросов), чтобы не мерить терминал"""
+    stack = contextlib.ExitStack()
+    if not args.verbose:
+        devnull = stack.enter_context(open(os.devnull, 'w'))
+        stack.enter_context(contextlib.redirect_stdout(devnull))
+        stack.enter_context(contextlib.redirect_stderr(devnull))
+    return stack
+
+def run_scenario(server, port, name, devices, seed_samples, args):
+    """Выполняет один сценарий и возвращает его результаты"""
+    # Чистое состояние между сценариями
+    with quiet(args):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        connection.request('GET', '/cleanup')
+        connection.getresponse().read()
+        connection.close()
+
+    if seed_samples:
+        print(f'⏳ {name}: запись истории {devices} x {seed_samples} сэмплов')
+        seeded_started = time.perf_counter()
+        with quiet(args):
+            seed_history(server, devices, seed_samples)
+        print(f'   готово за {time.perf_counter() - seeded_started:.1f} с')
+
+    def boat_request(number):
+        device = f'Boat_{number:03d}'
+        def make_request(sequence):
+            speed = f'{10 + (sequence % 200) / 10:.1f}'
+            return 'POST', '/', speed.encode(), {'X-Device-Name': device, 'Content-Type': 'text/plain'}
+        return make_request
+
+    def poller_request(sequence):
+        return 'GET', '/api/data', None, {}
+
+    print(f'🚤 {name}: {devices} лодок каждые {args.interval} мс, {args.pollers} панелей, {args.duration} с')
+    deadline = time.perf_counter() + args.duration
+    boats = [Worker(port, args.interval / 1000, deadline, boat_request(number)) for number in range(devices)]
+    pollers = [Worker(port, args.poll_interval / 1000, deadline, poller_request) for _ in range(args.pollers)]
+
+    started = time.perf_counter()
+    with quiet(args), FileCounter() as counter:
+        for worker in boats + pollers:
+            worker.start()
+        for worker in boats + pollers:
+            worker.join()
+        server.flush_logs()
+    elapsed = time.perf_counter() - started
+
+    ingest = summarize([value for worker in boats for value in worker.latencies],
+                       sum(worker.errors for worker in boats), elapsed)
+    reads = summarize([value for worker in pollers for value in worker.latencies],
+                      sum(worker.errors for worker in pollers), elapsed)
+    total_requests = ingest['requests'] + reads['requests']
+
+    # Полная сборка Excel на данных сценария
+    excel_times = []
+    with quiet(args):
+        for _ in range(args.excel_runs):
+            excel_started = time.perf_counter()
+            server.create_excel_file()
+            excel_times.append(time.perf_counter() - excel_started)
+
+    result = {
+        'devices': devices,
+        'seed_samples': seed_samples,
+        'duration_s': round(elapsed, 2),
+        'ingest': ingest,
+        'api_data': reads,
+        'files_opened': counter.count,
+        'files_opened_per_request': round(counter.count / total_requests, 3) if total_requests else None,
+        'excel_rebuild': summarize(excel_times, 0, sum(excel_times) or 1),
+    }
+    print(f"   ingest p50/p95/p99 {ingest['p50_ms']}/{ingest['p95_ms']}/{ingest['p99_ms']} мс, {ingest['throughput_rps']} rps"
+          f" | /api/data p50/p95/p99 {reads['p50_ms']}/{reads['p95_ms']}/{reads['p99_ms']} мс"
+          f" | файлов на запрос {result['files_opened_per_request']}")
+    return result
+
+def git_revision(path):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=path,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', default='small,medium,large,seeded',
+                        help=f'через запятую из: {", ".join(SCENARIOS)}')
+    parser.add_argument('--duration', type=float, default=10, help='длительность сценария, секунды')
+    parser.add_argument('--interval', type=float, default=500, help='период отправки лодкой, мс')
+    parser.add_argument('--pollers', type=int, default=5, help='число панелей мониторинга')
+    parser.add_argument('--poll-interval', type=float, default=1000, help='период опроса /api/data, мс')
+    parser.add_argument('--seed-samples', type=int, help='переопределить объем истории в сценарии seeded')
+    parser.add_argument('--excel-runs', type=int, default=3, help='число замеров сборки Excel')
+    parser.add_argument('--workers', type=int, help='рабочих потоков сервера (по умолчанию SERVER_WORKERS сервера)')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--verbose', action='store_true', help='не скрывать вывод сервера')
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(unknown)}')
+
+    data_dir = tempfile.mkdtemp(prefix='speed_load_')
+    os.environ['SPEED_DATA_DIR'] = data_dir
+    # Экспорт Excel в фоне не должен искажать замеры запросов
+    os.environ.setdefault('EXCEL_EXPORT_INTERVAL', '3600')
+    # История сценария seeded датирована фиксированным днем в прошлом - правила хранения ее бы удалили
+    os.environ.setdefault('LOG_RETENTION_DAYS', '0')
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo_dir)
+    import server
+
+    httpd = server.PooledHTTPServer(('127.0.0.1', 0), server.handler, args.workers or server.SERVER_WORKERS)
+    port = httpd.server_address[1]
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    results = {
+        'revision': git_revision(repo_dir),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': {
+            'duration_s': args.duration,
+            'interval_ms': args.interval,
+            'pollers': args.pollers,
+            'poll_interval_ms': args.poll_interval,
+        },
+        'scenarios': {},
+    }
+    try:
+        for name in names:
+            scenario = SCENARIOS[name]
+            seed_samples = scenario['seed_samples']
+            if name == 'seeded' and args.seed_samples is not None:
+                seed_samples = args.seed_samples
+            result = run_scenario(server, port, name, scenario['devices'], seed_samples, args)
+            results['scenarios'][name] = result
+            print(f"✅ {name}: ingest p99 {result['ingest']['p99_ms']} мс, /api/data p99 {result['api_data']['p99_ms']} мс,"
+                  f" Excel {result['excel_rebuild']['p50_ms']} мс")
+    finally:
+        server.server_shutdown_event.set()
+        httpd.shutdown()
+        httpd.server_close()
+        server.flush_logs()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+        print(f'💾 Результаты записаны в {args.output}')
+    else:
+        print(report)
+
+if __name__ == '__main__':
+    main()
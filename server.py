@@ -1,213 +1,3328 @@
-from http.server import BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+import argparse
+import atexit
+import gzip
+import hashlib
+import heapq
 import json
+import math
 import os
+import queue
+import random
+import re
+import shutil
+import signal
+import socket
+import struct
+import tempfile
+import threading
+import time
+import zlib
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape
+from urllib.parse import parse_qs, quote, unquote, urlsplit
 import pytz
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
 
+# Brotli - необязательная зависимость, без нее используется только gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# NumPy нужен только для /api/analytics
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Создаем директорию для данных
-DATA_DIR = '/tmp/speed_data'
+DATA_DIR = os.environ.get('SPEED_DATA_DIR', '/tmp/speed_data')
 ALL_DEVICES_FILE = os.path.join(DATA_DIR, 'all_devices.txt')
+EXCEL_FILE = os.path.join(DATA_DIR, 'gps_speed_data.xlsx')
+# Выгрузка истории всех устройств (по запросу /create_excel?history=1)
+EXCEL_HISTORY_FILE = os.path.join(DATA_DIR, 'gps_speed_history.xlsx')
+# Бинарная история скорости: history/<safe_name>/segment_NNNNNN.bin,
+# трек GPS рядом с ней: history/<safe_name>/track_NNNNNN.bin
+HISTORY_DIR = os.path.join(DATA_DIR, 'history')
 os.makedirs(DATA_DIR, exist_ok=True)
 
+# Минимальный интервал между пересборками Excel файла (секунды)
+EXCEL_EXPORT_INTERVAL = float(os.environ.get('EXCEL_EXPORT_INTERVAL', '5'))
+
+# Через сколько секунд без данных устройство считается неактивным
+DEVICE_INACTIVE_TIMEOUT = float(os.environ.get('DEVICE_INACTIVE_TIMEOUT', '10'))
+
+# Максимальная длительность одного SSE соединения (браузер переподключается сам)
+SSE_MAX_DURATION = float(os.environ.get('SSE_MAX_DURATION', '25'))
+
+# Автономный режим (python server.py --serve): адрес и число рабочих потоков
+SERVER_HOST = os.environ.get('SERVER_HOST', '0.0.0.0')
+SERVER_PORT = int(os.environ.get('PORT', '8000'))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', '256'))
+
+# Постоянные соединения HTTP/1.1: таймаут простоя (секунды) и лимит запросов на соединение
+KEEPALIVE_TIMEOUT = float(os.environ.get('KEEPALIVE_TIMEOUT', '15'))
+KEEPALIVE_MAX_REQUESTS = int(os.environ.get('KEEPALIVE_MAX_REQUESTS', '1000'))
+
+# Максимальное число сэмплов в одном запросе /api/batch
+BATCH_MAX_SAMPLES = int(os.environ.get('BATCH_MAX_SAMPLES', '10000'))
+
+# Число полос блокировок устройств: прием данных одного устройства
+# сериализуется, разные устройства (почти всегда) обрабатываются параллельно
+DEVICE_LOCK_STRIPES = int(os.environ.get('DEVICE_LOCK_STRIPES', '64'))
+
+# Скользящие окна средней скорости (секунды) и максимальный разрыв между
+# сэмплами (секунды), который еще засчитывается в пройденную дистанцию
+STATS_WINDOWS = (10, 60)
+STATS_MAX_GAP = float(os.environ.get('STATS_MAX_GAP', '30'))
+
+# Ограничение числа точек общей временной сетки в /api/analytics
+ANALYTICS_MAX_POINTS = int(os.environ.get('ANALYTICS_MAX_POINTS', '20000'))
+
+# Прореживание истории для графиков /api/history: максимум точек в ответе
+HISTORY_MAX_POINTS = int(os.environ.get('HISTORY_MAX_POINTS', '10000'))
+
+# Последние сэмплы устройства в памяти для /api/recent (10 минут при 2 Гц)
+RECENT_BUFFER_SIZE = int(os.environ.get('RECENT_BUFFER_SIZE', '1200'))
+
+# Шаг сетки пространственного индекса (градусы, 0.002 - около 220 м по широте)
+# и максимум точек трека в ответе /api/track
+SPATIAL_CELL_DEG = float(os.environ.get('SPATIAL_CELL_DEG', '0.002'))
+TRACK_MAX_POINTS = int(os.environ.get('TRACK_MAX_POINTS', '50000'))
+# Упрощение трека при выгрузке GPX/GeoJSON выполняется окнами по столько точек
+TRACK_SIMPLIFY_WINDOW = int(os.environ.get('TRACK_SIMPLIFY_WINDOW', '4096'))
+
+# Буферизованная запись логов: сброс по времени (секунды) или объему (байты)
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '0.2'))
+LOG_FLUSH_BYTES = int(os.environ.get('LOG_FLUSH_BYTES', str(64 * 1024)))
+# Политика fsync: always - на каждый запрос, interval - раз в LOG_FSYNC_INTERVAL, never - не вызывать
+LOG_FSYNC_POLICY = os.environ.get('LOG_FSYNC_POLICY', 'interval')
+LOG_FSYNC_INTERVAL = float(os.environ.get('LOG_FSYNC_INTERVAL', '1'))
+LOG_MAX_OPEN_FILES = int(os.environ.get('LOG_MAX_OPEN_FILES', '256'))
+
+# Ответы меньше этого размера (байты) не сжимаются
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+# Кэш сжатых копий файлов для скачивания
+COMPRESSED_DIR = os.path.join(DATA_DIR, 'compressed')
+
+# Ротация текстовых логов: текущий лог переносится в ARCHIVE_DIR/<YYYY-MM-DD>/
+# при превышении размера (байты) или при смене суток. Архив старше
+# LOG_COMPRESS_AFTER_DAYS сжимается, старше LOG_RETENTION_DAYS удаляется (0 - хранить всегда).
+ARCHIVE_DIR = os.path.join(DATA_DIR, 'archive')
+LOG_ROTATE_BYTES = int(os.environ.get('LOG_ROTATE_BYTES', str(64 * 1024 * 1024)))
+LOG_RETENTION_DAYS = float(os.environ.get('LOG_RETENTION_DAYS', '30'))
+LOG_COMPRESS_AFTER_DAYS = float(os.environ.get('LOG_COMPRESS_AFTER_DAYS', '1'))
+# Бинарная история и треки (аналитика, графики, выгрузки) хранятся отдельно от
+# текстовых логов: сутки старше HISTORY_RETENTION_DAYS удаляются (0 - хранить всегда)
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', '0'))
+# Период фонового обслуживания логов (ротация, сжатие, удаление), секунды
+LOG_MAINTENANCE_INTERVAL = float(os.environ.get('LOG_MAINTENANCE_INTERVAL', '60'))
+
+# Журнал: минимальный уровень (debug, info, warning, error) и доля записываемых
+# сообщений о каждом запросе (1 - все, 0 - ни одного)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'info')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
 # Функция для получения московского времени
 def get_moscow_time():
     moscow_tz = pytz.timezone('Europe/Moscow')
     return datetime.now(moscow_tz)
 
-def update_inactive_devices():
-    """Обновляет txt файлы неактивных устройств прочерками"""
+# Журнал событий: сообщения ниже LOG_LEVEL отбрасываются, частые сообщения
+# о каждом запросе (sampled) пишутся с вероятностью LOG_SAMPLE_RATE
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40}
+LOG_THRESHOLD = LOG_LEVELS.get(LOG_LEVEL.lower(), LOG_LEVELS['info'])
+
+def log_event(level, message, sampled=False):
+    """Пишет сообщение в журнал с учетом уровня и выборки"""
+    if LOG_LEVELS[level] < LOG_THRESHOLD:
+        return
+    if sampled and LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    print(message)
+
+# Метрики для /metrics (формат Prometheus). Счетчики и гистограммы живут
+# в памяти процесса и обновляются под metrics_lock.
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+metrics_lock = threading.Lock()
+metrics_state = {
+    'requests': {},         # (handler, method, status) -> число запросов
+    'latency': {},          # handler -> гистограмма длительности
+    'bytes_in': {},         # handler -> байт получено
+    'bytes_out': {},        # handler -> байт отправлено
+    'excel_rebuild': None,  # гистограмма длительности сборки Excel
+    'device_samples': {},   # safe_name -> принято сэмплов
+    'registry_files_scanned': 0,
+    'inactive_checks': 0,
+}
+
+def new_histogram():
+    return {'buckets': [0] * len(METRICS_LATENCY_BUCKETS), 'sum': 0.0, 'count': 0}
+
+def observe_histogram(histogram, value):
+    """Добавляет наблюдение в гистограмму; вызывать под metrics_lock"""
+    # Счетчики по корзинам хранятся без накопления, +Inf - это count
+    index = bisect_left(METRICS_LATENCY_BUCKETS, value)
+    if index < len(METRICS_LATENCY_BUCKETS):
+        histogram['buckets'][index] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+def record_request(handler_name, method, status, duration, bytes_in, bytes_out):
+    """Учитывает обработанный HTTP запрос"""
+    with metrics_lock:
+        key = (handler_name, method, status)
+        metrics_state['requests'][key] = metrics_state['requests'].get(key, 0) + 1
+        histogram = metrics_state['latency'].get(handler_name)
+        if histogram is None:
+            histogram = metrics_state['latency'][handler_name] = new_histogram()
+        observe_histogram(histogram, duration)
+        metrics_state['bytes_in'][handler_name] = metrics_state['bytes_in'].get(handler_name, 0) + bytes_in
+        metrics_state['bytes_out'][handler_name] = metrics_state['bytes_out'].get(handler_name, 0) + bytes_out
+
+def record_excel_rebuild(duration):
+    with metrics_lock:
+        if metrics_state['excel_rebuild'] is None:
+            metrics_state['excel_rebuild'] = new_histogram()
+        observe_histogram(metrics_state['excel_rebuild'], duration)
+
+def count_metric(name, amount=1, key=None):
+    """Увеличивает счетчик metrics_state[name] (или metrics_state[name][key])"""
+    with metrics_lock:
+        if key is None:
+            metrics_state[name] += amount
+        else:
+            metrics_state[name][key] = metrics_state[name].get(key, 0) + amount
+
+def metric_labels(**labels):
+    """Метки в формате Prometheus с экранированием значений"""
+    parts = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+def format_histogram(lines, name, histogram, labels):
+    """Строки гистограммы Prometheus (накопительные корзины, sum, count)"""
+    cumulative = 0
+    for bound, count in zip(METRICS_LATENCY_BUCKETS, histogram['buckets']):
+        cumulative += count
+        lines.append(f'{name}_bucket{metric_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_bucket{metric_labels(**labels, le="+Inf")} {histogram["count"]}')
+    lines.append(f'{name}_sum{metric_labels(**labels) if labels else ""} {histogram["sum"]:.6f}')
+    lines.append(f'{name}_count{metric_labels(**labels) if labels else ""} {histogram["count"]}')
+
+class CountingWriter:
+    """Обертка wfile обработчика, считающая отправленные байты"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+# Реестр состояния устройств в памяти процесса (ключ - безопасное имя)
+# Файлы device_*.txt остаются только слоем сохранения на диск
+devices_registry = {}
+devices_registry_lock = threading.Lock()
+# version - монотонный счетчик изменений данных (прием данных, смена статуса, очистка),
+# epoch отличает счетчики разных запусков процесса в ETag
+# devices_version меняется только при изменении состава устройств
+devices_registry_state = {'loaded': False, 'version': 0, 'reset_version': 0, 'devices_version': 0, 'epoch': time.time_ns() // 1_000_000}
+
+# Полосы блокировок устройств: устройство всегда попадает в одну и ту же полосу.
+# RLock - прием данных держит блокировку и при записи истории того же устройства.
+device_locks = [threading.RLock() for _ in range(DEVICE_LOCK_STRIPES)]
+
+def make_safe_name(device_name):
+    """Имя устройства для имен файлов и каталогов: без разделителей путей, '..' и точек"""
+    return re.sub(r'[.: /\\\x00]', '_', device_name)
+
+def get_device_lock(safe_name):
+    """Блокировка полосы, которой принадлежит устройство"""
+    return device_locks[zlib.crc32(safe_name.encode('utf-8')) % len(device_locks)]
+
+def acquire_all_device_locks():
+    """Захватывает все полосы (по порядку номеров) - для полной очистки данных"""
+    for lock in device_locks:
+        lock.acquire()
+
+def release_all_device_locks():
+    for lock in reversed(device_locks):
+        lock.release()
+
+# Индекс устаревания: куча (last_seen, safe_name) для активных устройств.
+# Устаревшие записи кучи (после новых данных) отбрасываются лениво.
+devices_stale_heap = []
+
+# Окна скользящих средних: куча (момент, safe_name) - когда окно устройства
+# опустеет. Средние считаются при чтении, а версия записи (ETag, дельты, SSE)
+# меняется только при изменении данных - поэтому опустевшее окно тоже
+# считается изменением. Изменяется под devices_registry_lock.
+stats_expiry_heap = []
+stats_expiry_scheduled = {}
+
+def window_deadlines(summary):
+    """Моменты (epoch_ms), когда окна скользящих средних опустеют"""
+    samples = (summary or {}).get('window', ((), 0.0))[0]
+    if not samples:
+        return []
+    return [samples[-1][0] + seconds * 1000 for seconds in STATS_WINDOWS]
+
+def schedule_window_expiry(entry, now_ms):
+    """Планирует ближайшее опустение окна устройства; вызывать под devices_registry_lock"""
+    safe_name = entry['safe_name']
+    pending = [deadline for deadline in window_deadlines(entry.get('stats')) if deadline > now_ms]
+    if not pending:
+        return
+    scheduled = stats_expiry_scheduled.get(safe_name)
+    # Уже запланированная проверка перепланирует следующую сама
+    if scheduled is None or scheduled > min(pending):
+        stats_expiry_scheduled[safe_name] = min(pending)
+        heapq.heappush(stats_expiry_heap, (min(pending), safe_name))
+
+# Таблица лидеров: по каждому ключу отсортированный список (-значение, safe_name)
+# только активных устройств. Обновляется при приеме данных бинарным поиском,
+# неактивные устройства удаляются через индекс устаревания, без перебора реестра.
+# Изменяется под devices_registry_lock.
+# Скользящие средние зависят от текущего времени, поэтому рейтинг по ним
+# считается при запросе среди устройств таблицы лидеров.
+LEADERBOARD_KEYS = ('speed', 'max_speed', 'avg_speed', 'avg_10s', 'avg_60s', 'distance_km')
+LEADERBOARD_WINDOW_KEYS = tuple(f'avg_{seconds}s' for seconds in STATS_WINDOWS)
+leaderboard_index = {key: [] for key in LEADERBOARD_KEYS if key not in LEADERBOARD_WINDOW_KEYS}
+leaderboard_values = {}
+
+def leaderboard_entry_values(entry):
+    """Значения индексируемых ключей рейтинга для записи реестра"""
+    stats = entry.get('stats') or {}
+    values = {key: stats.get(key) for key in leaderboard_index}
     try:
-        current_time = get_moscow_time()
-        device_files = []
+        values['speed'] = float(entry['speed'])
+    except (TypeError, ValueError):
+        values['speed'] = None
+    if values['speed'] is not None and not math.isfinite(values['speed']):
+        values['speed'] = None
+    return {key: value for key, value in values.items() if value is not None}
+
+def leaderboard_remove(safe_name):
+    """Убирает устройство из таблицы лидеров; вызывать под devices_registry_lock"""
+    values = leaderboard_values.pop(safe_name, None)
+    if values is None:
+        return
+    for key, value in values.items():
+        ranking = leaderboard_index[key]
+        position = bisect_left(ranking, (-value, safe_name))
+        if position < len(ranking) and ranking[position][1] == safe_name:
+            del ranking[position]
+
+def leaderboard_update(entry):
+    """Переставляет устройство в таблице лидеров; вызывать под devices_registry_lock"""
+    safe_name = entry['safe_name']
+    leaderboard_remove(safe_name)
+    values = leaderboard_entry_values(entry)
+    for key, value in values.items():
+        insort(leaderboard_index[key], (-value, safe_name))
+    leaderboard_values[safe_name] = values
+
+def get_leaderboard(key, limit):
+    """Первые limit активных устройств по ключу: [(safe_name, значение), ...]"""
+    # Сначала убираем устройства, ставшие неактивными
+    collect_inactive_devices()
+    with devices_registry_lock:
+        if key in LEADERBOARD_WINDOW_KEYS:
+            now_ms = time.time() * 1000
+            ranking = []
+            for safe_name in leaderboard_values:
+                value = device_stats_view(devices_registry[safe_name].get('stats'), now_ms).get(key)
+                if value is not None:
+                    ranking.append((-value, safe_name))
+            return [(safe_name, -value) for value, safe_name in heapq.nsmallest(limit, ranking)], len(ranking)
+        ranking = leaderboard_index[key]
+        return [(safe_name, -value) for value, safe_name in ranking[:limit]], len(ranking)
+
+def load_devices_registry():
+    """Однократно восстанавливает реестр устройств из файлов при холодном старте"""
+    if devices_registry_state['loaded']:
+        return
+    with devices_registry_lock:
+        if devices_registry_state['loaded']:
+            return
+        try:
+            device_files = []
+            if os.path.exists(DATA_DIR):
+                device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
+            count_metric('registry_files_scanned', len(device_files))
+
+            for filename in device_files:
+                safe_name = filename[len('device_'):-len('.txt')]
+                filepath = os.path.join(DATA_DIR, filename)
+                log_filepath = os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')
+                try:
+                    with open(filepath, 'r') as f:
+                        content = f.read().strip()
+                    file_stat = os.stat(filepath)
+
+                    lines = content.split('\n')
+                    if len(lines) >= 2:
+                        speed = lines[0]
+                        timestamp = lines[1]
+                    else:
+                        speed = content
+                        timestamp = "Неизвестно"
+
+                    # Переводим mtime файла в монотонное время процесса
+                    last_seen = time.monotonic() - (time.time() - file_stat.st_mtime)
+                    if speed == '—':
+                        # Файл затерт прочерками старой версией сервера - время данных неизвестно
+                        last_seen = 0.0
+                    else:
+                        heapq.heappush(devices_stale_heap, (last_seen, safe_name))
+
+                    devices_registry[safe_name] = {
+                        'name': safe_name.replace('_', ' '),
+                        'safe_name': safe_name,
+                        'speed': speed,
+                        'timestamp': timestamp,
+                        'client_ip': 'unknown',
+                        'last_seen': last_seen,
+                        'file_size': file_stat.st_size,
+                        'log_size': os.path.getsize(log_filepath) if os.path.exists(log_filepath) else 0,
+                        # Статистику по истории досчитает фоновый поток
+                        'stats': None,
+                    }
+                    devices_registry_state['version'] += 1
+                    devices_registry[safe_name]['version'] = devices_registry_state['version']
+                    if last_seen:
+                        leaderboard_update(devices_registry[safe_name])
+                except Exception as e:
+                    log_event('error', f"❌ Ошибка чтения {filename}: {e}")
+                    continue
+
+            devices_registry_state['devices_version'] += 1
+            schedule_stats_rebuild(list(devices_registry))
+            log_event('info', f"📂 Реестр устройств восстановлен с диска: {len(devices_registry)} устройств")
+        except Exception as e:
+            log_event('error', f"❌ Ошибка в load_devices_registry: {e}")
+        devices_registry_state['loaded'] = True
+
+def update_device_state(safe_name, speed, timestamp, client_ip, file_size, log_bytes, stats=None, sample_time=None):
+    """Обновляет запись устройства в реестре после приема данных
+
+    sample_time - время (epoch) самого нового принятого сэмпла, None - только что.
+    """
+    load_devices_registry()
+    with devices_registry_lock:
+        entry = devices_registry.get(safe_name)
+        if entry is None:
+            entry = devices_registry[safe_name] = {
+                'name': safe_name.replace('_', ' '),
+                'safe_name': safe_name,
+                'log_size': 0,
+            }
+            devices_registry_state['devices_version'] += 1
+        entry['speed'] = speed
+        entry['timestamp'] = timestamp
+        entry['client_ip'] = client_ip
+        entry['file_size'] = file_size
+        entry['log_size'] += log_bytes
+        if stats is not None:
+            entry['stats'] = stats
+            schedule_window_expiry(entry, time.time() * 1000)
+        devices_registry_state['version'] += 1
+        entry['version'] = devices_registry_state['version']
+        # Досылка только старых сэмплов не делает устройство снова активным
+        age = time.time() - sample_time if sample_time is not None else 0.0
+        fresh = age <= DEVICE_INACTIVE_TIMEOUT
+        if fresh:
+            entry['last_seen'] = time.monotonic()
+            heapq.heappush(devices_stale_heap, (entry['last_seen'], safe_name))
+        elif 'last_seen' not in entry:
+            entry['last_seen'] = time.monotonic() - age
+        if fresh or safe_name in leaderboard_values:
+            leaderboard_update(entry)
+        return dict(entry)
+
+def get_devices_snapshot():
+    """Возвращает копии записей реестра, отсортированные по имени устройства"""
+    load_devices_registry()
+    with devices_registry_lock:
+        return [dict(devices_registry[key]) for key in sorted(devices_registry)]
+
+def get_device_state(safe_name):
+    """Возвращает копию записи устройства или None"""
+    load_devices_registry()
+    with devices_registry_lock:
+        entry = devices_registry.get(safe_name)
+        return dict(entry) if entry is not None else None
+
+def get_data_version():
+    """Возвращает текущую версию данных и версию последней очистки"""
+    load_devices_registry()
+    with devices_registry_lock:
+        return devices_registry_state['version'], devices_registry_state['reset_version']
+
+def clear_devices_registry():
+    """Очищает реестр устройств (после удаления файлов)"""
+    with devices_registry_lock:
+        devices_registry.clear()
+        devices_stale_heap.clear()
+        stats_expiry_heap.clear()
+        stats_expiry_scheduled.clear()
+        leaderboard_values.clear()
+        for ranking in leaderboard_index.values():
+            ranking.clear()
+        devices_registry_state['loaded'] = True
+        devices_registry_state['version'] += 1
+        devices_registry_state['reset_version'] = devices_registry_state['version']
+        devices_registry_state['devices_version'] += 1
+        device_stats.clear()
+        stats_pending.clear()
+        recent_samples.clear()
+
+def remove_device_state(safe_name):
+    """Удаляет устройство из реестра (выборочная очистка)"""
+    with devices_registry_lock:
+        if devices_registry.pop(safe_name, None) is None:
+            return
+        # Клиенты с дельтами (since) не узнают об удалении - требуем полный снимок
+        devices_registry_state['version'] += 1
+        devices_registry_state['reset_version'] = devices_registry_state['version']
+        devices_registry_state['devices_version'] += 1
+        device_stats.pop(safe_name, None)
+        stats_pending.discard(safe_name)
+        stats_expiry_scheduled.pop(safe_name, None)
+        recent_samples.pop(safe_name, None)
+        leaderboard_remove(safe_name)
+
+def set_device_stats_summary(safe_name, summary):
+    """Итоги статистики после пересчета по истории; копия записи или None"""
+    with devices_registry_lock:
+        entry = devices_registry.get(safe_name)
+        if entry is None:
+            return None
+        entry['stats'] = summary
+        schedule_window_expiry(entry, time.time() * 1000)
+        devices_registry_state['version'] += 1
+        entry['version'] = devices_registry_state['version']
+        if safe_name in leaderboard_values:
+            leaderboard_update(entry)
+        return dict(entry)
+
+def set_device_log_size(safe_name, size):
+    """Размер текущего лога устройства (после ротации)"""
+    with devices_registry_lock:
+        entry = devices_registry.get(safe_name)
+        if entry is not None:
+            entry['log_size'] = size
+
+def describe_device(entry, now=None):
+    """Формирует данные устройства для отображения (статус, скорость, время)"""
+    if now is None:
+        now = time.monotonic()
+    # Статус вычисляется при чтении - файлы устройств не перезаписываются
+    time_diff = now - entry['last_seen']
+    is_active = time_diff <= DEVICE_INACTIVE_TIMEOUT
+    return {
+        'name': entry['name'],
+        'safe_name': entry['safe_name'],
+        'speed': f"{entry['speed']} км/ч" if is_active else "—",
+        'last_speed': entry['speed'],
+        'timestamp': entry['timestamp'],
+        'is_active': is_active,
+        'status_text': "🟢 Device Tracking" if is_active else "🔴 Device not Tracking",
+        'status_color': "#28a745" if is_active else "#dc3545",
+        'time_diff': time_diff,
+        'file_size': entry['file_size'],
+        'log_size': entry['log_size'],
+        'stats': device_stats_view(entry.get('stats')),
+        'version': entry['version']
+    }
+
+def collect_inactive_devices(now=None):
+    """Возвращает устройства, ставшие неактивными с прошлого вызова (без обращения к диску)
+
+    Заодно меняет версию устройств, у которых опустело окно скользящего среднего.
+    """
+    if now is None:
+        now = time.monotonic()
+    load_devices_registry()
+    became_inactive = []
+    checks = 0
+    with devices_registry_lock:
+        while devices_stale_heap and now - devices_stale_heap[0][0] > DEVICE_INACTIVE_TIMEOUT:
+            last_seen, safe_name = heapq.heappop(devices_stale_heap)
+            checks += 1
+            entry = devices_registry.get(safe_name)
+            # Запись актуальна, только если после нее не было новых данных
+            if entry is not None and entry['last_seen'] == last_seen:
+                devices_registry_state['version'] += 1
+                entry['version'] = devices_registry_state['version']
+                leaderboard_remove(safe_name)
+                became_inactive.append(dict(entry))
         
-        if os.path.exists(DATA_DIR):
-            device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
+        # Опустевшие окна скользящих средних - новая версия записи
+        now_ms = time.time() * 1000
+        windows_changed = []
+        while stats_expiry_heap and stats_expiry_heap[0][0] <= now_ms:
+            deadline, safe_name = heapq.heappop(stats_expiry_heap)
+            if stats_expiry_scheduled.get(safe_name) != deadline:
+                continue
+            del stats_expiry_scheduled[safe_name]
+            entry = devices_registry.get(safe_name)
+            if entry is None:
+                continue
+            # После новых данных окна опустеют позже - только перепланируем
+            if deadline in window_deadlines(entry.get('stats')):
+                devices_registry_state['version'] += 1
+                entry['version'] = devices_registry_state['version']
+                windows_changed.append(dict(entry))
+            schedule_window_expiry(entry, now_ms)
+    if checks:
+        count_metric('inactive_checks', checks)
+
+    for entry in became_inactive:
+        log_event('info', f"⚠️ Устройство {entry['name']} неактивно")
+        publish_device_update(entry, now)
+    for entry in windows_changed:
+        publish_device_update(entry, now)
+    if became_inactive or windows_changed:
+        mark_excel_dirty()
+    return became_inactive
+
+# Общий писатель логов: копит строки от всех запросов и пишет их пачками
+# через постоянно открытые файлы. pending - строки для дозаписи,
+# pending_states - последнее содержимое файлов текущего состояния.
+# Пишет на диск только фоновый поток; запросы лишь ставят строки в очередь,
+# а при срочном сбросе ждут, пока поток запишет их номер (enqueued/flushed).
+log_writer_lock = threading.Lock()
+log_writer_flush_lock = threading.Lock()
+log_writer_flushed = threading.Condition(log_writer_lock)
+log_writer_event = threading.Event()
+log_writer_urgent = threading.Event()
+log_writer_pending = {}
+log_writer_pending_states = {}
+log_writer_handles = OrderedDict()
+log_writer_stats = {
+    'pending_bytes': 0,
+    'flushes': 0,
+    'fsyncs': 0,
+    'last_fsync': 0.0,
+    'unsynced': False,
+    'enqueued': 0,
+    'flushed': 0,
+    'worker_started': False,
+}
+
+def append_log(path, text):
+    """Ставит строки в очередь на дозапись в лог"""
+    write_logs({path: text})
+
+def write_logs(appends, states=None):
+    """Ставит в очередь дозаписи логов и новое содержимое файлов состояния"""
+    with log_writer_lock:
+        for path, text in appends.items():
+            log_writer_pending.setdefault(path, []).append(text)
+            log_writer_stats['pending_bytes'] += len(text)
+        for path, content in (states or {}).items():
+            log_writer_pending_states[path] = content
+        log_writer_stats['enqueued'] += 1
+        sequence = log_writer_stats['enqueued']
+        flush_now = LOG_FSYNC_POLICY == 'always' or log_writer_stats['pending_bytes'] >= LOG_FLUSH_BYTES
+        if not log_writer_stats['worker_started']:
+            log_writer_stats['worker_started'] = True
+            threading.Thread(target=log_writer_worker, name='log-writer', daemon=True).start()
+            start_maintenance_worker()
+    
+    if flush_now:
+        log_writer_urgent.set()
+    log_writer_event.set()
+    if flush_now:
+        # Групповая запись: поток писателя записывает строки всех ожидающих запросов,
+        # запрос дожидается своей записи (обратное давление при большой очереди)
+        with log_writer_flushed:
+            done = log_writer_flushed.wait_for(lambda: log_writer_stats['flushed'] >= sequence, timeout=5)
+        if not done:
+            # Поток писателя не отвечает - пишем сами
+            flush_logs(fsync=LOG_FSYNC_POLICY == 'always')
+
+def get_log_handle(path):
+    """Открытый на дозапись файл (LRU кэш дескрипторов); вызывать под log_writer_flush_lock"""
+    f = log_writer_handles.get(path)
+    if f is not None:
+        log_writer_handles.move_to_end(path)
+        return f
+    f = open(path, 'a', encoding='utf-8')
+    log_writer_handles[path] = f
+    while len(log_writer_handles) > LOG_MAX_OPEN_FILES:
+        _, old = log_writer_handles.popitem(last=False)
+        old.close()
+    return f
+
+def flush_logs(fsync=False):
+    """Записывает накопленные строки и файлы состояния на диск"""
+    with log_writer_flush_lock:
+        with log_writer_lock:
+            pending = dict(log_writer_pending)
+            states = dict(log_writer_pending_states)
+            log_writer_pending.clear()
+            log_writer_pending_states.clear()
+            log_writer_stats['pending_bytes'] = 0
+            sequence = log_writer_stats['enqueued']
+        if not pending and not states and not fsync:
+            mark_logs_flushed(sequence)
+            return
         
-        for filename in device_files:
-            device_name = filename.replace('device_', '').replace('.txt', '').replace('_', ' ')
-            filepath = os.path.join(DATA_DIR, filename)
-            
+        written = []
+        for path, chunks in pending.items():
             try:
-                with open(filepath, 'r') as f:
-                    content = f.read().strip()
-                
-                lines = content.split('\n')
-                if len(lines) >= 2:
-                    speed = lines[0]
-                    timestamp_str = lines[1]
-                    
-                    # Проверяем, не устарели ли данные (больше 10 секунд)
-                    try:
-                        data_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                        data_time = pytz.timezone('Europe/Moscow').localize(data_time)
-                        time_diff = (current_time - data_time).total_seconds()
-                        
-                        if time_diff > 10:
-                            # Устройство неактивно - обновляем файл прочерками
-                            with open(filepath, 'w') as f:
-                                f.write("—\n—")
-                            print(f"⚠️ Устройство {device_name} неактивно - обновлен файл прочерками")
-                    except:
-                        # Если не можем распарсить время - обновляем прочерками
-                        with open(filepath, 'w') as f:
-                            f.write("—\n—")
-                        print(f"⚠️ Устройство {device_name} - ошибка времени, обновлен файл прочерками")
-                        
+                f = get_log_handle(path)
+                f.write(''.join(chunks))
+                f.flush()
+                written.append(f)
+            except Exception as e:
+                log_event('error', f"❌ Ошибка записи лога {path}: {e}")
+        
+        for path, content in states.items():
+            try:
+                # Атомарная замена: читатель видит либо старое, либо новое содержимое целиком
+                tmp_path = f'{path}.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
             except Exception as e:
-                print(f"❌ Ошибка обновления файла {filename}: {e}")
+                log_event('error', f"❌ Ошибка записи файла {path}: {e}")
+        
+        if fsync:
+            for f in (written or list(log_writer_handles.values())):
+                try:
+                    os.fsync(f.fileno())
+                except OSError:
+                    pass
+            log_writer_stats['fsyncs'] += 1
+            log_writer_stats['last_fsync'] = time.monotonic()
+            log_writer_stats['unsynced'] = False
+        elif written or states:
+            log_writer_stats['unsynced'] = True
+        log_writer_stats['flushes'] += 1
+        mark_logs_flushed(sequence)
+
+def mark_logs_flushed(sequence):
+    """Отмечает записанными запросы с номером до sequence и будит ожидающих"""
+    with log_writer_flushed:
+        if sequence > log_writer_stats['flushed']:
+            log_writer_stats['flushed'] = sequence
+        log_writer_flushed.notify_all()
+
+def close_log_handles():
+    """Сбрасывает очередь и закрывает все дескрипторы (перед удалением файлов)"""
+    flush_logs()
+    with log_writer_flush_lock:
+        while log_writer_handles:
+            _, f = log_writer_handles.popitem()
+            f.close()
+
+def log_writer_worker():
+    """Фоновый поток - единственный писатель: сбрасывает очередь не реже LOG_FLUSH_INTERVAL"""
+    while True:
+        if log_writer_event.wait(LOG_FSYNC_INTERVAL):
+            # Даем накопиться строкам от других запросов (срочный сброс - без ожидания)
+            log_writer_urgent.wait(LOG_FLUSH_INTERVAL)
+        log_writer_event.clear()
+        log_writer_urgent.clear()
+        try:
+            has_pending = log_writer_stats['pending_bytes'] > 0 or bool(log_writer_pending_states)
+            fsync = ((LOG_FSYNC_POLICY == 'always' and has_pending) or
+                     (LOG_FSYNC_POLICY == 'interval' and
+                      (log_writer_stats['unsynced'] or has_pending) and
+                      time.monotonic() - log_writer_stats['last_fsync'] >= LOG_FSYNC_INTERVAL))
+            flush_logs(fsync=fsync)
+        except Exception as e:
+            log_event('warning', f"⚠️ Ошибка фоновой записи логов: {e}")
+
+atexit.register(flush_logs, True)
+
+# Бинарное хранилище истории скорости. Каждый сегмент - отсортированная
+# по времени последовательность записей фиксированной длины
+# (epoch_ms int64, speed float32). Досылка старых данных открывает новый
+# сегмент, поэтому внутри сегмента время не убывает. Для каждого сегмента
+# в памяти хранится разреженный индекс: время каждой HISTORY_INDEX_STRIDE записи.
+HISTORY_RECORD = struct.Struct('<qf')
+# Точка трека: epoch_ms, широта, долгота, курс и точность (NaN - нет данных).
+# Трек хранится такими же сегментами, как история скорости.
+TRACK_RECORD = struct.Struct('<qddff')
+HISTORY_INDEX_STRIDE = 256
+# Пирамида min/max для прореживания: уровень k - корзины шириной
+# HISTORY_PYRAMID_BASE_MS * HISTORY_PYRAMID_FACTOR**k
+HISTORY_PYRAMID_BASE_MS = 10_000
+HISTORY_PYRAMID_FACTOR = 4
+HISTORY_PYRAMID_LEVELS = 6
+# Сегменты истории разбиваются по суткам (UTC): старые сутки удаляются целиком
+HISTORY_SEGMENT_MS = 86_400_000
+
+history_store = {}
+track_store = {}
+history_lock = threading.Lock()
+history_state = {'loaded': False}
+# Пирамиды min/max по устройствам; изменяются под блокировкой устройства
+history_pyramids = {}
+
+def open_history_segment(path, number, record=HISTORY_RECORD, sealed=False):
+    """Открывает сегмент истории (или трека) и строит его разреженный индекс"""
+    fd = os.open(path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    size = os.fstat(fd).st_size
+    count = size // record.size
+    if size % record.size:
+        # Недописанная запись после сбоя - отбрасываем хвост
+        os.ftruncate(fd, count * record.size)
+    
+    index = []
+    for position in range(0, count, HISTORY_INDEX_STRIDE):
+        index.append(record.unpack(os.pread(fd, record.size, position * record.size))[0])
+    last_ms = None
+    if count:
+        last_ms = record.unpack(os.pread(fd, record.size, (count - 1) * record.size))[0]
+    
+    segment = {'number': number, 'path': path, 'fd': fd, 'count': count, 'index': index, 'last_ms': last_ms,
+               'record': record, 'users': 0, 'sealed': False}
+    if sealed:
+        seal_segment(segment)
+    return segment
+
+# Время жизни дескрипторов сегментов. Читатели и писатель захватывают сегменты
+# (users) под history_lock и читают уже без него. Дописывается только последний
+# сегмент устройства; остальные запечатаны (sealed): их дескриптор закрыт и
+# открывается только на время чтения. Удаляемый сегмент сразу убирается из
+# списка и с диска, а дескриптор закрывает последний освободивший его читатель.
+def seal_segment(segment):
+    """Запечатывает сегмент: дописываться больше не будет; вызывать под history_lock"""
+    segment['sealed'] = True
+    if not segment['users'] and segment['fd'] is not None:
+        os.close(segment['fd'])
+        segment['fd'] = None
+
+def acquire_segments(safe_name, store=history_store):
+    """Снимок сегментов устройства [(segment, count)]; дескрипторы не закрываются до release_segments"""
+    with history_lock:
+        segments = []
+        for segment in store.get(safe_name, []):
+            if segment['fd'] is None:
+                segment['fd'] = os.open(segment['path'], os.O_RDONLY)
+            segment['users'] += 1
+            segments.append((segment, segment['count']))
+        return segments
+
+def release_segments(segments):
+    """Освобождает сегменты, захваченные acquire_segments"""
+    with history_lock:
+        for segment, _ in segments:
+            segment['users'] -= 1
+            if not segment['users'] and segment['sealed'] and segment['fd'] is not None:
+                os.close(segment['fd'])
+                segment['fd'] = None
+
+def history_device_dir(safe_name):
+    """Каталог истории устройства; ValueError, если путь выходит за HISTORY_DIR"""
+    root = os.path.realpath(HISTORY_DIR)
+    device_dir = os.path.realpath(os.path.join(HISTORY_DIR, safe_name))
+    if not safe_name or os.path.dirname(device_dir) != root:
+        raise ValueError(f'Недопустимое имя устройства: {safe_name!r}')
+    return device_dir
+
+def load_history_store():
+    """Однократно открывает сегменты истории всех устройств"""
+    if history_state['loaded']:
+        return
+    with history_lock:
+        if history_state['loaded']:
+            return
+        try:
+            if os.path.exists(HISTORY_DIR):
+                for safe_name in os.listdir(HISTORY_DIR):
+                    device_dir = os.path.join(HISTORY_DIR, safe_name)
+                    files = sorted(os.listdir(device_dir))
+                    for store, prefix, record in ((history_store, 'segment_', HISTORY_RECORD), (track_store, 'track_', TRACK_RECORD)):
+                        names = [f for f in files if f.startswith(prefix) and f.endswith('.bin')]
+                        if names:
+                            # Открытым остается только последний сегмент - в него идет запись
+                            store[safe_name] = [
+                                open_history_segment(os.path.join(device_dir, name), int(name[len(prefix):-len('.bin')]),
+                                                     record, sealed=name != names[-1])
+                                for name in names
+                            ]
+        except Exception as e:
+            log_event('error', f"❌ Ошибка в load_history_store: {e}")
+        history_state['loaded'] = True
+
+def append_history(safe_name, records):
+    """Дописывает отсортированные записи (epoch_ms, speed) в историю устройства"""
+    if not records:
+        return
+    load_history_store()
+    # Запись сериализуется блокировкой устройства; общий history_lock
+    # защищает только списки сегментов, поэтому устройства пишут параллельно
+    with get_device_lock(safe_name):
+        with history_lock:
+            segments = history_store.setdefault(safe_name, [])
+        append_segment_records(safe_name, segments, 'segment', HISTORY_RECORD, records)
+        # Еще не построенную пирамиду дополнит build_history_pyramid
+        pyramid = history_pyramids.get(safe_name)
+        if pyramid is not None:
+            add_to_pyramid(pyramid, records)
+
+def append_segment_records(safe_name, segments, prefix, record, records):
+    """Дописывает отсортированные записи в сегменты устройства; вызывать под блокировкой устройства"""
+    position = 0
+    while position < len(records):
+        day = records[position][0] // HISTORY_SEGMENT_MS
+        with history_lock:
+            segment = segments[-1] if segments else None
+            rollover = segment is None or segment['sealed'] or (
+                segment['last_ms'] is not None and
+                (records[position][0] < segment['last_ms'] or day != segment['last_ms'] // HISTORY_SEGMENT_MS))
+            if not rollover:
+                segment['users'] += 1
+        if rollover:
+            # Данные старше уже записанных или новые сутки - начинаем новый сегмент
+            device_dir = history_device_dir(safe_name)
+            os.makedirs(device_dir, exist_ok=True)
+            number = segment['number'] + 1 if segment else 0
+            new_segment = open_history_segment(os.path.join(device_dir, f'{prefix}_{number:06d}.bin'), number, record)
+            with history_lock:
+                if segment is not None:
+                    seal_segment(segment)
+                new_segment['users'] += 1
+                segments.append(new_segment)
+            segment = new_segment
+        
+        # Записи, идущие по возрастанию, пишем в сегмент одним вызовом.
+        # Индекс дополняется до увеличения count: читатель берет count
+        # и видит только полностью записанные записи.
+        try:
+            end = position + 1
+            while end < len(records) and records[end][0] >= records[end - 1][0] and records[end][0] // HISTORY_SEGMENT_MS == day:
+                end += 1
+            chunk = records[position:end]
+            os.write(segment['fd'], b''.join(record.pack(*row) for row in chunk))
+            for offset, row in enumerate(chunk):
+                if (segment['count'] + offset) % HISTORY_INDEX_STRIDE == 0:
+                    segment['index'].append(row[0])
+            segment['last_ms'] = chunk[-1][0]
+            segment['count'] += len(chunk)
+        finally:
+            release_segments([(segment, None)])
+        position = end
+
+def history_lower_bound(segment, count, epoch_ms):
+    """Номер первой записи захваченного сегмента со временем >= epoch_ms (индекс + чтение одного блока)"""
+    blocks = (count + HISTORY_INDEX_STRIDE - 1) // HISTORY_INDEX_STRIDE
+    block = bisect_left(segment['index'], epoch_ms, 0, blocks) - 1
+    if block < 0:
+        return 0
+    block_start = block * HISTORY_INDEX_STRIDE
+    block_end = min(block_start + HISTORY_INDEX_STRIDE, count)
+    record = segment['record']
+    data = os.pread(segment['fd'], (block_end - block_start) * record.size, block_start * record.size)
+    times = [row[0] for row in record.iter_unpack(data)]
+    return block_start + bisect_left(times, epoch_ms)
+
+def read_history_chunks(safe_name, start_ms=None, end_ms=None, store=history_store):
+    """Сырые блоки записей истории (или трека) за интервал [start_ms, end_ms], по одному на сегмент"""
+    load_history_store()
+    segments = acquire_segments(safe_name, store)
+    try:
+        chunks = []
+        for segment, count in segments:
+            if not count:
                 continue
-                
+            low = history_lower_bound(segment, count, start_ms) if start_ms is not None else 0
+            high = history_lower_bound(segment, count, end_ms + 1) if end_ms is not None else count
+            if high > low:
+                chunks.append(os.pread(segment['fd'], (high - low) * segment['record'].size, low * segment['record'].size))
+        return chunks
+    finally:
+        release_segments(segments)
+
+def query_history(safe_name, start_ms=None, end_ms=None):
+    """Скорости устройства за интервал: отсортированный список (epoch_ms, speed)"""
+    runs = [list(HISTORY_RECORD.iter_unpack(chunk)) for chunk in read_history_chunks(safe_name, start_ms, end_ms)]
+    if len(runs) == 1:
+        return runs[0]
+    return list(heapq.merge(*runs))
+
+def query_track(safe_name, start_ms=None, end_ms=None):
+    """Точки трека устройства за интервал: (epoch_ms, lat, lon, heading, accuracy)"""
+    runs = [list(TRACK_RECORD.iter_unpack(chunk)) for chunk in read_history_chunks(safe_name, start_ms, end_ms, track_store)]
+    if len(runs) == 1:
+        return runs[0]
+    return list(heapq.merge(*runs))
+
+def iter_segment_records(segment, low, high, block_records=4096):
+    """Записи [low, high) захваченного сегмента, чтением блоками"""
+    record = segment['record']
+    for position in range(low, high, block_records):
+        count = min(block_records, high - position)
+        yield from record.iter_unpack(os.pread(segment['fd'], count * record.size, position * record.size))
+
+def iter_history(safe_name, start_ms=None, end_ms=None, block_records=4096, store=history_store, segments=None):
+    """Записи истории (или трека) за интервал по возрастанию времени, чтением блоками (постоянная память)
+
+    Сегменты захватываются при первом обращении к итератору и освобождаются,
+    когда он исчерпан или закрыт. Переданный снимок segments (acquire_segments)
+    читается как есть - повторные проходы видят одни и те же записи.
+    """
+    load_history_store()
+    owned = segments is None
+    if owned:
+        segments = acquire_segments(safe_name, store)
+    try:
+        runs = []
+        for segment, count in segments:
+            if not count:
+                continue
+            low = history_lower_bound(segment, count, start_ms) if start_ms is not None else 0
+            high = history_lower_bound(segment, count, end_ms + 1) if end_ms is not None else count
+            if high > low:
+                runs.append(iter_segment_records(segment, low, high, block_records))
+        yield from heapq.merge(*runs)
+    finally:
+        if owned:
+            release_segments(segments)
+
+def drop_history_segments(safe_name, start_ms=None, end_ms=None):
+    """Удаляет сегменты истории устройства, целиком попадающие в интервал; возвращает их число"""
+    load_history_store()
+    removed = {}
+    with get_device_lock(safe_name):
+        with history_lock:
+            for name, store in (('history', history_store), ('track', track_store)):
+                segments = store.get(safe_name, [])
+                kept = []
+                for segment in segments:
+                    first_ms = segment['index'][0] if segment['count'] else None
+                    if first_ms is not None and (start_ms is None or first_ms >= start_ms) and \
+                            (end_ms is None or segment['last_ms'] <= end_ms):
+                        # Читатели дочитают уже открытый дескриптор удаленного файла
+                        os.remove(segment['path'])
+                        seal_segment(segment)
+                        removed[name] = removed.get(name, 0) + 1
+                    else:
+                        kept.append(segment)
+                segments[:] = kept
+        if removed.get('history'):
+            # Производные данные пересчитываются по оставшейся истории
+            history_pyramids.pop(safe_name, None)
+            device_stats.pop(safe_name, None)
+            schedule_stats_rebuild([safe_name])
+        if removed.get('track'):
+            reindex_device_track(safe_name)
+    return sum(removed.values())
+
+def clear_history_store(safe_name=None):
+    """Закрывает и удаляет историю одного устройства или всех устройств"""
+    load_history_store()
+    with history_lock:
+        names = [safe_name] if safe_name is not None else list(set(history_store) | set(track_store))
+        for name in names:
+            for segment in history_store.pop(name, []) + track_store.pop(name, []):
+                seal_segment(segment)
+            history_pyramids.pop(name, None)
+        if safe_name is not None:
+            shutil.rmtree(history_device_dir(safe_name), ignore_errors=True)
+        else:
+            shutil.rmtree(HISTORY_DIR, ignore_errors=True)
+    clear_spatial_index(safe_name)
+
+def count_history(safe_name, start_ms=None, end_ms=None):
+    """Число записей истории за интервал (по индексу, без чтения записей)"""
+    load_history_store()
+    segments = acquire_segments(safe_name)
+    try:
+        total = 0
+        for segment, count in segments:
+            if count:
+                low = history_lower_bound(segment, count, start_ms) if start_ms is not None else 0
+                high = history_lower_bound(segment, count, end_ms + 1) if end_ms is not None else count
+                total += max(0, high - low)
+        return total
+    finally:
+        release_segments(segments)
+
+def new_history_pyramid():
+    return [{'width': HISTORY_PYRAMID_BASE_MS * HISTORY_PYRAMID_FACTOR ** level, 'keys': [], 'buckets': []}
+            for level in range(HISTORY_PYRAMID_LEVELS)]
+
+def add_to_pyramid(pyramid, records):
+    """Дописывает записи (epoch_ms, speed) в корзины всех уровней пирамиды"""
+    for level in pyramid:
+        width = level['width']
+        keys = level['keys']
+        buckets = level['buckets']
+        for epoch_ms, speed in records:
+            key = epoch_ms // width
+            if keys and keys[-1] == key:
+                bucket = buckets[-1]
+            elif not keys or key > keys[-1]:
+                keys.append(key)
+                buckets.append([epoch_ms, speed, epoch_ms, speed])
+                continue
+            else:
+                # Досланные старые данные - корзина ищется двоичным поиском
+                position = bisect_left(keys, key)
+                if keys[position] != key:
+                    keys.insert(position, key)
+                    buckets.insert(position, [epoch_ms, speed, epoch_ms, speed])
+                    continue
+                bucket = buckets[position]
+            # Корзина: [время минимума, минимум, время максимума, максимум]
+            if speed < bucket[1]:
+                bucket[0], bucket[1] = epoch_ms, speed
+            if speed > bucket[3]:
+                bucket[2], bucket[3] = epoch_ms, speed
+
+def add_segments_to_pyramid(pyramid, segments, done=None, block_records=4096):
+    """Добавляет в пирамиду записи захваченных сегментов, кроме первых done[id(segment)] записей"""
+    done = done or {}
+    records = heapq.merge(*(iter_segment_records(segment, done.get(id(segment), 0), count, block_records)
+                            for segment, count in segments))
+    block = []
+    for record in records:
+        block.append(record)
+        if len(block) >= block_records:
+            add_to_pyramid(pyramid, block)
+            block = []
+    add_to_pyramid(pyramid, block)
+
+def get_history_pyramid(safe_name):
+    """Пирамида устройства; если еще не построена - строится по истории
+
+    История читается без блокировки устройства (прием данных не ждет);
+    под блокировкой дочитываются только записи, дописанные за время построения.
+    Не вызывать под блокировкой устройства.
+    """
+    load_history_store()
+    while True:
+        pyramid = history_pyramids.get(safe_name)
+        if pyramid is not None:
+            return pyramid
+        pyramid = new_history_pyramid()
+        segments = acquire_segments(safe_name)
+        try:
+            add_segments_to_pyramid(pyramid, segments)
+            done = {id(segment): count for segment, count in segments}
+            with get_device_lock(safe_name):
+                if safe_name in history_pyramids:
+                    return history_pyramids[safe_name]
+                current = acquire_segments(safe_name)
+                try:
+                    if not done.keys() <= {id(segment) for segment, _ in current}:
+                        # Сегменты удалены за время построения - строим заново
+                        continue
+                    add_segments_to_pyramid(pyramid, current, done)
+                finally:
+                    release_segments(current)
+                history_pyramids[safe_name] = pyramid
+                return pyramid
+        finally:
+            release_segments(segments)
+
+def build_history_pyramids():
+    """Строит пирамиды всех устройств (фоновый поток при запуске сервера)"""
+    load_history_store()
+    with history_lock:
+        names = sorted(history_store)
+    started = time.perf_counter()
+    for safe_name in names:
+        try:
+            get_history_pyramid(safe_name)
+        except Exception as e:
+            log_event('error', f'❌ Ошибка построения пирамиды истории {safe_name}: {e}')
+    log_event('info', f'📈 Пирамиды истории построены: {len(names)} устройств за {time.perf_counter() - started:.1f} с')
+
+def pyramid_points(level, start_ms=None, end_ms=None):
+    """Точки минимумов и максимумов корзин уровня за интервал, по возрастанию времени"""
+    keys = level['keys']
+    low = bisect_left(keys, start_ms // level['width']) if start_ms is not None else 0
+    high = bisect_left(keys, end_ms // level['width'] + 1) if end_ms is not None else len(keys)
+    points = []
+    for min_ms, min_speed, max_ms, max_speed in level['buckets'][low:high]:
+        pair = sorted(((min_ms, min_speed), (max_ms, max_speed)))
+        for point in (pair if min_ms != max_ms else pair[:1]):
+            # Крайние корзины могут выходить за границы интервала
+            if (start_ms is None or point[0] >= start_ms) and (end_ms is None or point[0] <= end_ms):
+                points.append(point)
+    return points
+
+def lttb(points, threshold):
+    """Прореживание Largest-Triangle-Three-Buckets до threshold точек"""
+    if threshold >= len(points) or threshold < 3:
+        return points
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / (threshold - 2)
+    selected = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+        # Средняя точка следующей корзины
+        next_end = min(int((bucket + 2) * bucket_size) + 1, len(points))
+        next_points = points[end:next_end] or [points[-1]]
+        avg_x = sum(point[0] for point in next_points) / len(next_points)
+        avg_y = sum(point[1] for point in next_points) / len(next_points)
+        ax, ay = points[selected]
+        best_area = -1.0
+        best = start
+        for index in range(start, end):
+            x, y = points[index]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                best = index
+        sampled.append(points[best])
+        selected = best
+    sampled.append(points[-1])
+    return sampled
+
+def downsample_history(safe_name, start_ms, end_ms, points, method='minmax'):
+    """Прореженная история устройства: (точки, источник). Стоимость ограничена числом точек, а не длиной сессии"""
+    total = count_history(safe_name, start_ms, end_ms)
+    if total <= points:
+        # Мало записей - отдаем как есть
+        return query_history(safe_name, start_ms, end_ms), 'raw'
+    if method == 'lttb' and total <= points * 4:
+        return lttb(query_history(safe_name, start_ms, end_ms), points), 'lttb:raw'
+    
+    pyramid = get_history_pyramid(safe_name)
+    with get_device_lock(safe_name):
+        finest = pyramid[0]
+        if not finest['keys']:
+            return [], 'raw'
+        first_ms = finest['keys'][0] * finest['width']
+        last_ms = (finest['keys'][-1] + 1) * finest['width']
+        span = (end_ms if end_ms is not None else last_ms) - (start_ms if start_ms is not None else first_ms)
+        # min/max дает до двух точек на корзину; для LTTB берется уровень в 4 раза подробнее ответа
+        budget = points // 2 if method == 'minmax' else points * 2
+        for level in pyramid:
+            if span / level['width'] > budget and level is not pyramid[-1]:
+                continue
+            source = pyramid_points(level, start_ms, end_ms)
+            if method == 'lttb' or len(source) <= points or level is pyramid[-1]:
+                break
+    
+    if method == 'lttb':
+        return lttb(source, points), f"lttb:{level['width'] // 1000}s"
+    if len(source) > points:
+        # Даже самый грубый уровень не укладывается - сливаем соседние корзины
+        return merge_minmax(source, points), f"minmax:{level['width'] // 1000}s+"
+    return source, f"minmax:{level['width'] // 1000}s"
+
+def merge_minmax(points, limit):
+    """Сливает подряд идущие точки в группы (минимум и максимум каждой) - не больше limit точек на весь интервал"""
+    size = -(-len(points) // (limit // 2))
+    merged = []
+    for start in range(0, len(points), size):
+        group = points[start:start + size]
+        low = min(group, key=lambda point: point[1])
+        high = max(group, key=lambda point: point[1])
+        merged.extend(sorted({low, high}))
+    return merged
+
+# Пространственный индекс: сетка широта/долгота с шагом SPATIAL_CELL_DEG.
+# track_cells: ячейка -> {safe_name: [[first_ms, last_ms], ...]} - интервалы времени,
+# когда устройство было в ячейке (идущие подряд точки одной ячейки - один интервал);
+# сами точки читаются из трека только по найденным интервалам.
+# position_cells: ячейка -> устройства, последняя позиция которых в ней.
+# Изменяется под spatial_lock. При запуске индекс треков строится фоновым
+# потоком; пока устройство в track_pending, прием данных обновляет только его
+# текущую позицию, а интервалы добавит построение.
+METERS_PER_DEGREE = 111_320
+spatial_lock = threading.Lock()
+spatial_state = {'loaded': False, 'started': False}
+track_pending = set()
+track_cells = {}
+track_device_cells = {}
+track_last_span = {}
+device_positions = {}
+position_cells = {}
+
+def spatial_cell(lat, lon):
+    return (math.floor(lat / SPATIAL_CELL_DEG), math.floor(lon / SPATIAL_CELL_DEG))
+
+def distance_m(lat1, lon1, lat2, lon2):
+    """Расстояние по большому кругу (гаверсинус), метры"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * 6_371_000 * math.asin(min(1.0, math.sqrt(a)))
+
+def cells_in_box(grid, min_lat, min_lon, max_lat, max_lon):
+    """Непустые ячейки сетки внутри прямоугольника: перебор диапазона ячеек или ключей - что меньше"""
+    low_lat, low_lon = spatial_cell(min_lat, min_lon)
+    high_lat, high_lon = spatial_cell(max_lat, max_lon)
+    if (high_lat - low_lat + 1) * (high_lon - low_lon + 1) <= len(grid):
+        return [(cell, grid[cell]) for cell in ((x, y) for x in range(low_lat, high_lat + 1) for y in range(low_lon, high_lon + 1))
+                if cell in grid]
+    return [(cell, value) for cell, value in grid.items()
+            if low_lat <= cell[0] <= high_lat and low_lon <= cell[1] <= high_lon]
+
+def split_track_spans(fixes, last=None):
+    """Разбивает отсортированные точки на интервалы пребывания в ячейках
+
+    Возвращает (новые интервалы [(ячейка, [first_ms, last_ms])], живой интервал,
+    самая новая точка). Живой интервал last продлевается на месте только точками
+    не старше его конца; подряд идущие точки одной ячейки внутри пакета - один
+    интервал, даже если весь пакет досылает старые данные.
+    """
+    spans = []
+    run = None
+    newest = None
+    for fix in fixes:
+        epoch_ms, lat, lon = fix[:3]
+        cell = spatial_cell(lat, lon)
+        if run is None and last is not None and epoch_ms >= last[1][1]:
+            run = last
+        if run is not None and run[0] == cell and epoch_ms >= run[1][1]:
+            run[1][1] = epoch_ms
+        else:
+            run = (cell, [epoch_ms, epoch_ms])
+            spans.append(run)
+        if last is None or epoch_ms >= last[1][1]:
+            last = run
+        if newest is None or epoch_ms >= newest[0]:
+            newest = fix
+    return spans, last, newest
+
+def add_track_spans(safe_name, spans):
+    """Добавляет интервалы устройства в сетку; вызывать под spatial_lock"""
+    cells = track_device_cells.setdefault(safe_name, set())
+    for cell, span in spans:
+        track_cells.setdefault(cell, {}).setdefault(safe_name, []).append(span)
+        cells.add(cell)
+
+def set_device_position(safe_name, fix, seen=None):
+    """Текущая позиция устройства, если точка не старше известной; вызывать под spatial_lock"""
+    epoch_ms, lat, lon, heading, accuracy = fix
+    current = device_positions.get(safe_name)
+    if current is not None and current['time'] > epoch_ms:
+        return
+    if current is not None:
+        forget_position(safe_name, current)
+    device_positions[safe_name] = {'time': epoch_ms, 'lat': lat, 'lon': lon, 'heading': heading, 'accuracy': accuracy, 'seen': seen}
+    position_cells.setdefault(spatial_cell(lat, lon), set()).add(safe_name)
+
+def index_track_fixes(safe_name, fixes, seen=None):
+    """Добавляет отсортированные точки трека в индекс при приеме данных; вызывать под spatial_lock"""
+    if safe_name not in track_pending:
+        spans, track_last_span[safe_name], _ = split_track_spans(fixes, track_last_span.get(safe_name))
+        add_track_spans(safe_name, spans)
+    set_device_position(safe_name, fixes[-1], seen)
+
+def forget_position(safe_name, position):
+    cell = spatial_cell(position['lat'], position['lon'])
+    names = position_cells.get(cell)
+    if names is not None:
+        names.discard(safe_name)
+        if not names:
+            del position_cells[cell]
+
+def forget_track_spans(safe_name):
+    """Убирает интервалы устройства из сетки; вызывать под spatial_lock"""
+    for cell in track_device_cells.pop(safe_name, ()):
+        devices = track_cells.get(cell)
+        if devices is not None:
+            devices.pop(safe_name, None)
+            if not devices:
+                del track_cells[cell]
+    track_last_span.pop(safe_name, None)
+
+def forget_device_track(safe_name):
+    """Убирает устройство из пространственного индекса; вызывать под spatial_lock"""
+    forget_track_spans(safe_name)
+    track_pending.discard(safe_name)
+    position = device_positions.pop(safe_name, None)
+    if position is not None:
+        forget_position(safe_name, position)
+
+def index_device_track(safe_name):
+    """Строит индекс трека устройства по записанным точкам
+
+    Трек читается без блокировок (прием данных не ждет); под блокировкой
+    устройства дочитываются только точки, дописанные за время построения.
+    """
+    load_history_store()
+    while True:
+        segments = acquire_segments(safe_name, track_store)
+        try:
+            spans, last, newest = split_track_spans(
+                heapq.merge(*(iter_segment_records(segment, 0, count) for segment, count in segments)))
+            done = {id(segment): count for segment, count in segments}
+            with get_device_lock(safe_name):
+                current = acquire_segments(safe_name, track_store)
+                try:
+                    if not done.keys() <= {id(segment) for segment, _ in current}:
+                        # Сегменты удалены за время построения - строим заново
+                        continue
+                    tail, last, tail_newest = split_track_spans(
+                        heapq.merge(*(iter_segment_records(segment, done.get(id(segment), 0), count)
+                                      for segment, count in current)), last)
+                finally:
+                    release_segments(current)
+                with spatial_lock:
+                    forget_track_spans(safe_name)
+                    add_track_spans(safe_name, spans + tail)
+                    if last is not None:
+                        track_last_span[safe_name] = last
+                    track_pending.discard(safe_name)
+                    # Живая позиция (с временем приема) не заменяется той же точкой с диска
+                    newest = max((fix for fix in (newest, tail_newest) if fix is not None), default=None, key=lambda fix: fix[0])
+                    if newest is not None and safe_name not in device_positions:
+                        set_device_position(safe_name, newest)
+                return
+        finally:
+            release_segments(segments)
+
+def build_spatial_index():
+    """Строит индекс по всем трекам на диске (фоновый поток)"""
+    started = time.perf_counter()
+    with spatial_lock:
+        names = sorted(track_pending)
+    for safe_name in names:
+        try:
+            index_device_track(safe_name)
+        except Exception as e:
+            log_event('error', f"❌ Ошибка индексации трека {safe_name}: {e}")
+            with spatial_lock:
+                track_pending.discard(safe_name)
+    spatial_state['loaded'] = True
+    log_event('info', f'🗺️ Индекс треков построен: {len(names)} устройств за {time.perf_counter() - started:.1f} с')
+
+def load_spatial_index():
+    """Однократно запускает построение индекса треков в фоне; до его завершения доступны живые позиции"""
+    if spatial_state['started']:
+        return
+    load_history_store()
+    with spatial_lock:
+        if spatial_state['started']:
+            return
+        spatial_state['started'] = True
+        with history_lock:
+            track_pending.update(track_store)
+    threading.Thread(target=build_spatial_index, name='spatial-index', daemon=True).start()
+
+def reindex_device_track(safe_name):
+    """Перестраивает индекс трека устройства (после удаления сегментов)"""
+    if not spatial_state['started']:
+        return
+    index_device_track(safe_name)
+
+def clear_spatial_index(safe_name=None):
+    """Убирает из индекса одно устройство или все"""
+    with spatial_lock:
+        if safe_name is not None:
+            forget_device_track(safe_name)
+            return
+        for state in (track_cells, track_device_cells, track_last_span, device_positions, position_cells, track_pending):
+            state.clear()
+
+def append_track(safe_name, fixes):
+    """Дописывает отсортированные точки (epoch_ms, lat, lon, heading, accuracy) в трек и индекс"""
+    if not fixes:
+        return
+    load_spatial_index()
+    with get_device_lock(safe_name):
+        with history_lock:
+            segments = track_store.setdefault(safe_name, [])
+        append_segment_records(safe_name, segments, 'track', TRACK_RECORD, fixes)
+        with spatial_lock:
+            index_track_fixes(safe_name, fixes, time.monotonic())
+
+def find_nearby(lat, lon, radius_m, max_age=None):
+    """Устройства, последняя позиция которых в радиусе radius_m: [(расстояние, safe_name, позиция)]"""
+    load_spatial_index()
+    dlat = radius_m / METERS_PER_DEGREE
+    dlon = min(360.0, radius_m / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6)))
+    now = time.monotonic()
+    found = []
+    with spatial_lock:
+        for _, names in cells_in_box(position_cells, lat - dlat, lon - dlon, lat + dlat, lon + dlon):
+            for safe_name in names:
+                position = device_positions[safe_name]
+                if max_age is not None and (position['seen'] is None or now - position['seen'] > max_age):
+                    continue
+                distance = distance_m(lat, lon, position['lat'], position['lon'])
+                if distance <= radius_m:
+                    found.append((distance, safe_name, dict(position)))
+    found.sort(key=lambda item: (item[0], item[1]))
+    return found
+
+def query_track_box(min_lat, min_lon, max_lat, max_lon, start_ms=None, end_ms=None, device=None, limit=TRACK_MAX_POINTS):
+    """Точки треков внутри прямоугольника за интервал: ({safe_name: [точки]}, обрезано ли)"""
+    load_spatial_index()
+    spans = {}
+    with spatial_lock:
+        for _, devices in cells_in_box(track_cells, min_lat, min_lon, max_lat, max_lon):
+            for safe_name, device_spans in devices.items():
+                if device is not None and safe_name != device:
+                    continue
+                for first_ms, last_ms in device_spans:
+                    if (start_ms is None or last_ms >= start_ms) and (end_ms is None or first_ms <= end_ms):
+                        spans.setdefault(safe_name, []).append((
+                            first_ms if start_ms is None else max(first_ms, start_ms),
+                            last_ms if end_ms is None else min(last_ms, end_ms),
+                        ))
+    
+    tracks = {}
+    total = 0
+    for safe_name in sorted(spans):
+        # Соседние интервалы (проход через несколько ячеек) читаются одним запросом
+        intervals = []
+        for first_ms, last_ms in sorted(spans[safe_name]):
+            if intervals and first_ms - intervals[-1][1] <= 60_000:
+                intervals[-1][1] = max(intervals[-1][1], last_ms)
+            else:
+                intervals.append([first_ms, last_ms])
+        points = []
+        for first_ms, last_ms in intervals:
+            for fix in query_track(safe_name, first_ms, last_ms):
+                if min_lat <= fix[1] <= max_lat and min_lon <= fix[2] <= max_lon:
+                    if total >= limit:
+                        if points:
+                            tracks[safe_name] = points
+                        return tracks, True
+                    points.append(fix)
+                    total += 1
+        if points:
+            tracks[safe_name] = points
+    return tracks, False
+
+# Упрощение треков для выгрузки. Точки переводятся в локальные метры
+# (равнопромежуточная проекция), допуск tolerance - в метрах: для Дугласа-Пекера
+# это отклонение от хорды, для Висвалингам - сторона квадрата минимальной
+# площади треугольника (tolerance**2 м²).
+TRACK_SIMPLIFY_METHODS = ('none', 'dp', 'vw')
+TRACK_EXPORT_RE = re.compile(r'track_(?P<device>[^/\\]+)\.(?P<format>gpx|geojson)')
+
+def project_points(points):
+    """Точки трека (epoch_ms, lat, lon, ...) в метры относительно первой точки"""
+    scale = math.cos(math.radians(points[0][1])) * METERS_PER_DEGREE
+    return [(point[2] * scale, point[1] * METERS_PER_DEGREE) for point in points]
+
+def douglas_peucker(xy, tolerance):
+    """Номера точек, оставляемых алгоритмом Дугласа-Пекера (без рекурсии)"""
+    keep = [False] * len(xy)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xy) - 1)]
+    while stack:
+        first, last = stack.pop()
+        ax, ay = xy[first]
+        dx, dy = xy[last][0] - ax, xy[last][1] - ay
+        length = math.hypot(dx, dy)
+        farthest, farthest_distance = None, tolerance
+        for i in range(first + 1, last):
+            px, py = xy[i][0] - ax, xy[i][1] - ay
+            distance = abs(dy * px - dx * py) / length if length else math.hypot(px, py)
+            if distance > farthest_distance:
+                farthest, farthest_distance = i, distance
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [i for i, kept in enumerate(keep) if kept]
+
+def visvalingam(xy, tolerance):
+    """Номера точек, оставляемых алгоритмом Висвалингам-Уайатта (куча с ленивым удалением)"""
+    n = len(xy)
+    if n < 3:
+        return list(range(n))
+    previous = list(range(-1, n - 1))
+    following = list(range(1, n + 1))
+    
+    def triangle_area(i):
+        (ax, ay), (bx, by), (cx, cy) = xy[previous[i]], xy[i], xy[following[i]]
+        return abs((bx - ax) * (cy - ay) - (cx - ax) * (by - ay)) / 2
+    
+    areas = [0.0] + [triangle_area(i) for i in range(1, n - 1)] + [0.0]
+    heap = [(areas[i], i) for i in range(1, n - 1)]
+    heapq.heapify(heap)
+    removed = [False] * n
+    threshold = tolerance ** 2
+    while heap:
+        area, i = heapq.heappop(heap)
+        if removed[i] or area != areas[i]:
+            continue
+        if area >= threshold:
+            break
+        removed[i] = True
+        before, after = previous[i], following[i]
+        following[before] = after
+        previous[after] = before
+        for j in (before, after):
+            if 0 < j < n - 1:
+                # Эффективная площадь соседа не меньше удаленной - порядок удаления монотонный
+                areas[j] = max(triangle_area(j), area)
+                heapq.heappush(heap, (areas[j], j))
+    return [i for i in range(n) if not removed[i]]
+
+def simplify_track(points, method, tolerance, window=TRACK_SIMPLIFY_WINDOW):
+    """Упрощает поток точек окнами по window точек: память не зависит от длины трека"""
+    simplify = douglas_peucker if method == 'dp' else visvalingam
+    batch = []
+    for point in points:
+        batch.append(point)
+        if len(batch) >= window:
+            kept = simplify(project_points(batch), tolerance)
+            for i in kept[:-1]:
+                yield batch[i]
+            # Последняя точка окна всегда остается и начинает следующее окно
+            batch = [batch[-1]]
+    if batch:
+        for i in simplify(project_points(batch), tolerance):
+            yield batch[i]
+
+def format_track_time(epoch_ms):
+    """Время точки трека в ISO 8601 (UTC)"""
+    return f"{datetime.fromtimestamp(epoch_ms // 1000, pytz.utc):%Y-%m-%dT%H:%M:%S}.{epoch_ms % 1000:03d}Z"
+
+def iter_gpx(name, points):
+    """Документ GPX 1.1 по частям"""
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<gpx version="1.1" creator="69F GPS Speed" xmlns="http://www.topografix.com/GPX/1/1">\n'
+           f'<trk><name>{escape(name)}</name><trkseg>\n')
+    for epoch_ms, lat, lon, _, _ in points:
+        yield f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><time>{format_track_time(epoch_ms)}</time></trkpt>\n'
+    yield '</trkseg></trk>\n</gpx>\n'
+
+def iter_geojson(name, safe_name, make_points):
+    """Feature GeoJSON (LineString) по частям; make_points вызывается дважды - для координат и времени,
+    и оба раза должна отдавать одни и те же точки"""
+    yield json.dumps({'type': 'Feature', 'properties': {'name': name, 'device': safe_name}}, ensure_ascii=False)[:-2]
+    yield ', "coordTimes": ['
+    separator = ''
+    for point in make_points():
+        yield f'{separator}"{format_track_time(point[0])}"'
+        separator = ', '
+    yield ']}, "geometry": {"type": "LineString", "coordinates": ['
+    separator = ''
+    for _, lat, lon, _, _ in make_points():
+        yield f'{separator}[{lon:.7f}, {lat:.7f}]'
+        separator = ', '
+    yield ']}}\n'
+
+# Накопительная статистика скорости по устройствам: обновляется за O(1) на
+# сэмпл при приеме данных (Welford для среднего и дисперсии, максимум,
+# дистанция по трапециям). Для скользящих средних хранится окно самого
+# длинного интервала с накопленной суммой скорости: среднее считается при
+# чтении относительно текущего времени, поэтому замолчавшее устройство не
+# показывает навсегда последнее значение.
+# Изменяется под блокировкой устройства. При холодном старте (и после удаления
+# сегментов) пересчитывается по бинарной истории фоновым потоком; пока
+# устройство в stats_pending, прием данных статистику не трогает - новые
+# записи пересчет дочитает из истории.
+device_stats = {}
+stats_pending = set()
+
+def new_device_stats():
+    return {
+        'count': 0,
+        'mean': 0.0,
+        'm2': 0.0,
+        'max': None,
+        'distance_km': 0.0,
+        'last_ms': None,
+        'last_speed': None,
+        # (epoch_ms, сумма скоростей до этого сэмпла) и сумма с последним сэмплом
+        'window': deque(),
+        'window_total': 0.0,
+    }
+
+def update_device_stats(stats, epoch_ms, speed):
+    """Добавляет сэмпл в статистику устройства"""
+    stats['count'] += 1
+    delta = speed - stats['mean']
+    stats['mean'] += delta / stats['count']
+    stats['m2'] += delta * (speed - stats['mean'])
+    if stats['max'] is None or speed > stats['max']:
+        stats['max'] = speed
+    
+    last_ms = stats['last_ms']
+    if last_ms is not None and epoch_ms < last_ms:
+        # Досланный старый сэмпл: окна и дистанция ведутся только по возрастанию времени
+        return
+    if last_ms is not None and epoch_ms - last_ms <= STATS_MAX_GAP * 1000:
+        stats['distance_km'] += (speed + stats['last_speed']) / 2 * (epoch_ms - last_ms) / 3_600_000
+    stats['last_ms'] = epoch_ms
+    stats['last_speed'] = speed
+    
+    window = stats['window']
+    while window and window[0][0] <= epoch_ms - max(STATS_WINDOWS) * 1000:
+        window.popleft()
+    if not window:
+        # Сбрасываем накопленную погрешность суммы
+        stats['window_total'] = 0.0
+    window.append((epoch_ms, stats['window_total']))
+    stats['window_total'] += speed
+
+def summarize_device_stats(stats):
+    """Итоги статистики для /api/data и Excel"""
+    count = stats['count']
+    summary = {
+        'samples': count,
+        'max_speed': round(stats['max'], 2) if stats['max'] is not None else None,
+        'avg_speed': round(stats['mean'], 2) if count else None,
+        'stddev_speed': round(math.sqrt(stats['m2'] / (count - 1)), 2) if count > 1 else None,
+        'distance_km': round(stats['distance_km'], 3),
+    }
+    # Снимок окна: средние за интервалы считает device_stats_view при чтении
+    summary['window'] = (tuple(stats['window']), stats['window_total'])
+    return summary
+
+def device_stats_view(summary, now_ms=None):
+    """Итоги статистики со скользящими средними на момент now_ms (по умолчанию - сейчас)"""
+    if not summary:
+        return summary
+    if now_ms is None:
+        now_ms = time.time() * 1000
+    view = {key: value for key, value in summary.items() if key != 'window'}
+    samples, total = summary.get('window', ((), 0.0))
+    for seconds in STATS_WINDOWS:
+        position = bisect_right(samples, (now_ms - seconds * 1000, math.inf))
+        count = len(samples) - position
+        view[f'avg_{seconds}s'] = round((total - samples[position][1]) / count, 2) if count else None
+    return view
+
+def get_device_stats(safe_name):
+    """Статистика устройства или None, пока она пересчитывается; вызывать под блокировкой устройства"""
+    if safe_name in stats_pending:
+        return None
+    stats = device_stats.get(safe_name)
+    if stats is None:
+        # Новое устройство или удаленная история - пересчет мгновенный
+        stats = rebuild_device_stats(safe_name)
+    return stats
+
+def rebuild_device_stats(safe_name):
+    """Пересчитывает статистику устройства по бинарной истории
+
+    История читается без блокировки устройства (прием данных не ждет);
+    под блокировкой дочитываются только записи, дописанные за время пересчета.
+    """
+    load_history_store()
+    while True:
+        stats = new_device_stats()
+        segments = acquire_segments(safe_name)
+        try:
+            for epoch_ms, speed in heapq.merge(*(iter_segment_records(segment, 0, count) for segment, count in segments)):
+                update_device_stats(stats, epoch_ms, speed)
+            done = {id(segment): count for segment, count in segments}
+            with get_device_lock(safe_name):
+                current = acquire_segments(safe_name)
+                try:
+                    if not done.keys() <= {id(segment) for segment, _ in current}:
+                        # Сегменты удалены за время пересчета - считаем заново
+                        continue
+                    for epoch_ms, speed in heapq.merge(*(iter_segment_records(segment, done.get(id(segment), 0), count)
+                                                         for segment, count in current)):
+                        update_device_stats(stats, epoch_ms, speed)
+                finally:
+                    release_segments(current)
+                device_stats[safe_name] = stats
+                stats_pending.discard(safe_name)
+                entry = set_device_stats_summary(safe_name, summarize_device_stats(stats))
+            if entry is not None:
+                publish_device_update(entry)
+                mark_excel_dirty()
+            return stats
+        finally:
+            release_segments(segments)
+
+def rebuild_pending_stats(names):
+    """Пересчитывает статистику устройств из stats_pending (фоновый поток)"""
+    for safe_name in names:
+        if safe_name not in stats_pending:
+            continue
+        try:
+            rebuild_device_stats(safe_name)
+        except Exception as e:
+            log_event('error', f'❌ Ошибка пересчета статистики {safe_name}: {e}')
+            stats_pending.discard(safe_name)
+
+def schedule_stats_rebuild(names):
+    """Помечает статистику устройств устаревшей и пересчитывает ее в фоне"""
+    if not names:
+        return
+    stats_pending.update(names)
+    threading.Thread(target=rebuild_pending_stats, args=(sorted(names),), name='device-stats', daemon=True).start()
+
+# Последние сэмплы устройств: кольцевой буфер (epoch_ms, speed) на
+# RECENT_BUFFER_SIZE записей, пополняется при приеме данных. При холодном старте
+# заполняется чтением последних строк текущего лога с конца файла.
+# Изменяется под блокировкой устройства.
+recent_samples = {}
+
+def parse_log_line(line):
+    """Строка лога устройства 'YYYY-MM-DD HH:MM:SS - 12.5 км/ч' -> (epoch_ms, speed) или None"""
+    timestamp, _, rest = line.partition(' - ')
+    try:
+        moment = pytz.timezone('Europe/Moscow').localize(datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S'))
+        return int(moment.timestamp() * 1000), float(rest.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+def get_recent_buffer(safe_name):
+    """Буфер последних сэмплов; вызывать под блокировкой устройства"""
+    buffer = recent_samples.get(safe_name)
+    if buffer is None:
+        buffer = deque(maxlen=RECENT_BUFFER_SIZE)
+        log_file = os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')
+        # Строки могут быть еще в очереди писателя
+        flush_logs()
+        if os.path.exists(log_file):
+            lines = read_tail_lines(log_file, RECENT_BUFFER_SIZE).decode('utf-8', 'replace').splitlines()
+            samples = [sample for sample in map(parse_log_line, lines) if sample is not None]
+            buffer.extend(sorted(samples))
+        recent_samples[safe_name] = buffer
+    return buffer
+
+def add_recent_samples(buffer, records):
+    """Добавляет отсортированные записи в буфер; досланные старые встают на свое место"""
+    for record in records:
+        if not buffer or record[0] >= buffer[-1][0]:
+            buffer.append(record)
+        elif len(buffer) < buffer.maxlen or record[0] > buffer[0][0]:
+            position = bisect_left(buffer, record)
+            if len(buffer) == buffer.maxlen:
+                # Вытесняем самую старую запись
+                buffer.popleft()
+                position -= 1
+            buffer.insert(position, record)
+
+def get_recent_samples(safe_name, count=None, seconds=None):
+    """Последние count сэмплов и/или сэмплы за последние seconds секунд"""
+    with get_device_lock(safe_name):
+        buffer = get_recent_buffer(safe_name)
+        result = []
+        cutoff_ms = (time.time() - seconds) * 1000 if seconds is not None else None
+        limit = count if count is not None else len(buffer)
+        # Идем с конца буфера: стоимость пропорциональна размеру ответа,
+        # n больше размера буфера просто возвращает весь буфер
+        for record in reversed(buffer):
+            if len(result) >= limit or (cutoff_ms is not None and record[0] < cutoff_ms):
+                break
+            result.append(record)
+    result.reverse()
+    return result
+
+# Аналитика по истории: записи устройства загружаются из бинарных сегментов
+# в колоночные массивы NumPy (время int64, скорость float32) и кэшируются.
+# Ключ кэша - (номер, число записей) каждого сегмента, поэтому любая дозапись
+# истории делает кэш устройства недействительным.
+analytics_cache = {}
+analytics_cache_lock = threading.Lock()
+
+def get_history_key(safe_name):
+    """Версия истории устройства: (номер, число записей) каждого сегмента"""
+    load_history_store()
+    with history_lock:
+        return tuple((segment['number'], segment['count']) for segment in history_store.get(safe_name, []))
+
+def load_history_arrays(safe_name):
+    """История устройства как массивы (times_ms, speeds), отсортированные по времени"""
+    key = get_history_key(safe_name)
+    with analytics_cache_lock:
+        cached = analytics_cache.get(safe_name)
+        if cached is not None and cached[0] == key:
+            return cached[1], cached[2]
+    
+    # Формат записи '<qf' совпадает с упакованным структурным типом NumPy
+    records = np.frombuffer(b''.join(read_history_chunks(safe_name)), dtype=np.dtype([('t', '<i8'), ('v', '<f4')]))
+    times = records['t'].copy()
+    speeds = records['v'].astype(np.float64)
+    if len(key) > 1 and np.any(np.diff(times) < 0):
+        # Сегменты пересекаются по времени (досылка старых данных) - общий порядок по времени
+        order = np.argsort(times, kind='stable')
+        times = times[order]
+        speeds = speeds[order]
+    
+    with analytics_cache_lock:
+        analytics_cache[safe_name] = (key, times, speeds)
+    return times, speeds
+
+def finite_or_none(value, digits=2):
+    value = float(value)
+    return round(value, digits) if math.isfinite(value) else None
+
+def bucket_averages(times, speeds, boundaries):
+    """Средняя и максимальная скорость между соседними границами (epoch ms)"""
+    boundaries = np.asarray(boundaries, dtype=np.int64)
+    bucket = np.searchsorted(boundaries, times, side='right') - 1
+    inside = (bucket >= 0) & (bucket < len(boundaries) - 1)
+    bucket = bucket[inside]
+    values = speeds[inside]
+    buckets = len(boundaries) - 1
+    counts = np.bincount(bucket, minlength=buckets)
+    sums = np.bincount(bucket, weights=values, minlength=buckets)
+    maxima = np.full(buckets, -np.inf)
+    np.maximum.at(maxima, bucket, values)
+    result = []
+    for number in range(buckets):
+        count = int(counts[number])
+        result.append({
+            'start': int(boundaries[number]),
+            'end': int(boundaries[number + 1]),
+            'samples': count,
+            'avg_speed': finite_or_none(sums[number] / count) if count else None,
+            'max_speed': finite_or_none(maxima[number]) if count else None,
+        })
+    return result
+
+def analyze_device(times, speeds, percentiles, threshold=None, segment_ms=None, laps=None):
+    """Агрегаты скорости одного устройства по отсортированным массивам"""
+    result = {'samples': int(len(times))}
+    if not len(times):
+        return result
+    
+    # Длительность интервалов между сэмплами; разрывы больше STATS_MAX_GAP не учитываются
+    intervals = np.diff(times) / 1000.0
+    intervals[intervals > STATS_MAX_GAP] = 0.0
+    result.update({
+        'start': int(times[0]),
+        'end': int(times[-1]),
+        'tracked_s': finite_or_none(intervals.sum(), 1),
+        'min_speed': finite_or_none(speeds.min()),
+        'max_speed': finite_or_none(speeds.max()),
+        'avg_speed': finite_or_none(speeds.mean()),
+        'stddev_speed': finite_or_none(speeds.std(ddof=1)) if len(speeds) > 1 else None,
+        'percentiles': {f'p{value:g}': finite_or_none(point)
+                        for value, point in zip(percentiles, np.percentile(speeds, percentiles))},
+        # Дистанция по трапециям не зависит от неравномерной частоты сэмплов
+        'distance_km': finite_or_none(((speeds[1:] + speeds[:-1]) / 2 * intervals).sum() / 3600, 3),
+    })
+    if threshold is not None:
+        above = (intervals * (speeds[:-1] >= threshold)).sum()
+        total = intervals.sum()
+        result['time_above_threshold_s'] = finite_or_none(above, 1)
+        result['share_above_threshold'] = finite_or_none(above / total, 4) if total else None
+    if segment_ms:
+        result['segments'] = bucket_averages(times, speeds, np.arange(times[0], times[-1] + segment_ms, segment_ms))
+    if laps:
+        result['laps'] = bucket_averages(times, speeds, laps)
+    return result
+
+def resample_series(times, speeds, grid):
+    """Скорость на общей временной сетке: линейная интерполяция, None вне данных и в разрывах"""
+    if len(times) < 2:
+        return [None] * len(grid)
+    values = np.interp(grid, times, speeds)
+    right = np.searchsorted(times, grid, side='left')
+    left = np.clip(right - 1, 0, len(times) - 1)
+    right = np.clip(right, 0, len(times) - 1)
+    exact = times[right] == grid
+    gap = (times[right] - times[left]) > STATS_MAX_GAP * 1000
+    invalid = (grid < times[0]) | (grid > times[-1]) | (gap & ~exact)
+    values[invalid] = np.nan
+    return [finite_or_none(value) for value in values]
+
+# Максимум строк данных на листе Excel (ограничение формата - 1 048 576 строк)
+EXCEL_MAX_ROWS = 1_048_575
+
+def excel_header_row(ws, headers):
+    """Строка заголовков листа в режиме потоковой записи"""
+    row = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.font = Font(bold=True, color="FFFFFF")
+        cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        cell.alignment = Alignment(horizontal="center")
+        row.append(cell)
+    return row
+
+def excel_sheet_title(name, used):
+    """Имя листа: без запрещенных символов, не длиннее 31 символа, уникальное"""
+    base = re.sub(r'[\[\]:*?/\\]', '_', name)[:31] or 'Device'
+    title = base
+    number = 2
+    while title.lower() in used:
+        suffix = f' ({number})'
+        title = base[:31 - len(suffix)] + suffix
+        number += 1
+    used.add(title.lower())
+    return title
+
+def create_excel_file(path=None, start_ms=None, end_ms=None, include_history=False):
+    """Собирает Excel файл заново в режиме потоковой записи (write-only)
+
+    Лист "GPS Speed Data" - сводка по устройствам. С include_history для каждого
+    устройства добавляется лист истории за интервал [start_ms, end_ms], строки
+    читаются из бинарной истории блоками и сразу пишутся в файл, поэтому
+    память не зависит от числа строк.
+    """
+    excel_file = path or EXCEL_FILE
+    tmp_file = f'{excel_file}.tmp'
+    try:
+        moscow_tz = pytz.timezone('Europe/Moscow')
+        wb = Workbook(write_only=True)
+        used_titles = set()
+        
+        ws = wb.create_sheet(excel_sheet_title("GPS Speed Data", used_titles))
+        ws.column_dimensions['A'].width = 20
+        ws.column_dimensions['B'].width = 15
+        ws.column_dimensions['C'].width = 12
+        for column in 'DEFGH':
+            ws.column_dimensions[column].width = 15
+        ws.append(excel_header_row(ws, ["Устройство", "Скорость (км/ч)", "Время", "Макс. (км/ч)", "Средняя (км/ч)",
+                                        "Средняя 10 с", "Средняя 1 мин", "Дистанция (км)"]))
+        
+        # Заполняем данными из реестра устройств
+        now = time.monotonic()
+        devices = get_devices_snapshot()
+        for entry in devices:
+            device = describe_device(entry, now)
+            if not device['is_active']:
+                # Устройство не трекается - ставим прочерки
+                row = [device['name'], "—", "—"]
+            else:
+                # Устройство активно - записываем данные
+                speed = entry['speed']
+                timestamp_str = entry['timestamp']
+                try:
+                    dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
+                    time_only = dt.strftime('%H:%M:%S')
+                except:
+                    time_only = timestamp_str
+                row = [device['name'], float(speed) if speed.replace('.', '').isdigit() else speed, time_only]
+            
+            # Накопленная статистика сессии - и для неактивных устройств
+            stats = device_stats_view(entry.get('stats'))
+            if stats:
+                row += [stats[key] for key in ('max_speed', 'avg_speed', 'avg_10s', 'avg_60s', 'distance_km')]
+            ws.append(row)
+        
+        if include_history:
+            load_history_store()
+            with history_lock:
+                names = sorted(history_store)
+            for safe_name in names:
+                ws = None
+                rows = EXCEL_MAX_ROWS
+                for epoch_ms, speed in iter_history(safe_name, start_ms, end_ms):
+                    if rows >= EXCEL_MAX_ROWS:
+                        # Лист заполнен - продолжаем на следующем
+                        ws = wb.create_sheet(excel_sheet_title(safe_name, used_titles))
+                        ws.column_dimensions['A'].width = 22
+                        ws.column_dimensions['B'].width = 15
+                        ws.append(excel_header_row(ws, ["Время", "Скорость (км/ч)"]))
+                        rows = 0
+                    moment = datetime.fromtimestamp(epoch_ms / 1000, moscow_tz).replace(tzinfo=None)
+                    ws.append([moment, round(speed, 2)])
+                    rows += 1
+        
+        # Сохраняем файл атомарно: пишем во временный и переименовываем
+        wb.save(tmp_file)
+        os.replace(tmp_file, excel_file)
+        
+        log_event('debug', f"✅ Excel файл обновлен: {excel_file}")
+        return excel_file
+        
     except Exception as e:
-        print(f"❌ Ошибка в update_inactive_devices: {e}")
+        log_event('error', f"❌ Ошибка создания Excel файла: {e}")
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return None
+
+# Состояние фонового экспорта Excel. excel_export_lock защищает только флаги
+# (его берет каждый прием данных), сборки сериализуются excel_rebuild_lock
+excel_export_lock = threading.Lock()
+excel_rebuild_lock = threading.Lock()
+excel_history_lock = threading.Lock()
+excel_export_event = threading.Event()
+excel_export_stats = {
+    'dirty': False,
+    'rebuilds': 0,
+    'skipped': 0,
+    'last_build': 0.0,
+    'worker_started': False,
+}
+
+def mark_excel_dirty():
+    """Помечает Excel файл устаревшим и будит фоновый экспортер"""
+    with excel_export_lock:
+        if excel_export_stats['dirty']:
+            # Пересборка уже запланирована - эта запись войдет в нее
+            excel_export_stats['skipped'] += 1
+        excel_export_stats['dirty'] = True
+        if not excel_export_stats['worker_started']:
+            excel_export_stats['worker_started'] = True
+            threading.Thread(target=excel_export_worker, name='excel-export', daemon=True).start()
+    excel_export_event.set()
+
+def rebuild_excel_file(force=False):
+    """Пересобирает Excel файл, если он устарел (или принудительно)"""
+    # Переходы в неактивное состояние тоже делают файл устаревшим
+    collect_inactive_devices()
+    with excel_rebuild_lock:
+        with excel_export_lock:
+            if not (force or excel_export_stats['dirty'] or not os.path.exists(EXCEL_FILE)):
+                return EXCEL_FILE
+            # Данные, пришедшие во время сборки, снова пометят файл устаревшим
+            excel_export_stats['dirty'] = False
+        started = time.perf_counter()
+        excel_file = create_excel_file()
+        record_excel_rebuild(time.perf_counter() - started)
+        with excel_export_lock:
+            excel_export_stats['last_build'] = time.monotonic()
+            if excel_file:
+                excel_export_stats['rebuilds'] += 1
+        return excel_file
 
-def create_excel_file():
-    """Создает или обновляет Excel файл с данными о скорости всех устройств"""
+def excel_export_worker():
+    """Фоновый поток: пересобирает Excel не чаще EXCEL_EXPORT_INTERVAL"""
+    while True:
+        excel_export_event.wait()
+        excel_export_event.clear()
+        delay = EXCEL_EXPORT_INTERVAL - (time.monotonic() - excel_export_stats['last_build'])
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            if excel_export_stats['dirty']:
+                rebuild_excel_file()
+        except Exception as e:
+            log_event('warning', f"⚠️ Ошибка фонового обновления Excel: {e}")
+
+def read_tail_lines(path, count, block_size=64 * 1024):
+    """Последние count строк файла: чтение блоками с конца, без чтения всего файла"""
+    if count <= 0:
+        return b''
+    with open(path, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        data = b''
+        # Нужно count+1 переводов строки, чтобы первая из count строк была полной
+        while position > 0 and data.count(b'\n') <= count:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            data = f.read(read_size) + data
+    return b''.join(data.splitlines(keepends=True)[-count:])
+
+def parse_byte_range(header, size):
+    """Разбирает заголовок Range: (start, end), None - игнорировать, 'invalid' - 416"""
+    match = re.fullmatch(r'\s*bytes=(\d*)-(\d*)\s*', header)
+    if not match or not any(match.groups()):
+        # Несколько диапазонов или неизвестные единицы - отдаем файл целиком
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # bytes=-N - последние N байт
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size or start > end:
+        return 'invalid'
+    return start, end
+
+# Сжатые версии повторяющихся ответов (страницы): (sha1, кодировка) -> байты
+compressed_payload_cache = OrderedDict()
+compressed_payload_lock = threading.Lock()
+
+def choose_encoding(accept_encoding):
+    """Выбирает кодировку сжатия по Accept-Encoding: br, gzip или None"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        match = re.search(r'q=([\d.]+)', params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        if name:
+            accepted[name.lower()] = quality
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return 'br'
+    if accepted.get('gzip', accepted.get('*', 0)) > 0:
+        return 'gzip'
+    return None
+
+def compress_payload(data, encoding, cache=False):
+    """Сжимает ответ; cache=True - хранит результат для повторных одинаковых ответов"""
+    key = None
+    if cache:
+        key = (hashlib.sha1(data).digest(), encoding)
+        with compressed_payload_lock:
+            if key in compressed_payload_cache:
+                compressed_payload_cache.move_to_end(key)
+                return compressed_payload_cache[key]
+    
+    if encoding == 'br':
+        compressed = brotli.compress(data, quality=5)
+    else:
+        compressed = gzip.compress(data, compresslevel=6)
+    
+    if key is not None:
+        with compressed_payload_lock:
+            compressed_payload_cache[key] = compressed
+            while len(compressed_payload_cache) > 32:
+                compressed_payload_cache.popitem(last=False)
+    return compressed
+
+def iter_compressed(source, encoding, limit=None, block_size=256 * 1024):
+    """Потоково сжимает открытый файл (не больше limit байт) блоками br или gzip"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=5)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+    remaining = limit
+    while remaining is None or remaining > 0:
+        chunk = source.read(block_size if remaining is None else min(block_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        data = compress(chunk)
+        if data:
+            yield data
+    yield finish()
+
+def compress_file(source_path, target_path, encoding):
+    """Потоково сжимает файл (постоянный объем памяти), запись атомарная"""
+    # У каждого вызова свой временный файл: одновременные скачивания не пишут в один
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target_path), prefix='.compress_', suffix='.tmp')
     try:
-        excel_file = os.path.join(DATA_DIR, 'gps_speed_data.xlsx')
+        with os.fdopen(fd, 'wb') as target, open(source_path, 'rb') as source:
+            for data in iter_compressed(source, encoding):
+                target.write(data)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def get_compressed_copy(filepath, filename, etag, encoding):
+    """Сжатая копия закрытого (архивного) файла для скачивания; пересоздается только при изменении файла"""
+    os.makedirs(COMPRESSED_DIR, exist_ok=True)
+    suffix = '.br' if encoding == 'br' else '.gz'
+    version = hashlib.sha1(etag.encode('utf-8')).hexdigest()[:16]
+    target_path = os.path.join(COMPRESSED_DIR, f'{filename}.{version}{suffix}')
+    if not os.path.exists(target_path):
+        compress_file(filepath, target_path, encoding)
+        # Удаляем копии прежних версий этого файла
+        for name in os.listdir(COMPRESSED_DIR):
+            if name.startswith(f'{filename}.') and name.endswith(suffix) and name != os.path.basename(target_path):
+                try:
+                    os.remove(os.path.join(COMPRESSED_DIR, name))
+                except OSError:
+                    pass
+    return target_path
+
+def compress_log_segment(path):
+    """Сжимает старый сегмент лога на диске (path -> path.gz) и удаляет оригинал"""
+    compress_file(path, f'{path}.gz', 'gzip')
+    os.remove(path)
+    return f'{path}.gz'
+
+# Ротация и хранение логов. Обслуживание выполняет фоновый поток: раз в
+# LOG_MAINTENANCE_INTERVAL ротация и правила хранения, а также задания
+# выборочной очистки из очереди (запрос только ставит задание).
+ARCHIVE_NAME_RE = re.compile(r'^archive/(\d{4}-\d{2}-\d{2})/((?:device_[^/\\]+_log|all_devices)\.\d{3}\.txt(?:\.gz)?)$')
+maintenance_queue = queue.Queue()
+maintenance_jobs = OrderedDict()
+maintenance_lock = threading.Lock()
+maintenance_state = {'worker_started': False, 'next_job': 1, 'rotations': 0, 'compressed': 0, 'expired_days': 0,
+                     'expired_segments': 0}
+
+def is_active_log(filename):
+    """Текущий (неархивный) текстовый лог"""
+    return filename == os.path.basename(ALL_DEVICES_FILE) or (filename.startswith('device_') and filename.endswith('_log.txt'))
+
+def log_file_day(path):
+    """Сутки первой строки лога ('YYYY-MM-DD') или None"""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(10).decode('ascii')
+    except (OSError, UnicodeDecodeError):
+        return None
+    return head if re.match(r'^\d{4}-\d{2}-\d{2}$', head) else None
+
+def rotate_log(path, day):
+    """Переносит текущий лог в архив за сутки day; новые строки пойдут в новый файл"""
+    flush_logs()
+    with log_writer_flush_lock:
+        handle = log_writer_handles.pop(path, None)
+        if handle is not None:
+            handle.close()
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return None
+        day_dir = os.path.join(ARCHIVE_DIR, day)
+        os.makedirs(day_dir, exist_ok=True)
+        base = os.path.basename(path)[:-len('.txt')]
+        existing = [name for name in os.listdir(day_dir) if name.startswith(f'{base}.')]
+        target = os.path.join(day_dir, f'{base}.{len(existing) + 1:03d}.txt')
+        os.rename(path, target)
+    
+    filename = os.path.basename(path)
+    if filename != os.path.basename(ALL_DEVICES_FILE):
+        set_device_log_size(filename[len('device_'):-len('_log.txt')], 0)
+    with maintenance_lock:
+        maintenance_state['rotations'] += 1
+    log_event('info', f'🗂️ Лог {filename} перенесен в архив: {os.path.relpath(target, DATA_DIR)}')
+    return target
+
+def rotate_logs(today=None):
+    """Ротация текущих логов по размеру и по смене суток"""
+    today = today or get_moscow_time().strftime('%Y-%m-%d')
+    if not os.path.exists(DATA_DIR):
+        return
+    for filename in os.listdir(DATA_DIR):
+        if not is_active_log(filename):
+            continue
+        path = os.path.join(DATA_DIR, filename)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        day = log_file_day(path)
+        if size >= LOG_ROTATE_BYTES or (day is not None and day < today):
+            rotate_log(path, day or today)
+
+def apply_log_retention(today=None):
+    """Сжимает и удаляет архивные сутки по правилам хранения"""
+    today = datetime.strptime(today or get_moscow_time().strftime('%Y-%m-%d'), '%Y-%m-%d')
+    for day in sorted(os.listdir(ARCHIVE_DIR)) if os.path.exists(ARCHIVE_DIR) else []:
+        try:
+            age = (today - datetime.strptime(day, '%Y-%m-%d')).days
+        except ValueError:
+            continue
+        day_dir = os.path.join(ARCHIVE_DIR, day)
+        if LOG_RETENTION_DAYS and age > LOG_RETENTION_DAYS:
+            shutil.rmtree(day_dir, ignore_errors=True)
+            with maintenance_lock:
+                maintenance_state['expired_days'] += 1
+            log_event('info', f'🗑️ Удален архив логов за {day}')
+        elif age >= LOG_COMPRESS_AFTER_DAYS:
+            for name in os.listdir(day_dir):
+                if name.endswith('.txt'):
+                    compress_log_segment(os.path.join(day_dir, name))
+                    with maintenance_lock:
+                        maintenance_state['compressed'] += 1
+    
+    # Бинарная история и трек - по собственному сроку хранения.
+    # Сегменты, которые сейчас читаются, закрываются после последнего читателя
+    if HISTORY_RETENTION_DAYS:
+        cutoff_ms = int((today.timestamp() - HISTORY_RETENTION_DAYS * 86400) * 1000)
+        load_history_store()
+        with history_lock:
+            names = sorted(set(history_store) | set(track_store))
+        for safe_name in names:
+            dropped = drop_history_segments(safe_name, None, cutoff_ms)
+            if dropped:
+                with maintenance_lock:
+                    maintenance_state['expired_segments'] += dropped
+                log_event('info', f'🗑️ {safe_name}: удалено сегментов истории: {dropped}')
+
+def is_known_device(safe_name):
+    """Устройство есть в реестре, в истории или среди файлов данных"""
+    load_history_store()
+    with history_lock:
+        if safe_name in history_store or safe_name in track_store:
+            return True
+    return get_device_state(safe_name) is not None or \
+        os.path.exists(os.path.join(DATA_DIR, f'device_{safe_name}_log.txt'))
+
+def remove_device_data(safe_name):
+    """Удаляет все данные одного устройства: файлы, архив, историю, состояние"""
+    removed = 0
+    with get_device_lock(safe_name):
+        # Строки из очереди писателя не должны пересоздать удаленные файлы
+        flush_logs()
+        paths = [os.path.join(DATA_DIR, f'device_{safe_name}.txt'), os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')]
+        with log_writer_flush_lock:
+            for path in paths:
+                handle = log_writer_handles.pop(path, None)
+                if handle is not None:
+                    handle.close()
+        if os.path.exists(ARCHIVE_DIR):
+            for day in os.listdir(ARCHIVE_DIR):
+                day_dir = os.path.join(ARCHIVE_DIR, day)
+                paths += [os.path.join(day_dir, name) for name in os.listdir(day_dir) if name.startswith(f'device_{safe_name}_log.')]
+        if os.path.exists(COMPRESSED_DIR):
+            paths += [os.path.join(COMPRESSED_DIR, name) for name in os.listdir(COMPRESSED_DIR)
+                      if name.startswith((f'device_{safe_name}.', f'device_{safe_name}_log.'))]
+        for path in paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        clear_history_store(safe_name)
+        remove_device_state(safe_name)
+    return removed
+
+def cleanup_logs(device=None, start_ms=None, end_ms=None):
+    """Выборочная очистка: устройство целиком либо архив и история за интервал (по устройству или всем)"""
+    if device is not None and start_ms is None and end_ms is None:
+        return {'files_removed': remove_device_data(device), 'history_segments_removed': 0}
+    
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    files_removed = 0
+    if os.path.exists(ARCHIVE_DIR):
+        for day in sorted(os.listdir(ARCHIVE_DIR)):
+            try:
+                day_start = moscow_tz.localize(datetime.strptime(day, '%Y-%m-%d'))
+            except ValueError:
+                continue
+            day_start_ms = int(day_start.timestamp() * 1000)
+            # Удаляются только сутки, целиком попадающие в интервал
+            if (start_ms is not None and day_start_ms < start_ms) or (end_ms is not None and day_start_ms + 86_400_000 - 1 > end_ms):
+                continue
+            day_dir = os.path.join(ARCHIVE_DIR, day)
+            for name in os.listdir(day_dir):
+                if device is None or name.startswith(f'device_{device}_log.'):
+                    os.remove(os.path.join(day_dir, name))
+                    files_removed += 1
+            if not os.listdir(day_dir):
+                os.rmdir(day_dir)
+    
+    load_history_store()
+    with history_lock:
+        names = [device] if device is not None else list(set(history_store) | set(track_store))
+    segments_removed = sum(drop_history_segments(name, start_ms, end_ms) for name in names)
+    return {'files_removed': files_removed, 'history_segments_removed': segments_removed}
+
+def schedule_cleanup(device=None, start_ms=None, end_ms=None):
+    """Ставит задание выборочной очистки в очередь фонового потока"""
+    with maintenance_lock:
+        job_id = maintenance_state['next_job']
+        maintenance_state['next_job'] += 1
+        job = maintenance_jobs[job_id] = {
+            'id': job_id,
+            'status': 'queued',
+            'device': device,
+            'from': start_ms,
+            'to': end_ms,
+            'result': None,
+        }
+        # Храним только последние задания
+        while len(maintenance_jobs) > 50:
+            maintenance_jobs.popitem(last=False)
+    start_maintenance_worker()
+    maintenance_queue.put(job_id)
+    return dict(job)
+
+def run_cleanup_job(job_id):
+    with maintenance_lock:
+        job = maintenance_jobs.get(job_id)
+        if job is None:
+            return
+        job['status'] = 'running'
+    try:
+        result = cleanup_logs(job['device'], job['from'], job['to'])
+        status = 'done'
+    except Exception as e:
+        result = {'error': str(e)}
+        status = 'failed'
+        log_event('error', f'❌ Ошибка выборочной очистки: {e}')
+    with maintenance_lock:
+        job['status'] = status
+        job['result'] = result
+    # Состав устройств и данные могли измениться
+    mark_excel_dirty()
+    publish_stream_event('snapshot', build_devices_payload())
+    log_event('info', f"🧹 Выборочная очистка #{job_id} ({status}): {result}")
+
+def start_maintenance_worker():
+    with maintenance_lock:
+        if maintenance_state['worker_started']:
+            return
+        maintenance_state['worker_started'] = True
+    threading.Thread(target=log_maintenance_worker, name='log-maintenance', daemon=True).start()
+
+def log_maintenance_worker():
+    """Фоновый поток: задания очистки и периодическая ротация/хранение логов"""
+    next_run = time.monotonic()
+    while True:
+        try:
+            job_id = maintenance_queue.get(timeout=max(0.0, next_run - time.monotonic()))
+        except queue.Empty:
+            job_id = None
+        try:
+            if job_id is not None:
+                run_cleanup_job(job_id)
+            if time.monotonic() >= next_run:
+                next_run = time.monotonic() + LOG_MAINTENANCE_INTERVAL
+                rotate_logs()
+                apply_log_retention()
+        except Exception as e:
+            log_event('warning', f"⚠️ Ошибка обслуживания логов: {e}")
+
+def list_log_files():
+    """Текущие и архивные логи для /api/logs"""
+    active = []
+    if os.path.exists(DATA_DIR):
+        for filename in sorted(os.listdir(DATA_DIR)):
+            if is_active_log(filename):
+                active.append({'file': filename, 'size': os.path.getsize(os.path.join(DATA_DIR, filename)),
+                               'url': f'/download/{quote(filename)}'})
+    archive = []
+    if os.path.exists(ARCHIVE_DIR):
+        for day in sorted(os.listdir(ARCHIVE_DIR)):
+            day_dir = os.path.join(ARCHIVE_DIR, day)
+            for name in sorted(os.listdir(day_dir)):
+                archive.append({'day': day, 'file': name, 'size': os.path.getsize(os.path.join(day_dir, name)),
+                                'compressed': name.endswith('.gz'), 'url': f'/download/archive/{day}/{quote(name)}'})
+    return active, archive
+
+def content_disposition(filename):
+    """Заголовок Content-Disposition с поддержкой не-ASCII имен (RFC 6266)"""
+    ascii_name = filename.encode('ascii', 'replace').decode('ascii').replace('"', '')
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+# Статистика соединений: сколько запросов обслужено на повторно используемых соединениях
+connection_stats = {'connections': 0, 'requests': 0, 'reused_requests': 0, 'saturated_closes': 0}
+connection_stats_lock = threading.Lock()
+
+# Выставляется при остановке автономного сервера - долгие соединения (SSE) завершаются
+server_shutdown_event = threading.Event()
+
+# Подписчики SSE потока /api/stream: у каждого своя очередь готовых событий
+stream_subscribers = set()
+stream_subscribers_lock = threading.Lock()
+
+def parse_since_token(value):
+    """Токен версии '<epoch>:<version>' из ответа /api/data -> (epoch, version)"""
+    epoch, separator, version = value.partition(':')
+    if not separator:
+        raise ValueError(f'Некорректный токен версии: {value!r}')
+    return int(epoch), int(version)
+
+def build_devices_payload(now=None, since=None):
+    """Формирует данные устройств (как в /api/data); since - только изменения после (epoch, version)"""
+    if now is None:
+        now = time.monotonic()
+    # Версию читаем до снимка: клиент может получить изменение дважды, но не потеряет его
+    version, reset_version = get_data_version()
+    epoch = devices_registry_state['epoch']
+    entries = get_devices_snapshot()
+    # Токен другого запуска процесса, после очистки или из будущей версии - дельта невозможна, отдаем все
+    full = since is None or since[0] != epoch or since[1] < reset_version or since[1] > version
+    if not full:
+        entries = [entry for entry in entries if entry['version'] > since[1]]
+    devices_data = [describe_device(entry, now) for entry in entries]
+    return {
+        'timestamp': get_moscow_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'version': f'{epoch}:{version}',
+        'full': full,
+        'devices': devices_data,
+        'devices_count': len(devices_data)
+    }
+
+def get_data_etag():
+    """ETag текущей версии данных"""
+    version, _ = get_data_version()
+    return f'W/"{devices_registry_state["epoch"]}-{version}"'
+
+def format_sse_event(event, data):
+    """Кодирует событие в формате Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+def publish_stream_event(event, data):
+    """Рассылает событие всем подписчикам (сериализация выполняется один раз)"""
+    with stream_subscribers_lock:
+        if not stream_subscribers:
+            return
+        subscribers = list(stream_subscribers)
+    message = format_sse_event(event, data)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            # Медленный клиент - отключаем, браузер переподключится и получит снимок
+            unsubscribe_stream(subscriber)
+
+def publish_device_update(entry, now=None):
+    """Рассылает изменившуюся запись устройства"""
+    publish_stream_event('device', {
+        'timestamp': get_moscow_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'device': describe_device(entry, now),
+    })
+
+def subscribe_stream():
+    """Регистрирует нового подписчика SSE потока"""
+    subscriber = queue.Queue(maxsize=256)
+    with stream_subscribers_lock:
+        stream_subscribers.add(subscriber)
+    return subscriber
+
+def unsubscribe_stream(subscriber):
+    """Удаляет подписчика SSE потока"""
+    with stream_subscribers_lock:
+        stream_subscribers.discard(subscriber)
+        # Пустое сообщение будит обработчик, чтобы он закрыл соединение.
+        # В полной очереди освобождаем место: без него обработчик медленного
+        # клиента продолжал бы отправлять устаревшие события до конца срока
+        while True:
+            try:
+                subscriber.put_nowait(None)
+                break
+            except queue.Full:
+                try:
+                    subscriber.get_nowait()
+                except queue.Empty:
+                    pass
+
+def format_metrics():
+    """Метрики процесса в текстовом формате Prometheus"""
+    now = time.monotonic()
+    devices = get_devices_snapshot()
+    with stream_subscribers_lock:
+        subscribers = len(stream_subscribers)
+    with connection_stats_lock:
+        connections = dict(connection_stats)
+    
+    lines = []
+    def header(name, kind, help_text):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+    
+    with metrics_lock:
+        header('speed_http_requests_total', 'counter', 'HTTP запросы по обработчику, методу и статусу')
+        for (handler_name, method, status), count in sorted(metrics_state['requests'].items()):
+            lines.append(f'speed_http_requests_total{metric_labels(handler=handler_name, method=method, status=status)} {count}')
+        header('speed_http_request_duration_seconds', 'histogram', 'Длительность обработки запроса')
+        for handler_name, histogram in sorted(metrics_state['latency'].items()):
+            format_histogram(lines, 'speed_http_request_duration_seconds', histogram, {'handler': handler_name})
+        header('speed_http_request_bytes_total', 'counter', 'Получено байт в телах запросов')
+        for handler_name, count in sorted(metrics_state['bytes_in'].items()):
+            lines.append(f'speed_http_request_bytes_total{metric_labels(handler=handler_name)} {count}')
+        header('speed_http_response_bytes_total', 'counter', 'Отправлено байт ответов (с заголовками)')
+        for handler_name, count in sorted(metrics_state['bytes_out'].items()):
+            lines.append(f'speed_http_response_bytes_total{metric_labels(handler=handler_name)} {count}')
         
-        # Проверяем, существует ли файл
-        if os.path.exists(excel_file):
-            from openpyxl import load_workbook
-            wb = load_workbook(excel_file)
-            ws = wb.active
+        header('speed_excel_rebuild_duration_seconds', 'histogram', 'Длительность сборки Excel файла')
+        format_histogram(lines, 'speed_excel_rebuild_duration_seconds', metrics_state['excel_rebuild'] or new_histogram(), {})
+        header('speed_registry_files_scanned_total', 'counter', 'Файлы device_*.txt, прочитанные при восстановлении реестра')
+        lines.append(f"speed_registry_files_scanned_total {metrics_state['registry_files_scanned']}")
+        header('speed_inactive_checks_total', 'counter', 'Записи индекса устаревания, проверенные при поиске неактивных устройств')
+        lines.append(f"speed_inactive_checks_total {metrics_state['inactive_checks']}")
+        header('speed_device_samples_total', 'counter', 'Принятые сэмплы скорости по устройствам')
+        for safe_name, count in sorted(metrics_state['device_samples'].items()):
+            lines.append(f'speed_device_samples_total{metric_labels(device=safe_name)} {count}')
+    
+    header('speed_device_last_seen_age_seconds', 'gauge', 'Время с последних данных устройства')
+    for entry in devices:
+        if entry['last_seen']:
+            lines.append(f"speed_device_last_seen_age_seconds{metric_labels(device=entry['safe_name'])} {now - entry['last_seen']:.3f}")
+    active = sum(1 for entry in devices if now - entry['last_seen'] <= DEVICE_INACTIVE_TIMEOUT)
+    header('speed_devices', 'gauge', 'Устройства в реестре по состоянию')
+    lines.append(f'speed_devices{metric_labels(state="active")} {active}')
+    lines.append(f'speed_devices{metric_labels(state="inactive")} {len(devices) - active}')
+    
+    header('speed_stream_subscribers', 'gauge', 'Открытые SSE потоки /api/stream')
+    lines.append(f'speed_stream_subscribers {subscribers}')
+    header('speed_connections_total', 'counter', 'Принятые TCP соединения')
+    lines.append(f"speed_connections_total {connections['connections']}")
+    header('speed_connection_reused_requests_total', 'counter', 'Запросы на повторно использованных соединениях')
+    lines.append(f"speed_connection_reused_requests_total {connections['reused_requests']}")
+    header('speed_connection_saturated_closes_total', 'counter', 'Соединения, закрытые после ответа из-за занятого пула потоков')
+    lines.append(f"speed_connection_saturated_closes_total {connections['saturated_closes']}")
+    header('speed_excel_rebuilds_skipped_total', 'counter', 'Изменения, вошедшие в уже запланированную сборку Excel')
+    lines.append(f"speed_excel_rebuilds_skipped_total {excel_export_stats['skipped']}")
+    header('speed_log_flushes_total', 'counter', 'Сбросы очереди писателя логов')
+    lines.append(f"speed_log_flushes_total {log_writer_stats['flushes']}")
+    header('speed_log_fsyncs_total', 'counter', 'Вызовы fsync писателем логов')
+    lines.append(f"speed_log_fsyncs_total {log_writer_stats['fsyncs']}")
+    header('speed_log_pending_bytes', 'gauge', 'Строки логов, ожидающие записи')
+    lines.append(f"speed_log_pending_bytes {log_writer_stats['pending_bytes']}")
+    return '\n'.join(lines) + '\n'
+
+def parse_sample_time(value):
+    """Время сэмпла: epoch в секундах/миллисекундах или 'YYYY-MM-DD HH:MM:SS' (МСК)"""
+    moscow_tz = pytz.timezone('Europe/Moscow')
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            return moscow_tz.localize(datetime.strptime(value, '%Y-%m-%d %H:%M:%S'))
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'Некорректное время сэмпла: {value!r}')
+    if value > 1e11:
+        value /= 1000
+    return datetime.fromtimestamp(value, moscow_tz)
+
+def parse_time_param(value):
+    """Время из параметра запроса (epoch с/мс или 'YYYY-MM-DD HH:MM:SS' МСК) в epoch ms"""
+    return int(parse_sample_time(value).timestamp() * 1000)
+
+def parse_sample_row(row, default_time=None):
+    """Сэмпл из массива [time, speed, lat, lon, accuracy, heading] или объекта с теми же полями"""
+    if isinstance(row, dict):
+        row = [row.get('t', row.get('time', default_time)), row.get('speed'),
+               row.get('lat'), row.get('lon'), row.get('accuracy'), row.get('heading')]
+    if not isinstance(row, (list, tuple)) or len(row) < 2 or row[1] is None:
+        raise ValueError(f'Некорректный сэмпл: {row!r}')
+    
+    speed = str(row[1]).strip()
+    # nan/inf ломают сортировку рейтинга и JSON ответов
+    if not math.isfinite(float(speed)):
+        raise ValueError(f'Некорректная скорость: {speed!r}')
+    extra = [float(value) if value not in (None, '') else None for value in list(row[2:6])]
+    if any(value is not None and not math.isfinite(value) for value in extra):
+        raise ValueError(f'Некорректный сэмпл: {row!r}')
+    extra += [None] * (4 - len(extra))
+    lat, lon, accuracy, heading = extra
+    if (lat is None) != (lon is None) or (lat is not None and not (-90 <= lat <= 90 and -180 <= lon <= 180)):
+        raise ValueError(f'Некорректные координаты: {lat!r}, {lon!r}')
+    return {
+        'time': row[0] if isinstance(row[0], datetime) else parse_sample_time(row[0]),
+        'speed': speed,
+        'lat': lat,
+        'lon': lon,
+        'accuracy': accuracy,
+        'heading': heading,
+    }
+
+def parse_batch_samples(body, content_type=''):
+    """Разбирает пакет сэмплов (device_time, speed[, lat, lon, accuracy, heading])
+
+    Принимает JSON массив (или {"samples": [...]}) из массивов либо объектов,
+    а также текст - по одному сэмплу в строке, поля через запятую.
+    """
+    text = body.decode('utf-8').strip()
+    if 'json' in content_type or text.startswith(('[', '{')):
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get('samples')
+        if not isinstance(rows, list):
+            raise ValueError('Ожидается массив сэмплов')
+    else:
+        rows = [re.split(r'[,;\t]', line) for line in text.splitlines() if line.strip()]
+    
+    return [parse_sample_row(row) for row in rows]
+
+def ingest_samples(device_name, safe_name, client_ip, samples):
+    """Сохраняет сэмплы устройства: одна запись в каждый лог и одно обновление состояния"""
+    samples = sorted(samples, key=lambda sample: sample['time'])
+    lines = [(sample['time'].strftime('%Y-%m-%d %H:%M:%S'), sample['speed']) for sample in samples]
+    speed_data = lines[-1][1]
+    timestamp = lines[-1][0]
+    
+    device_file = os.path.join(DATA_DIR, f'device_{safe_name}.txt')
+    device_log_file = os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')
+    log_chunk = ''.join(f'{line_time} - {speed} км/ч\n' for line_time, speed in lines)
+    all_devices_chunk = ''.join(f'{line_time} - {device_name} ({client_ip}) - {speed} км/ч\n' for line_time, speed in lines)
+    
+    # Числовые скорости дополнительно пишутся в бинарную историю, координаты - в трек
+    records = []
+    fixes = []
+    for sample in samples:
+        epoch_ms = int(sample['time'].timestamp() * 1000)
+        if sample.get('lat') is not None:
+            fixes.append((epoch_ms, sample['lat'], sample['lon'],
+                          sample['heading'] if sample.get('heading') is not None else math.nan,
+                          sample['accuracy'] if sample.get('accuracy') is not None else math.nan))
+        try:
+            speed = float(sample['speed'])
+        except ValueError:
+            continue
+        # Текстовое тело POST не проверяется - nan/inf в историю не попадают
+        if math.isfinite(speed):
+            records.append((epoch_ms, speed))
+    
+    # Чтение текущего состояния, запись и обновление реестра выполняются под
+    # блокировкой устройства: параллельные запросы одной лодки не перемешиваются,
+    # запросы разных лодок не ждут друг друга
+    with get_device_lock(safe_name):
+        # Досылка старых сэмплов не должна затирать более свежие текущие данные
+        current = get_device_state(safe_name)
+        if current is not None and current['timestamp'][:1].isdigit() and current['timestamp'] > timestamp:
+            speed_data = current['speed']
+            timestamp = current['timestamp']
+            device_content = None
         else:
-            # Создаем новый файл
-            wb = Workbook()
-            ws = wb.active
-            ws.title = "GPS Speed Data"
-            
-            # Заголовки
-            headers = ["Устройство", "Скорость (км/ч)", "Время"]
-            for col, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col, value=header)
-                cell.font = Font(bold=True, color="FFFFFF")
-                cell.fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-                cell.alignment = Alignment(horizontal="center")
-            
-            # Настройка ширины колонок
-            ws.column_dimensions['A'].width = 20
-            ws.column_dimensions['B'].width = 15
-            ws.column_dimensions['C'].width = 12
+            # Сохраняем данные с временной меткой
+            device_content = f"{speed_data}\n{timestamp}"
+        
+        # Статистика берется до записи истории: при восстановлении из истории
+        # новые сэмплы не должны учитываться дважды. Пока статистика
+        # пересчитывается, эти записи пересчет дочитает из истории
+        stats = get_device_stats(safe_name)
+        if stats is not None:
+            for epoch_ms, speed in records:
+                update_device_stats(stats, epoch_ms, speed)
+        # Буфер последних сэмплов загружается с диска до записи новых строк
+        add_recent_samples(get_recent_buffer(safe_name), records)
+        
+        # Все файлы пишутся общим писателем логов одной пачкой
+        write_logs({
+            device_log_file: log_chunk,
+            ALL_DEVICES_FILE: all_devices_chunk,
+        }, {device_file: device_content} if device_content is not None else None)
         
-        # Получаем все файлы устройств
-        device_files = []
-        if os.path.exists(DATA_DIR):
-            device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
+        try:
+            append_history(safe_name, records)
+            append_track(safe_name, fixes)
+        except Exception as e:
+            log_event('error', f"❌ Ошибка записи истории {safe_name}: {e}")
         
-        # Очищаем старые данные (кроме заголовков)
-        if ws.max_row > 1:
-            for row in range(ws.max_row, 1, -1):
-                ws.delete_rows(row)
+        # Обновляем состояние устройства в памяти и рассылаем его подписчикам
+        file_size = len(device_content.encode('utf-8')) if device_content is not None else current['file_size']
+        entry = update_device_state(safe_name, speed_data, timestamp, client_ip,
+                                    file_size, len(log_chunk.encode('utf-8')),
+                                    summarize_device_stats(stats) if stats is not None else None,
+                                    samples[-1]['time'].timestamp())
+        publish_device_update(entry)
+    
+    count_metric('device_samples', len(samples), key=safe_name)
+    
+    # Excel пересобирается фоновым экспортером
+    mark_excel_dirty()
+    return entry
+
+# Статическая оболочка страницы мониторинга: CSS и JavaScript собираются один
+# раз при импорте и отдаются по адресам с хэшем содержимого (долгое кэширование).
+# Данные устройств страница получает только через /api/stream и /api/data.
+DASHBOARD_CSS = '''body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; margin: 0; padding: 20px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }
+.container { max-width: 1200px; margin: 0 auto; background: white; border-radius: 12px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); overflow: hidden; }
+.header { background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; }
+.content { padding: 30px; }
+.status { text-align: center; color: #6c757d; margin-bottom: 20px; }
+.device-card { background: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-bottom: 15px; }
+.device-name { font-size: 1.2em; font-weight: bold; margin-bottom: 10px; }
+.device-status { font-weight: bold; margin-bottom: 10px; }
+.device-speed { font-size: 2em; font-weight: bold; color: #28a745; margin: 10px 0; }
+.device-timestamp { font-size: 0.9em; color: #6c757d; margin: 5px 0; }
+.device-links { margin-top: 15px; display: flex; gap: 10px; flex-wrap: wrap; }
+.device-links a { color: #007bff; text-decoration: none; padding: 8px 12px; background: #e3f2fd; border-radius: 5px; font-size: 0.9em; }
+.copy-section { margin-top: 15px; padding: 10px; background: #fff; border: 1px solid #dee2e6; border-radius: 5px; }
+.copy-buttons { display: flex; gap: 8px; flex-wrap: wrap; }
+.copy-btn { background: #007bff; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 0.8em; }
+.loading { text-align: center; color: #6c757d; font-style: italic; padding: 20px; }
+'''
+
+DASHBOARD_JS = '''// Переменные для хранения данных
+let devicesData = [];
+let updateInterval;
+
+// Функция для загрузки данных с сервера
+async function loadDevicesData() {
+    try {
+        const response = await fetch('/api/data');
+        if (!response.ok) throw new Error('Network response was not ok');
         
-        # Заполняем данными
-        row = 2
-        current_time = get_moscow_time()
+        const data = await response.json();
+        devicesData = data.devices;
+        updateDevicesDisplay(data);
+    } catch (error) {
+        console.error('Ошибка загрузки данных:', error);
+        document.getElementById('devices-container').innerHTML = 
+            '<div class="loading">❌ Ошибка загрузки данных. Проверьте подключение к серверу.</div>';
+    }
+}
+
+// Функция для обновления отображения устройств
+function updateDevicesDisplay(data) {
+    const container = document.getElementById('devices-container');
+    const timestampElement = document.getElementById('timestamp');
+    
+    // Обновляем временную метку
+    if (timestampElement) {
+        timestampElement.textContent = `Обновлено: ${data.timestamp} (МСК)`;
+    }
+    
+    if (!data.devices || data.devices.length === 0) {
+        container.innerHTML = '<div class="loading">Нет данных от устройств. Подключите Android приложения.</div>';
+        return;
+    }
+    
+    // Генерируем HTML для устройств
+    let devicesHtml = '';
+    data.devices.forEach(device => {
+        devicesHtml += `
+            <div class="device-card">
+                <div class="device-name">📱 Устройство: ${device.name}</div>
+                <div class="device-status" style="color: ${device.status_color};">${device.status_text}</div>
+                <div class="device-speed">${device.speed}</div>
+                <div class="device-timestamp">⏰ Последние данные: ${device.timestamp} (МСК)</div>
+                ${device.stats && device.stats.samples ? `<div class="device-timestamp">📈 Макс: ${device.stats.max_speed} км/ч · Средняя: ${device.stats.avg_speed} км/ч · 10 с: ${device.stats.avg_10s ?? '—'} · 1 мин: ${device.stats.avg_60s ?? '—'} · Дистанция: ${device.stats.distance_km} км</div>` : ''}
+                <div class="device-links">
+                    <a href="/download/device_${device.safe_name}.txt">📄 Текущая скорость</a>
+                    <a href="/download/device_${device.safe_name}_log.txt">📊 История</a>
+                    <a href="/download/gps_speed_data.xlsx">📊 Excel</a>
+                </div>
+                <div class="copy-section">
+                    <div style="font-size: 0.9em; color: #495057; margin-bottom: 8px;">📋 Копировать ссылки:</div>
+                    <div class="copy-buttons">
+                        <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_${device.safe_name}.txt')">
+                            📄 Скопировать ссылку на скорость
+                        </button>
+                        <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_${device.safe_name}_log.txt')">
+                            📊 Скопировать ссылку на историю
+                        </button>
+                        <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/gps_speed_data.xlsx')">
+                            📊 Скопировать ссылку на Excel
+                        </button>
+                    </div>
+                </div>
+            </div>
+        `;
+    });
+    
+    container.innerHTML = devicesHtml;
+    
+    // Обновляем размеры файлов в секции прямых ссылок
+    data.devices.forEach(device => {
+        const sizes = document.getElementById(`sizes-${device.safe_name}`);
+        if (sizes) {
+            sizes.textContent = `Размеры: скорость ${device.file_size} байт, история ${device.log_size} байт`;
+        }
+    });
+}
+
+// Функция для копирования в буфер обмена
+function copyToClipboard(text) {
+    navigator.clipboard.writeText(text).then(function() {
+        // Показываем уведомление об успешном копировании
+        const notification = document.createElement('div');
+        notification.style.cssText = `
+            position: fixed;
+            top: 20px;
+            right: 20px;
+            background: #28a745;
+            color: white;
+            padding: 12px 20px;
+            border-radius: 5px;
+            font-size: 14px;
+            z-index: 1000;
+            box-shadow: 0 4px 8px rgba(0,0,0,0.2);
+        `;
+        notification.textContent = '✅ Ссылка скопирована в буфер обмена!';
+        document.body.appendChild(notification);
         
-        for filename in sorted(device_files):
-            device_name = filename.replace('device_', '').replace('.txt', '').replace('_', ' ')
-            filepath = os.path.join(DATA_DIR, filename)
+        // Удаляем уведомление через 3 секунды
+        setTimeout(() => {
+            document.body.removeChild(notification);
+        }, 3000);
+    }).catch(function(err) {
+        console.error('Ошибка копирования: ', err);
+        // Fallback для старых браузеров
+        const textArea = document.createElement('textarea');
+        textArea.value = text;
+        document.body.appendChild(textArea);
+        textArea.select();
+        try {
+            document.execCommand('copy');
+            alert('Ссылка скопирована в буфер обмена!');
+        } catch (err) {
+            alert('Не удалось скопировать ссылку. Скопируйте вручную: ' + text);
+        }
+        document.body.removeChild(textArea);
+    });
+}
+
+// Резервный режим: опрос /api/data каждую секунду
+function startPolling() {
+    if (updateInterval) return;
+    loadDevicesData();
+    updateInterval = setInterval(loadDevicesData, 1000);
+}
+
+// Подписка на поток изменений устройств (Server-Sent Events)
+function startStream() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+    
+    const source = new EventSource('/api/stream');
+    let opened = false;
+    
+    source.addEventListener('open', function() {
+        opened = true;
+    });
+    
+    // Полный снимок при подключении
+    source.addEventListener('snapshot', function(event) {
+        const data = JSON.parse(event.data);
+        devicesData = data.devices;
+        updateDevicesDisplay(data);
+    });
+    
+    // Изменение одного устройства
+    source.addEventListener('device', function(event) {
+        const data = JSON.parse(event.data);
+        const index = devicesData.findIndex(d => d.safe_name === data.device.safe_name);
+        if (index >= 0) {
+            devicesData[index] = data.device;
+        } else {
+            devicesData.push(data.device);
+            devicesData.sort((a, b) => a.safe_name < b.safe_name ? -1 : (a.safe_name > b.safe_name ? 1 : 0));
+        }
+        updateDevicesDisplay({ timestamp: data.timestamp, devices: devicesData });
+    });
+    
+    source.addEventListener('error', function() {
+        // Сервер периодически закрывает поток, и браузер переподключается сам.
+        // Если поток так и не открылся - переходим на опрос.
+        if (!opened || source.readyState === EventSource.CLOSED) {
+            source.close();
+            startPolling();
+        }
+        opened = false;
+    });
+}
+
+// Инициализация при загрузке страницы
+document.addEventListener('DOMContentLoaded', function() {
+    startStream();
+});
+
+// Очистка интервала при закрытии страницы
+window.addEventListener('beforeunload', function() {
+    if (updateInterval) {
+        clearInterval(updateInterval);
+    }
+});
+'''
+
+DASHBOARD_ASSET_HASH = hashlib.sha1((DASHBOARD_CSS + DASHBOARD_JS).encode('utf-8')).hexdigest()[:12]
+DASHBOARD_ASSETS = {
+    f'/static/dashboard.{DASHBOARD_ASSET_HASH}.css': ('text/css; charset=utf-8', DASHBOARD_CSS.encode('utf-8')),
+    f'/static/dashboard.{DASHBOARD_ASSET_HASH}.js': ('application/javascript; charset=utf-8', DASHBOARD_JS.encode('utf-8')),
+}
+
+DASHBOARD_PAGE_HEAD = '''<!DOCTYPE html>
+<html>
+<head>
+    <title>⛵ 69F СКОРОСТЬ</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <link rel="stylesheet" href="/static/dashboard.''' + DASHBOARD_ASSET_HASH + '''.css">
+    <script src="/static/dashboard.''' + DASHBOARD_ASSET_HASH + '''.js"></script>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>⛵ 69F СКОРОСТЬ</h1>
+            <p>Отслеживание скорости всех устройств</p>
+            <div style="margin-top: 15px;">
+                <a href="/cleanup" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">🧹 Очистить старые данные</a>
+                <a href="/restart_tracking" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">🔄 Перезапустить Tracking</a>
+                <a href="/download/all_devices.txt" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">📥 Скачать все данные</a>
+                <a href="/download/GPS-Speed-69F-v3.0-With-Remote-Restart.apk" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em;">📱 Скачать APK</a>
+            </div>
+        </div>
+        <div class="content">
+            <div class="status" id="timestamp">Обновлено: — (МСК)</div>
+            <div id="devices-container">
+                <div class="loading">Загрузка данных...</div>
+            </div>
             
-            try:
-                with open(filepath, 'r') as f:
-                    content = f.read().strip()
-                
-                lines = content.split('\n')
-                if len(lines) >= 2:
-                    speed = lines[0]
-                    timestamp_str = lines[1]
+            <div style="background: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-top: 30px;">
+                <h2>📁 Прямые ссылки на файлы</h2>
+                <div style="background: white; padding: 20px; border-radius: 8px;">
                     
-                    # Проверяем, не устарели ли данные (больше 10 секунд)
-                    try:
-                        data_time = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                        data_time = pytz.timezone('Europe/Moscow').localize(data_time)
-                        time_diff = (current_time - data_time).total_seconds()
-                        
-                        if time_diff > 10:
-                            # Устройство не трекается - ставим прочерки
-                            ws.cell(row=row, column=1, value=device_name)
-                            ws.cell(row=row, column=2, value="—")
-                            ws.cell(row=row, column=3, value="—")
-                        else:
-                            # Устройство активно - записываем данные
-                            try:
-                                dt = datetime.strptime(timestamp_str, '%Y-%m-%d %H:%M:%S')
-                                time_only = dt.strftime('%H:%M:%S')
-                            except:
-                                time_only = timestamp_str
-                            
-                            ws.cell(row=row, column=1, value=device_name)
-                            ws.cell(row=row, column=2, value=float(speed) if speed.replace('.', '').isdigit() else speed)
-                            ws.cell(row=row, column=3, value=time_only)
-                    except:
-                        # Если не можем распарсить время - ставим прочерки
-                        ws.cell(row=row, column=1, value=device_name)
-                        ws.cell(row=row, column=2, value="—")
-                        ws.cell(row=row, column=3, value="—")
+                    <!-- APK файл -->
+                    <div style="margin-bottom: 25px; padding: 15px; background: #e3f2fd; border-radius: 8px; border-left: 4px solid #2196f3;">
+                        <h3 style="margin: 0 0 10px 0; color: #1976d2;">📱 Android приложение</h3>
+                        <a href="/download/GPS-Speed-69F-v3.0-With-Remote-Restart.apk" 
+                           style="display: inline-block; background: #2196f3; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
+                            📥 Скачать APK
+                        </a>
+                    </div>
                     
-                    row += 1
+                    <!-- Общий лог -->
+                    <div style="margin-bottom: 25px; padding: 15px; background: #f3e5f5; border-radius: 8px; border-left: 4px solid #9c27b0;">
+                        <h3 style="margin: 0 0 10px 0; color: #7b1fa2;">📋 Общий лог всех устройств</h3>
+                        <a href="/download/all_devices.txt" 
+                           style="display: inline-block; background: #9c27b0; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
+                            📥 Скачать лог
+                        </a>
+                    </div>
                     
-            except Exception as e:
-                print(f"Ошибка обработки файла {filename}: {e}")
-                # Если файл поврежден - все равно добавляем устройство с прочерками
-                ws.cell(row=row, column=1, value=device_name)
-                ws.cell(row=row, column=2, value="—")
-                ws.cell(row=row, column=3, value="—")
-                row += 1
-                continue
-        
-        # Сохраняем файл
-        wb.save(excel_file)
-        
-        print(f"✅ Excel файл обновлен: {excel_file}")
-        return excel_file
-        
+                    <!-- Файлы устройств -->
+                    <div style="margin-bottom: 20px;">
+                        <h3 style="margin: 0 0 15px 0; color: #2e7d32;">📊 Файлы отдельных устройств</h3>
+'''
+
+DASHBOARD_PAGE_TAIL = '''                    </div>
+                    
+                    <!-- Excel файл -->
+                    <div style="margin-bottom: 25px; padding: 15px; background: #e8f5e8; border-radius: 8px; border-left: 4px solid #4caf50;">
+                        <h3 style="margin: 0 0 10px 0; color: #2e7d32;">📊 Excel отчет</h3>
+                        <a href="/download/gps_speed_data.xlsx" 
+                           style="display: inline-block; background: #4caf50; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
+                            📊 Скачать Excel файл
+                        </a>
+                    </div>
+                    
+                    <!-- Служебные файлы -->
+                    <div style="margin-top: 25px; padding: 15px; background: #fff3e0; border-radius: 8px; border-left: 4px solid #ff9800;">
+                        <h3 style="margin: 0 0 10px 0; color: #f57c00;">🔧 Служебные файлы</h3>
+                        <div style="margin: 10px 0;">
+                            <a href="/download/restart_signal.txt" 
+                               style="display: inline-block; background: #ff9800; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px; margin-bottom: 5px;">
+                                🔄 Файл-сигнал перезапуска
+                            </a>
+                            <span style="color: #666; font-size: 0.9em;">Для удаленного перезапуска tracking</span>
+                        </div>
+                    </div>
+                    
+                </div>
+            </div>
+        </div>
+    </div>
+</body>
+</html>'''
+
+# Готовая страница пересобирается только при изменении состава устройств
+dashboard_page_cache = {'key': None, 'body': None, 'etag': None}
+dashboard_page_lock = threading.Lock()
+
+# Фрагменты ссылок на файлы по устройствам (размеры подставляет JavaScript)
+device_links_fragments = {}
+
+def get_device_link_fragment(entry):
+    """HTML блок ссылок на файлы одного устройства (кэшируется)"""
+    fragment = device_links_fragments.get(entry['safe_name'])
+    if fragment is None:
+        device_name = escape(entry['name'])
+        safe_name = escape(entry['safe_name'])
+        fragment = f'''
+                <div style="margin-bottom: 20px; padding: 15px; background: #f8f9fa; border-radius: 8px; border-left: 4px solid #4caf50;">
+                    <h4 style="margin: 0 0 10px 0; color: #2e7d32;">🚤 {device_name}</h4>
+                    <div style="display: flex; gap: 10px; flex-wrap: wrap;">
+                        <a href="/download/device_{safe_name}.txt" 
+                           style="display: inline-block; background: #4caf50; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
+                            📄 Текущая скорость
+                        </a>
+                        <a href="/download/device_{safe_name}_log.txt" 
+                           style="display: inline-block; background: #8bc34a; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
+                            📊 История данных
+                        </a>
+                        <a href="/download/gps_speed_data.xlsx" 
+                           style="display: inline-block; background: #9c27b0; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
+                            📊 Excel файл
+                        </a>
+                    </div>
+                    <div id="sizes-{safe_name}" style="margin-top: 8px; color: #666; font-size: 0.8em;">
+                        Размеры: скорость — байт, история — байт
+                    </div>
+                </div>
+                '''
+        device_links_fragments[entry['safe_name']] = fragment
+    return fragment
+
+def get_device_links_html():
+    """Генерирует HTML со ссылками на файлы устройств из кэшированных фрагментов"""
+    try:
+        devices = get_devices_snapshot()
+
+        if not devices:
+            return '<div style="color: #6c757d; font-style: italic; padding: 20px; text-align: center; background: #f8f9fa; border-radius: 5px;">Нет файлов устройств</div>'
+
+        return ''.join(get_device_link_fragment(entry) for entry in devices)
     except Exception as e:
-        print(f"❌ Ошибка создания Excel файла: {e}")
-        return None
+        return f'<div style="color: #dc3545; padding: 15px; background: #f8d7da; border-radius: 5px;">Ошибка: {escape(str(e))}</div>'
+
+def get_dashboard_page():
+    """Страница мониторинга и ее ETag; пересборка только при изменении списка устройств"""
+    load_devices_registry()
+    key = (devices_registry_state['epoch'], devices_registry_state['devices_version'])
+    with dashboard_page_lock:
+        if dashboard_page_cache['key'] != key:
+            body = DASHBOARD_PAGE_HEAD + get_device_links_html() + '\n' + DASHBOARD_PAGE_TAIL
+            dashboard_page_cache['body'] = body.encode('utf-8')
+            dashboard_page_cache['etag'] = f'"{DASHBOARD_ASSET_HASH}-{key[0]}-{key[1]}"'
+            dashboard_page_cache['key'] = key
+        return dashboard_page_cache['body'], dashboard_page_cache['etag']
 
 class handler(BaseHTTPRequestHandler):
-    def do_POST(self):
-        # Получаем IP клиента
+    # HTTP/1.1: соединения остаются открытыми между запросами устройств,
+    # поэтому каждый ответ обязан содержать Content-Length
+    protocol_version = 'HTTP/1.1'
+    # Таймаут сокета - закрываем простаивающие соединения
+    timeout = KEEPALIVE_TIMEOUT
+
+    def get_client_ip(self):
+        """IP клиента с учетом прокси Vercel"""
         client_ip = self.headers.get('X-Forwarded-For', 'unknown').split(',')[0].strip()
         if client_ip == 'unknown':
             client_ip = self.headers.get('X-Real-IP', 'unknown')
-        
-        # Получаем название устройства
+        if client_ip == 'unknown' and self.client_address:
+            # Автономный режим без прокси - берем адрес соединения
+            client_ip = self.client_address[0]
+        return client_ip
+
+    def get_device_identity(self):
+        """Название устройства, безопасное имя для файлов и IP клиента"""
+        client_ip = self.get_client_ip()
         device_name = self.headers.get('X-Device-Name', client_ip)
-        safe_name = device_name.replace('.', '_').replace(':', '_').replace(' ', '_')
-        device_file = os.path.join(DATA_DIR, f'device_{safe_name}.txt')
-        device_log_file = os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')
+        safe_name = make_safe_name(device_name)
+        return device_name, safe_name, client_ip
+
+    def read_body(self):
+        """Читает тело запроса по Content-Length"""
+        content_length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(content_length)
+
+    # Таблицы маршрутов: путь без query string -> метод обработчика
+    GET_ROUTES = {
+        '/': 'handle_dashboard',
+        '/cleanup': 'handle_cleanup',
+        '/restart_tracking': 'handle_restart_tracking',
+        '/create_excel': 'handle_create_excel',
+        '/api/data': 'handle_api_data',
+        '/api/stream': 'handle_api_stream',
+        '/api/excel_status': 'handle_excel_status',
+        '/api/stats': 'handle_stats',
+        '/metrics': 'handle_metrics',
+        '/api/analytics': 'handle_api_analytics',
+        '/api/logs': 'handle_api_logs',
+        '/api/leaderboard': 'handle_api_leaderboard',
+        '/api/nearby': 'handle_api_nearby',
+        '/api/track': 'handle_api_track',
+    }
+    GET_PREFIX_ROUTES = [
+        ('/download/', 'handle_file_download'),
+        ('/static/', 'handle_static_asset'),
+        ('/api/history/', 'handle_api_history'),
+        ('/api/recent/', 'handle_api_recent'),
+    ]
+    POST_ROUTES = {
+        '/api/batch': 'handle_batch',
+    }
+
+    def setup(self):
+        super().setup()
+        # Заголовки и тело уходят отдельными записями: без TCP_NODELAY на
+        # keep-alive соединении тело ждет подтверждения заголовков (Nagle + delayed ACK)
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (AttributeError, OSError):
+            pass
+        # Отправленные байты учитываются в метриках
+        self.wfile = CountingWriter(self.wfile)
+
+    def handle(self):
+        """Обрабатывает запросы одного соединения (keep-alive)"""
+        self.requests_on_connection = 0
+        with connection_stats_lock:
+            connection_stats['connections'] += 1
+        super().handle()
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.response_status = code
+        
+        # Учет повторного использования соединения и лимит запросов на соединение
+        self.requests_on_connection = getattr(self, 'requests_on_connection', 0) + 1
+        with connection_stats_lock:
+            connection_stats['requests'] += 1
+            if self.requests_on_connection > 1:
+                connection_stats['reused_requests'] += 1
+        if self.request_version != 'HTTP/1.1':
+            return
+        keepalive_allowed = getattr(self.server, 'keepalive_allowed', None)
+        if self.requests_on_connection >= KEEPALIVE_MAX_REQUESTS:
+            self.send_header('Connection', 'close')
+        elif not self.close_connection and keepalive_allowed is not None and not keepalive_allowed():
+            # Пул занят соединениями - освобождаем поток после ответа
+            with connection_stats_lock:
+                connection_stats['saturated_closes'] += 1
+            self.send_header('Connection', 'close')
+        elif not self.close_connection:
+            remaining = KEEPALIVE_MAX_REQUESTS - self.requests_on_connection
+            self.send_header('Keep-Alive', f'timeout={int(KEEPALIVE_TIMEOUT)}, max={remaining}')
+
+    def resolve_route(self, routes, prefix_routes, default):
+        """Находит метод обработчика для пути запроса"""
+        path = urlsplit(self.path).path
+        if path in routes:
+            return getattr(self, routes[path])
+        for prefix, method in prefix_routes:
+            if path.startswith(prefix):
+                return getattr(self, method)
+        return getattr(self, default)
+
+    def dispatch(self, routes, prefix_routes, default):
+        """Вызывает обработчик маршрута и учитывает запрос в метриках"""
+        method = self.resolve_route(routes, prefix_routes, default)
+        self.response_status = None
+        bytes_before = self.wfile.bytes_written
+        started = time.perf_counter()
+        try:
+            method()
+        finally:
+            try:
+                bytes_in = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                bytes_in = 0
+            record_request(method.__name__, self.command, self.response_status or 0,
+                           time.perf_counter() - started, bytes_in,
+                           self.wfile.bytes_written - bytes_before)
 
-        # Читаем данные
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length)
-        speed_data = post_data.decode('utf-8').strip()
+    def log_message(self, format, *args):
+        """Журнал запросов http.server (уровень debug)"""
+        log_event('debug', f'{self.address_string()} - {format % args}')
 
-        now = get_moscow_time()
-        timestamp = now.strftime('%Y-%m-%d %H:%M:%S')
+    def log_error(self, format, *args):
+        # Ответы send_error (404, 400) и таймауты простаивающих keep-alive соединений -
+        # штатные события; ошибки сервера пишутся обработчиками через log_event('error')
+        log_event('debug', f'{self.address_string()} - {format % args}')
 
-        print(f'📥 Получена скорость от {device_name} ({client_ip}): {speed_data} км/ч в {timestamp}')
+    def do_POST(self):
+        self.dispatch(self.POST_ROUTES, [], 'handle_speed')
 
-        # Сохраняем данные с временной меткой
-        with open(device_file, 'w') as f:
-            f.write(f"{speed_data}\n{timestamp}")
+    def handle_speed(self):
+        """Прием одного значения скорости (тело запроса), время - серверное
 
-        with open(device_log_file, 'a') as f:
-            f.write(f'{timestamp} - {speed_data} км/ч\n')
+        Тело - строка скорости либо JSON объект {"speed", "lat", "lon", "heading",
+        "accuracy"[, "t"]} с координатами GPS.
+        """
+        # Получаем название устройства
+        device_name, safe_name, client_ip = self.get_device_identity()
 
-        with open(ALL_DEVICES_FILE, 'a') as f:
-            f.write(f'{timestamp} - {device_name} ({client_ip}) - {speed_data} км/ч\n')
+        # Читаем данные
+        speed_data = self.read_body().decode('utf-8').strip()
 
-        # Обновляем Excel файл
-        try:
-            create_excel_file()
-        except Exception as e:
-            print(f"⚠️ Ошибка обновления Excel: {e}")
+        now = get_moscow_time()
+        sample = {'time': now, 'speed': speed_data}
+        if speed_data.startswith('{'):
+            try:
+                fix = json.loads(speed_data)
+                if not isinstance(fix, dict):
+                    raise ValueError('Ожидается объект')
+                sample = parse_sample_row(fix, default_time=now)
+            except (ValueError, TypeError) as e:
+                self.send_error(400, "Invalid sample", str(e))
+                return
+            speed_data = sample['speed']
+        timestamp = sample['time'].strftime('%Y-%m-%d %H:%M:%S')
+
+        log_event('info', f'📥 Получена скорость от {device_name} ({client_ip}): {speed_data} км/ч в {timestamp}', sampled=True)
 
-        # Обновляем неактивные устройства прочерками
-        update_inactive_devices()
+        # Сохраняем данные с временной меткой сервера
+        ingest_samples(device_name, safe_name, client_ip, [sample])
+
+        # Отмечаем устройства, переставшие присылать данные
+        collect_inactive_devices()
 
         # Отправляем ответ
         self.send_response(200)
@@ -216,23 +3331,69 @@ class handler(BaseHTTPRequestHandler):
         self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
         self.send_header('Pragma', 'no-cache')
         self.send_header('Expires', '0')
-        self.end_headers()
-        self.wfile.write(f'Speed updated for {device_name}: {speed_data} km/h'.encode())
+        self.send_payload(f'Speed updated for {device_name}: {speed_data} km/h'.encode())
+
+    def handle_batch(self):
+        """Пакетный прием буферизованных сэмплов с временем устройства"""
+        try:
+            device_name, safe_name, client_ip = self.get_device_identity()
+            
+            try:
+                samples = parse_batch_samples(self.read_body(), self.headers.get('Content-Type', ''))
+            except (ValueError, TypeError) as e:
+                self.send_error(400, "Invalid batch", str(e))
+                return
+            
+            if len(samples) > BATCH_MAX_SAMPLES:
+                self.send_error(413, f"Too many samples (max {BATCH_MAX_SAMPLES})")
+                return
+            
+            if samples:
+                entry = ingest_samples(device_name, safe_name, client_ip, samples)
+                log_event('info', f'📦 Пакет от {device_name} ({client_ip}): {len(samples)} сэмплов, последние данные {entry["timestamp"]}', sampled=True)
+            
+            collect_inactive_devices()
+            
+            response_data = {
+                'device': device_name,
+                'accepted': len(samples),
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_batch: {e}')
+            self.send_error(500, "Internal server error")
 
     def handle_file_download(self):
         try:
-            filename = self.path.replace('/download/', '')
+            url = urlsplit(self.path)
+            filename = unquote(url.path[len('/download/'):])
+            query = parse_qs(url.query)
             
             # Разрешенные файлы для скачивания
             allowed_files = [
                 'all_devices.txt',
                 'GPS-Speed-69F-v3.0-With-Remote-Restart.apk',
                 'restart_signal.txt',
-                'gps_speed_data.xlsx'
+                'gps_speed_data.xlsx',
+                'gps_speed_history.xlsx'
             ]
             
+            # Треки выгружаются из хранилища истории, а не из файлов
+            track_export = TRACK_EXPORT_RE.fullmatch(filename)
+            if track_export:
+                self.send_track_export(track_export['device'], track_export['format'], query)
+                return
+            
             # Проверяем, что файл разрешен для скачивания
-            if not (filename.startswith('device_') and (filename.endswith('.txt') or filename.endswith('_log.txt'))) and filename not in allowed_files:
+            is_text_log = filename.startswith(('device_', 'all_devices')) and filename.endswith(('.txt', '.txt.gz'))
+            # Архивные сегменты: archive/<YYYY-MM-DD>/<лог>.NNN.txt[.gz]
+            is_archive = ARCHIVE_NAME_RE.match(filename) is not None
+            if not is_archive and ('/' in filename or '\\' in filename or (not is_text_log and filename not in allowed_files)):
                 self.send_error(404, "File not found")
                 return
             
@@ -244,6 +3405,13 @@ class handler(BaseHTTPRequestHandler):
                 # Остальные файлы в DATA_DIR
                 filepath = os.path.join(DATA_DIR, filename)
             
+            if filename == 'gps_speed_data.xlsx':
+                # Досборка Excel по запросу, если есть несохраненные изменения
+                rebuild_excel_file()
+            else:
+                # Логи могут быть еще в буфере писателя
+                flush_logs()
+            
             if not os.path.exists(filepath):
                 self.send_error(404, "File not found")
                 return
@@ -251,36 +3419,240 @@ class handler(BaseHTTPRequestHandler):
             # Определяем тип контента
             if filename.endswith('.apk'):
                 content_type = 'application/vnd.android.package-archive'
-                # Читаем APK как бинарный файл
-                with open(filepath, 'rb') as f:
-                    content = f.read()
             elif filename.endswith('.xlsx'):
                 content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                # Читаем Excel как бинарный файл
-                with open(filepath, 'rb') as f:
-                    content = f.read()
+            elif filename.endswith('.gz'):
+                # Сжатые на диске сегменты отдаются как есть, без пересжатия
+                content_type = 'application/gzip'
             else:
                 content_type = 'text/plain; charset=utf-8'
-                # Читаем текстовые файлы
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    content = f.read().encode('utf-8')
             
+            # ?tail=N - последние N строк, читаем файл с конца
+            if 'tail' in query and filename.endswith('.txt'):
+                try:
+                    tail_lines = int(query['tail'][0])
+                except ValueError:
+                    self.send_error(400, "Invalid tail")
+                    return
+                content = read_tail_lines(filepath, tail_lines)
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_payload(content)
+                return
+            
+            file_stat = os.stat(filepath)
+            etag = f'"{file_stat.st_mtime_ns:x}-{file_stat.st_size:x}"'
+            
+            # Текстовые логи сжимаются, если клиент это поддерживает (кроме Range запросов)
+            encoding = None
+            if filename.endswith('.txt') and file_stat.st_size >= COMPRESS_MIN_SIZE and not self.headers.get('Range'):
+                encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+            if encoding and is_active_log(filename):
+                # Текущий лог меняется при каждом сбросе буфера: сжимаем на лету, копию не кэшируем
+                self.send_compressed_stream(filepath, filename, file_stat, f'{etag[:-1]}-{encoding}"', encoding, content_type)
+                return
+            if encoding:
+                filepath = get_compressed_copy(filepath, filename.replace('/', '_'), etag, encoding)
+                etag = f'{etag[:-1]}-{encoding}"'
+            
+            with open(filepath, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                last_modified = formatdate(file_stat.st_mtime, usegmt=True)
+                
+                # Условный запрос: файл не изменился
+                if self.is_not_modified(etag, file_stat.st_mtime):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified', last_modified)
+                    self.send_header('Access-Control-Allow-Origin', '*')
+                    self.end_headers()
+                    return
+                
+                # Range запрос (один диапазон), If-Range - только для той же версии файла
+                byte_range = None
+                range_header = self.headers.get('Range')
+                if range_header and self.headers.get('If-Range', etag) in (etag, last_modified):
+                    byte_range = parse_byte_range(range_header, size)
+                    if byte_range == 'invalid':
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.send_header('Access-Control-Allow-Origin', '*')
+                        self.end_headers()
+                        return
+                
+                if byte_range:
+                    start, end = byte_range
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                else:
+                    start, end = 0, size - 1
+                    self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(end - start + 1))
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                if filename.endswith('.txt'):
+                    self.send_header('Vary', 'Accept-Encoding')
+                self.send_header('Content-Disposition', content_disposition(os.path.basename(filename)))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                
+                # Отдаем файл потоком без загрузки в память
+                self.send_file_range(f, start, end - start + 1)
+            
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except Exception as e:
+            log_event('error', f'❌ Ошибка при скачивании файла: {e}')
+            self.send_error(500, "Internal server error")
+
+    def send_compressed_stream(self, filepath, filename, file_stat, etag, encoding, content_type):
+        """Отдает файл, сжимая его на лету (длина заранее неизвестна)"""
+        last_modified = formatdate(file_stat.st_mtime, usegmt=True)
+        if self.is_not_modified(etag, file_stat.st_mtime):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            return
+        
+        with open(filepath, 'rb') as f:
             self.send_response(200)
             self.send_header('Content-Type', content_type)
-            self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+            self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+            self.send_header('Content-Disposition', content_disposition(os.path.basename(filename)))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', last_modified)
             self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            # Отдаем ровно ту версию, что описывает ETag: строки, дописанные позже, не попадут
+            for data in iter_compressed(f, encoding, limit=file_stat.st_size):
+                if data:
+                    self.wfile.write(data)
+
+    def send_track_export(self, device_name, export_format, query):
+        """Потоковая выгрузка трека (?from=&to=&simplify=dp|vw&tolerance=<м>)"""
+        safe_name = make_safe_name(device_name)
+        try:
+            start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+            end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+            method = query.get('simplify', ['none'])[0]
+            tolerance = float(query.get('tolerance', ['5'])[0])
+            if method not in TRACK_SIMPLIFY_METHODS:
+                raise ValueError(f"simplify must be one of {', '.join(TRACK_SIMPLIFY_METHODS)}")
+            if not tolerance > 0:
+                raise ValueError('tolerance must be positive')
+        except (ValueError, TypeError) as e:
+            self.send_error(400, f"Invalid parameters: {e}")
+            return
+        
+        load_history_store()
+        with history_lock:
+            known = safe_name in track_store
+        if not known:
+            self.send_error(404, "Track not found")
+            return
+        
+        # Оба прохода GeoJSON (время и координаты) читают один снимок трека:
+        # точки, дописанные во время выгрузки, не рассогласуют массивы
+        segments = acquire_segments(safe_name, track_store)
+        try:
+            def make_points():
+                points = iter_history(safe_name, start_ms, end_ms, store=track_store, segments=segments)
+                return simplify_track(points, method, tolerance) if method != 'none' else points
+            
+            name = safe_name.replace('_', ' ')
+            if export_format == 'gpx':
+                content_type = 'application/gpx+xml'
+                parts = iter_gpx(name, make_points())
+            else:
+                content_type = 'application/geo+json'
+                parts = iter_geojson(name, safe_name, make_points)
+            
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Disposition', content_disposition(f'track_{safe_name}.{export_format}'))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            # Длина документа заранее неизвестна - соединение закрывается после него
+            self.send_header('Connection', 'close')
             self.end_headers()
-            self.wfile.write(content)
             
-        except Exception as e:
-            print(f'❌ Ошибка при скачивании файла: {e}')
-            self.send_error(500, "Internal server error")
+            # Документ пишется блоками по мере чтения трека, целиком в памяти не собирается
+            buffer = []
+            buffered = 0
+            for part in parts:
+                buffer.append(part)
+                buffered += len(part)
+                if buffered >= 64 * 1024:
+                    self.wfile.write(''.join(buffer).encode('utf-8'))
+                    buffer = []
+                    buffered = 0
+            self.wfile.write(''.join(buffer).encode('utf-8'))
+        finally:
+            release_segments(segments)
+
+    def send_payload(self, body, cache=False):
+        """Завершает заголовки и отправляет тело, сжимая его по Accept-Encoding"""
+        if len(body) >= COMPRESS_MIN_SIZE:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+            if encoding:
+                body = compress_payload(body, encoding, cache=cache)
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def is_not_modified(self, etag, mtime=None):
+        """Проверяет If-None-Match / If-Modified-Since"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and mtime is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_file_range(self, f, offset, count):
+        """Отправляет часть файла через sendfile, при недоступности - блоками"""
+        if count <= 0:
+            return
+        try:
+            self.wfile.bytes_written += self.connection.sendfile(f, offset, count)
+            return
+        except (AttributeError, NotImplementedError, ValueError):
+            pass
+        f.seek(offset)
+        while count > 0:
+            chunk = f.read(min(count, 256 * 1024))
+            if not chunk:
+                break
+            self.wfile.write(chunk)
+            count -= len(chunk)
 
     def handle_cleanup(self):
+        query = parse_qs(urlsplit(self.path).query)
+        if any(key in query for key in ('device', 'from', 'to', 'older_than')):
+            self.handle_selective_cleanup(query)
+            return
         try:
+            # Удаляемые файлы не должны оставаться открытыми писателем логов
+            close_log_handles()
             cleaned_files = []
             if os.path.exists(DATA_DIR):
                 device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
@@ -298,20 +3670,34 @@ class handler(BaseHTTPRequestHandler):
                             cleaned_files.append(log_filename)
                             
                     except Exception as e:
-                        print(f'❌ Ошибка удаления файла {filename}: {e}')
+                        log_event('error', f'❌ Ошибка удаления файла {filename}: {e}')
             
             if os.path.exists(ALL_DEVICES_FILE):
                 with open(ALL_DEVICES_FILE, 'w') as f:
                     f.write('')
                 cleaned_files.append('all_devices.txt')
             
+            # Статистика, буферы и история меняются под блокировками устройств:
+            # на время полной очистки прием данных всех устройств ждет
+            acquire_all_device_locks()
+            try:
+                clear_history_store()
+                shutil.rmtree(COMPRESSED_DIR, ignore_errors=True)
+                if os.path.exists(ARCHIVE_DIR):
+                    cleaned_files.extend(name for _, _, names in os.walk(ARCHIVE_DIR) for name in names)
+                    shutil.rmtree(ARCHIVE_DIR, ignore_errors=True)
+                clear_devices_registry()
+            finally:
+                release_all_device_locks()
+            mark_excel_dirty()
+            publish_stream_event('snapshot', build_devices_payload())
+            
             self.send_response(200)
             self.send_header('Content-type', 'text/html; charset=utf-8')
             self.send_header('Access-Control-Allow-Origin', '*')
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Expires', '0')
-            self.end_headers()
             
             html = f'''<!DOCTYPE html>
 <html><head><title>Очистка данных</title></head>
@@ -321,11 +3707,187 @@ class handler(BaseHTTPRequestHandler):
 <p><a href="/">← Вернуться к мониторингу</a></p>
 </body></html>'''
             
-            self.wfile.write(html.encode('utf-8'))
-            print(f'🧹 Очистка завершена. Удалено файлов: {len(cleaned_files)}')
+            self.send_payload(html.encode('utf-8'))
+            log_event('info', f'🧹 Очистка завершена. Удалено файлов: {len(cleaned_files)}')
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка при очистке: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_selective_cleanup(self, query):
+        """Выборочная очистка (?device=, ?from=&to=, ?older_than=<дней>) - задание для фонового потока"""
+        try:
+            device = None
+            if 'device' in query:
+                device = make_safe_name(query['device'][0])
+                if not device:
+                    raise ValueError('empty device')
+            start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+            end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+            if 'older_than' in query:
+                end_ms = int((time.time() - float(query['older_than'][0]) * 86400) * 1000)
+        except (ValueError, TypeError) as e:
+            self.send_error(400, f"Invalid parameters: {e}")
+            return
+        # Удалять можно только известные устройства
+        if device is not None and not is_known_device(device):
+            self.send_error(404, "Device not found")
+            return
+        
+        job = schedule_cleanup(device, start_ms, end_ms)
+        self.send_response(202)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_header('Location', '/api/logs')
+        self.send_payload(json.dumps(job, ensure_ascii=False).encode('utf-8'))
+
+    def handle_api_logs(self):
+        """Текущие и архивные логи, настройки хранения и задания очистки"""
+        active, archive = list_log_files()
+        with maintenance_lock:
+            jobs = [dict(job) for job in maintenance_jobs.values()]
+            state = {key: value for key, value in maintenance_state.items() if key not in ('worker_started', 'next_job')}
+        response_data = {
+            'active': active,
+            'archive': archive,
+            'jobs': jobs,
+            'maintenance': state,
+            'policy': {
+                'rotate_bytes': LOG_ROTATE_BYTES,
+                'retention_days': LOG_RETENTION_DAYS,
+                'history_retention_days': HISTORY_RETENTION_DAYS,
+                'compress_after_days': LOG_COMPRESS_AFTER_DAYS,
+                'interval': LOG_MAINTENANCE_INTERVAL,
+            },
+        }
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+
+    def handle_api_leaderboard(self):
+        """Рейтинг активных устройств по ключу (?by=speed|max_speed|avg_speed|...&limit=10)"""
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            key = query.get('by', ['speed'])[0]
+            try:
+                limit = int(query.get('limit', ['10'])[0])
+                if key not in LEADERBOARD_KEYS:
+                    raise ValueError(f"by must be one of {', '.join(LEADERBOARD_KEYS)}")
+                if limit <= 0:
+                    raise ValueError('limit must be positive')
+            except (ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            
+            ranking, total = get_leaderboard(key, limit)
+            response_data = {
+                'by': key,
+                'total': total,
+                'leaders': [
+                    {'place': place, 'safe_name': safe_name, 'name': safe_name.replace('_', ' '), 'value': value}
+                    for place, (safe_name, value) in enumerate(ranking, 1)
+                ],
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_api_leaderboard: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_api_nearby(self):
+        """Устройства в радиусе от точки (?lat=&lon=&radius=<м>[&all=1])"""
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            try:
+                lat = float(query['lat'][0])
+                lon = float(query['lon'][0])
+                radius = float(query.get('radius', ['100'])[0])
+                if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                    raise ValueError('lat/lon out of range')
+                if not 0 < radius <= 1_000_000:
+                    raise ValueError('radius must be within 0..1000000 m')
+            except (KeyError, ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            
+            # По умолчанию только устройства, присылающие данные сейчас
+            max_age = None if query.get('all', ['0'])[0] == '1' else DEVICE_INACTIVE_TIMEOUT
+            now = time.monotonic()
+            devices = [{
+                'safe_name': safe_name,
+                'name': safe_name.replace('_', ' '),
+                'distance_m': round(distance, 1),
+                'lat': position['lat'],
+                'lon': position['lon'],
+                'heading': finite_or_none(position['heading'], 1),
+                'accuracy': finite_or_none(position['accuracy'], 1),
+                'time': position['time'],
+                'age': round(now - position['seen'], 1) if position['seen'] is not None else None,
+            } for distance, safe_name, position in find_nearby(lat, lon, radius, max_age)]
+            
+            response_data = {'lat': lat, 'lon': lon, 'radius': radius, 'count': len(devices), 'devices': devices,
+                             'index_ready': spatial_state['loaded']}
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_api_nearby: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_api_track(self):
+        """Точки треков в прямоугольнике (?bbox=minLat,minLon,maxLat,maxLon&from=&to=&device=)"""
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            try:
+                min_lat, min_lon, max_lat, max_lon = (float(value) for value in query['bbox'][0].split(','))
+                if not (-90 <= min_lat <= max_lat <= 90 and -180 <= min_lon <= max_lon <= 180):
+                    raise ValueError('bbox must be minLat,minLon,maxLat,maxLon')
+                start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+                end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+                limit = int(query.get('limit', [str(TRACK_MAX_POINTS)])[0])
+                if not 0 < limit <= TRACK_MAX_POINTS:
+                    raise ValueError(f'limit must be within 1..{TRACK_MAX_POINTS}')
+            except (KeyError, ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            device = make_safe_name(query['device'][0]) if 'device' in query else None
+            
+            tracks, truncated = query_track_box(min_lat, min_lon, max_lat, max_lon, start_ms, end_ms, device, limit)
+            response_data = {
+                'bbox': [min_lat, min_lon, max_lat, max_lon],
+                'count': sum(len(points) for points in tracks.values()),
+                'truncated': truncated,
+                # Пока индекс строится, треки еще не проиндексированных устройств не найдутся
+                'index_ready': spatial_state['loaded'],
+                'tracks': {
+                    safe_name: {
+                        'times': [fix[0] for fix in points],
+                        'lat': [fix[1] for fix in points],
+                        'lon': [fix[2] for fix in points],
+                        'heading': [finite_or_none(fix[3], 1) for fix in points],
+                        'accuracy': [finite_or_none(fix[4], 1) for fix in points],
+                    }
+                    for safe_name, points in tracks.items()
+                },
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
             
         except Exception as e:
-            print(f'❌ Ошибка при очистке: {e}')
+            log_event('error', f'❌ Ошибка в handle_api_track: {e}')
             self.send_error(500, "Internal server error")
 
     def handle_restart_tracking(self):
@@ -340,8 +3902,8 @@ class handler(BaseHTTPRequestHandler):
                 f.write(f"COMMAND_ID:{int(current_time.timestamp())}\n")
                 f.write(f"FORCE_RESTART:true\n")
             
-            print(f"🔄 Создан файл-сигнал перезапуска: {restart_file}")
-            print(f"🔄 Время создания: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
+            log_event('info', f"🔄 Создан файл-сигнал перезапуска: {restart_file}")
+            log_event('info', f"🔄 Время создания: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
             
             self.send_response(200)
             self.send_header('Content-type', 'text/html; charset=utf-8')
@@ -349,7 +3911,6 @@ class handler(BaseHTTPRequestHandler):
             self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
             self.send_header('Pragma', 'no-cache')
             self.send_header('Expires', '0')
-            self.end_headers()
             
             html_content = f'''<!DOCTYPE html>
 <html>
@@ -450,543 +4011,495 @@ FORCE_RESTART:true
 </body>
 </html>'''
             
-            self.wfile.write(html_content.encode('utf-8'))
-            print(f'🔄 Команда перезапуска отправлена в {get_moscow_time().strftime("%Y-%m-%d %H:%M:%S")}')
+            self.send_payload(html_content.encode('utf-8'))
+            log_event('info', f'🔄 Команда перезапуска отправлена в {get_moscow_time().strftime("%Y-%m-%d %H:%M:%S")}')
             
         except Exception as e:
-            print(f'❌ Ошибка при отправке команды перезапуска: {e}')
+            log_event('error', f'❌ Ошибка при отправке команды перезапуска: {e}')
             self.send_error(500, "Internal server error")
 
     def handle_create_excel(self):
-        """Обработка создания Excel файла"""
+        """Обработка создания Excel файла (?history=1&from=&to= - с листами истории устройств)"""
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            if query.get('history', ['0'])[0] not in ('', '0'):
+                try:
+                    start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+                    end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+                except (ValueError, TypeError) as e:
+                    self.send_error(400, f"Invalid parameters: {e}")
+                    return
+                # Выгрузка истории собирается по запросу, одна за раз
+                with excel_history_lock:
+                    excel_file = create_excel_file(EXCEL_HISTORY_FILE, start_ms, end_ms, include_history=True)
+            else:
+                # Создаем Excel файл (только если есть изменения)
+                excel_file = rebuild_excel_file()
+            
+            if excel_file and os.path.exists(excel_file):
+                # Перенаправляем на скачивание
+                self.send_response(302)
+                self.send_header('Location', f'/download/{os.path.basename(excel_file)}')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                log_event('info', f'📊 Excel файл создан и готов к скачиванию: {excel_file}')
+            else:
+                # Показываем ошибку
+                self.send_response(200)
+                self.send_header('Content-type', 'text/html; charset=utf-8')
+                self.send_header('Access-Control-Allow-Origin', '*')
+                
+                html = f'''<!DOCTYPE html>
+<html>
+<head>
+    <title>❌ Ошибка создания Excel - 69F СКОРОСТЬ</title>
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <style>
+        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; margin: 0; padding: 20px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }}
+        .container {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 12px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); overflow: hidden; }}
+        .header {{ background: linear-gradient(135deg, #dc3545 0%, #c82333 100%); color: white; padding: 30px; text-align: center; }}
+        .content {{ padding: 30px; }}
+        .error {{ background: #f8d7da; border: 1px solid #f5c6cb; color: #721c24; padding: 15px; border-radius: 8px; margin-bottom: 20px; }}
+        .back-link {{ display: inline-block; background: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; margin-top: 20px; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>❌ Ошибка создания Excel</h1>
+            <p>Не удалось создать Excel файл</p>
+        </div>
+        <div class="content">
+            <div class="error">
+                <strong>Ошибка:</strong> Не удалось создать Excel файл с данными о скорости.
+                <br><br>
+                Возможные причины:
+                <ul>
+                    <li>Нет данных от устройств</li>
+                    <li>Ошибка обработки файлов</li>
+                    <li>Проблемы с библиотекой openpyxl</li>
+                </ul>
+            </div>
+            <a href="/" class="back-link">← Вернуться к мониторингу</a>
+        </div>
+    </div>
+</body>
+</html>'''
+                
+                self.send_payload(html.encode('utf-8'))
+                log_event('error', f'❌ Ошибка создания Excel файла')
+                
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_create_excel: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_excel_status(self):
+        """Состояние фонового экспорта Excel в JSON формате"""
+        response_data = {
+            'dirty': excel_export_stats['dirty'],
+            'rebuilds': excel_export_stats['rebuilds'],
+            'skipped_rebuilds': excel_export_stats['skipped'],
+            'interval': EXCEL_EXPORT_INTERVAL,
+        }
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_payload(json.dumps(response_data).encode('utf-8'))
+
+    def handle_stats(self):
+        """Служебная статистика сервера в JSON формате"""
+        with connection_stats_lock:
+            connections = dict(connection_stats)
+        response_data = {
+            'connections': connections,
+            'excel': {
+                'rebuilds': excel_export_stats['rebuilds'],
+                'skipped_rebuilds': excel_export_stats['skipped'],
+            },
+        }
+        self.send_response(200)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_payload(json.dumps(response_data).encode('utf-8'))
+
+    def handle_metrics(self):
+        """Метрики сервера в текстовом формате Prometheus"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
+        self.send_payload(format_metrics().encode('utf-8'))
+
+    def handle_api_analytics(self):
+        """Аналитика по истории устройств: перцентили, время выше порога, отрезки, общая сетка"""
+        if np is None:
+            self.send_error(503, "Analytics requires NumPy")
+            return
+        try:
+            query = parse_qs(urlsplit(self.path).query)
+            try:
+                start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+                end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+                threshold = float(query['threshold'][0]) if 'threshold' in query else None
+                percentiles = [float(value) for value in query.get('percentiles', ['50,90,95,99'])[0].split(',') if value]
+                if any(not 0 <= value <= 100 for value in percentiles):
+                    raise ValueError('percentiles must be within 0..100')
+                segment_ms = int(float(query['segment'][0]) * 1000) if 'segment' in query else None
+                laps = sorted(parse_time_param(value) for value in query['laps'][0].split(',') if value) if 'laps' in query else None
+                step_ms = int(float(query['resample'][0]) * 1000) if 'resample' in query else None
+                if (segment_ms is not None and segment_ms <= 0) or (step_ms is not None and step_ms <= 0):
+                    raise ValueError('segment and resample must be positive')
+            except (ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            
+            load_history_store()
+            if 'device' in query:
+                names = [make_safe_name(name)
+                         for value in query['device'] for name in value.split(',') if name]
+            else:
+                with history_lock:
+                    names = sorted(history_store)
+            
+            series = {}
+            for safe_name in names:
+                times, speeds = load_history_arrays(safe_name)
+                low = np.searchsorted(times, start_ms, side='left') if start_ms is not None else 0
+                high = np.searchsorted(times, end_ms, side='right') if end_ms is not None else len(times)
+                series[safe_name] = (times[low:high], speeds[low:high])
+            
+            if segment_ms:
+                # Число отрезков ограничено так же, как точки общей сетки
+                segments = max(((times[-1] - times[0]) // segment_ms + 1 for times, _ in series.values() if len(times)), default=0)
+                if segments > ANALYTICS_MAX_POINTS:
+                    self.send_error(400, f"Too many segments (max {ANALYTICS_MAX_POINTS})")
+                    return
+            
+            response_data = {
+                'from': start_ms,
+                'to': end_ms,
+                'devices': {safe_name: analyze_device(times, speeds, percentiles, threshold, segment_ms, laps)
+                            for safe_name, (times, speeds) in series.items()},
+            }
+            
+            if step_ms:
+                # Общая сетка: заданный интервал или охват данных всех устройств
+                present = [times for times, _ in series.values() if len(times)]
+                grid_start = start_ms if start_ms is not None else min((times[0] for times in present), default=0)
+                grid_end = end_ms if end_ms is not None else max((times[-1] for times in present), default=0)
+                points = (grid_end - grid_start) // step_ms + 1 if present else 0
+                if points > ANALYTICS_MAX_POINTS:
+                    self.send_error(400, f"Too many resample points (max {ANALYTICS_MAX_POINTS})")
+                    return
+                grid = grid_start + np.arange(max(points, 0), dtype=np.int64) * step_ms
+                response_data['resample'] = {
+                    'step_s': step_ms / 1000,
+                    'times': grid.tolist(),
+                    'series': {safe_name: resample_series(times, speeds, grid) for safe_name, (times, speeds) in series.items()},
+                }
+            
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_api_analytics: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_api_history(self):
+        """История скорости устройства, прореженная до заданного числа точек"""
+        try:
+            url = urlsplit(self.path)
+            device_name = unquote(url.path[len('/api/history/'):])
+            safe_name = make_safe_name(device_name)
+            query = parse_qs(url.query)
+            try:
+                start_ms = parse_time_param(query['from'][0]) if 'from' in query else None
+                end_ms = parse_time_param(query['to'][0]) if 'to' in query else None
+                points = int(query.get('points', ['1000'])[0])
+                method = query.get('method', ['minmax'])[0]
+                if not 3 <= points <= HISTORY_MAX_POINTS:
+                    raise ValueError(f'points must be within 3..{HISTORY_MAX_POINTS}')
+                if method not in ('minmax', 'lttb'):
+                    raise ValueError('method must be minmax or lttb')
+            except (ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            
+            load_history_store()
+            with history_lock:
+                known = safe_name in history_store
+            if not safe_name or not known:
+                self.send_error(404, "Device history not found")
+                return
+            
+            samples, source = downsample_history(safe_name, start_ms, end_ms, points, method)
+            response_data = {
+                'device': safe_name,
+                'from': start_ms,
+                'to': end_ms,
+                'method': method,
+                'source': source,
+                'points': len(samples),
+                'times': [epoch_ms for epoch_ms, _ in samples],
+                'speeds': [round(speed, 2) for _, speed in samples],
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_api_history: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_api_recent(self):
+        """Последние сэмплы устройства (?n=, ?seconds=) из буфера в памяти"""
+        try:
+            url = urlsplit(self.path)
+            device_name = unquote(url.path[len('/api/recent/'):])
+            safe_name = make_safe_name(device_name)
+            query = parse_qs(url.query)
+            try:
+                count = int(query['n'][0]) if 'n' in query else None
+                seconds = float(query['seconds'][0]) if 'seconds' in query else None
+                if count is None and seconds is None:
+                    count = 100
+                if (count is not None and count <= 0) or (seconds is not None and seconds <= 0):
+                    raise ValueError('n and seconds must be positive')
+            except (ValueError, TypeError) as e:
+                self.send_error(400, f"Invalid parameters: {e}")
+                return
+            
+            if not safe_name or (get_device_state(safe_name) is None and safe_name not in recent_samples):
+                self.send_error(404, "Device not found")
+                return
+            
+            samples = get_recent_samples(safe_name, count, seconds)
+            response_data = {
+                'device': safe_name,
+                'count': len(samples),
+                'times': [epoch_ms for epoch_ms, _ in samples],
+                'speeds': [round(speed, 2) for _, speed in samples],
+            }
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data).encode('utf-8'))
+            
+        except Exception as e:
+            log_event('error', f'❌ Ошибка в handle_api_recent: {e}')
+            self.send_error(500, "Internal server error")
+
+    def handle_api_stream(self):
+        """SSE поток: снимок при подключении, затем только изменения устройств"""
+        subscriber = subscribe_stream()
         try:
-            # Создаем Excel файл
-            excel_file = create_excel_file()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('X-Accel-Buffering', 'no')
+            # Длина потока неизвестна - соединение закрывается после него
+            self.send_header('Connection', 'close')
+            self.end_headers()
             
-            if excel_file and os.path.exists(excel_file):
-                # Перенаправляем на скачивание
-                self.send_response(302)
-                self.send_header('Location', '/download/gps_speed_data.xlsx')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                print(f'📊 Excel файл создан и готов к скачиванию: {excel_file}')
-            else:
-                # Показываем ошибку
-                self.send_response(200)
-                self.send_header('Content-type', 'text/html; charset=utf-8')
-                self.send_header('Access-Control-Allow-Origin', '*')
-                self.end_headers()
-                
-                html = f'''<!DOCTYPE html>
-<html>
-<head>
-    <title>❌ Ошибка создания Excel - 69F СКОРОСТЬ</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; margin: 0; padding: 20px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }}
-        .container {{ max-width: 600px; margin: 0 auto; background: white; border-radius: 12px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); overflow: hidden; }}
-        .header {{ background: linear-gradient(135deg, #dc3545 0%, #c82333 100%); color: white; padding: 30px; text-align: center; }}
-        .content {{ padding: 30px; }}
-        .error {{ background: #f8d7da; border: 1px solid #f5c6cb; color: #721c24; padding: 15px; border-radius: 8px; margin-bottom: 20px; }}
-        .back-link {{ display: inline-block; background: #007bff; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; margin-top: 20px; }}
-    </style>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>❌ Ошибка создания Excel</h1>
-            <p>Не удалось создать Excel файл</p>
-        </div>
-        <div class="content">
-            <div class="error">
-                <strong>Ошибка:</strong> Не удалось создать Excel файл с данными о скорости.
-                <br><br>
-                Возможные причины:
-                <ul>
-                    <li>Нет данных от устройств</li>
-                    <li>Ошибка обработки файлов</li>
-                    <li>Проблемы с библиотекой openpyxl</li>
-                </ul>
-            </div>
-            <a href="/" class="back-link">← Вернуться к мониторингу</a>
-        </div>
-    </div>
-</body>
-</html>'''
+            collect_inactive_devices()
+            self.wfile.write(b'retry: 2000\n\n' + format_sse_event('snapshot', build_devices_payload()))
+            self.wfile.flush()
+            
+            deadline = time.monotonic() + SSE_MAX_DURATION
+            last_write = time.monotonic()
+            while time.monotonic() < deadline and not server_shutdown_event.is_set():
+                try:
+                    message = subscriber.get(timeout=1)
+                except queue.Empty:
+                    message = b''
+                if message is None:
+                    break
                 
-                self.wfile.write(html.encode('utf-8'))
-                print(f'❌ Ошибка создания Excel файла')
+                # Переходы active→inactive находим по куче, без обращения к диску
+                collect_inactive_devices()
                 
+                if not message and time.monotonic() - last_write >= 15:
+                    message = b': keep-alive\n\n'
+                if message:
+                    self.wfile.write(message)
+                    self.wfile.flush()
+                    last_write = time.monotonic()
+        
+        except (BrokenPipeError, ConnectionResetError):
+            pass
         except Exception as e:
-            print(f'❌ Ошибка в handle_create_excel: {e}')
-            self.send_error(500, "Internal server error")
+            log_event('error', f'❌ Ошибка в handle_api_stream: {e}')
+        finally:
+            unsubscribe_stream(subscriber)
 
     def handle_api_data(self):
         """API endpoint для получения данных устройств в JSON формате"""
         try:
-            # Обновляем неактивные устройства прочерками
-            update_inactive_devices()
-            
-            # Получаем данные устройств
-            device_files = []
-            if os.path.exists(DATA_DIR):
-                device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
-            
-            devices_data = []
-            current_time = get_moscow_time()
+            # Отмечаем устройства, переставшие присылать данные
+            collect_inactive_devices()
             
-            for filename in sorted(device_files):
-                filepath = os.path.join(DATA_DIR, filename)
+            query = parse_qs(urlsplit(self.path).query)
+            since = None
+            if 'since' in query:
                 try:
-                    with open(filepath, 'r') as f:
-                        file_content = f.read().strip()
-                    
-                    # Парсим содержимое файла
-                    lines = file_content.split('\n')
-                    if len(lines) >= 2:
-                        speed = lines[0]
-                        data_timestamp = lines[1]
-                    else:
-                        speed = file_content
-                        data_timestamp = "Неизвестно"
-                    
-                    device_name = filename.replace('device_', '').replace('.txt', '').replace('_', ' ')
-                    safe_name = device_name.replace(' ', '_')
-                    
-                    # Проверяем активность устройства
-                    last_update_time = datetime.fromtimestamp(os.path.getmtime(filepath), tz=pytz.timezone('Europe/Moscow'))
-                    time_diff = (current_time - last_update_time).total_seconds()
-                    
-                    is_active = time_diff <= 10
-                    status_text = "🟢 Device Tracking" if is_active else "🔴 Device not Tracking"
-                    status_color = "#28a745" if is_active else "#dc3545"
-                    speed_display = f"{speed} км/ч" if is_active else "—"
-                    
-                    devices_data.append({
-                        'name': device_name,
-                        'safe_name': safe_name,
-                        'speed': speed_display,
-                        'timestamp': data_timestamp,
-                        'is_active': is_active,
-                        'status_text': status_text,
-                        'status_color': status_color,
-                        'time_diff': time_diff
-                    })
-                    
-                except Exception as e:
-                    print(f"❌ Ошибка чтения {filename}: {e}")
-                    continue
+                    since = parse_since_token(query['since'][0])
+                except ValueError:
+                    self.send_error(400, "Invalid since")
+                    return
             
-            # Формируем JSON ответ
-            response_data = {
-                'timestamp': current_time.strftime('%Y-%m-%d %H:%M:%S'),
-                'devices': devices_data,
-                'devices_count': len(devices_data)
-            }
+            # Данные не менялись - отвечаем 304 без сборки JSON
+            etag = get_data_etag()
+            if_none_match = [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]
+            if since is None and etag in if_none_match:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Access-Control-Allow-Origin', '*')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                return
+            
+            # Формируем JSON ответ из реестра
+            response_data = build_devices_payload(since=since)
+            devices_data = response_data['devices']
             
             # Отправляем JSON ответ
             self.send_response(200)
             self.send_header('Content-type', 'application/json; charset=utf-8')
             self.send_header('Access-Control-Allow-Origin', '*')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
+            self.send_header('Access-Control-Expose-Headers', 'ETag')
+            if since is None:
+                self.send_header('ETag', etag)
+            # no-cache (а не no-store): клиент может перепроверить данные через If-None-Match
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_payload(json.dumps(response_data, ensure_ascii=False).encode('utf-8'))
             
-            print(f'📊 API данные отправлены: {len(devices_data)} устройств')
+            log_event('info', f'📊 API данные отправлены: {len(devices_data)} устройств', sampled=True)
             
         except Exception as e:
-            print(f'❌ Ошибка в handle_api_data: {e}')
+            log_event('error', f'❌ Ошибка в handle_api_data: {e}')
             self.send_error(500, "Internal server error")
 
-    def do_GET(self):
-        if self.path.startswith('/download/'):
-            self.handle_file_download()
-            return
-
-        if self.path == '/cleanup':
-            self.handle_cleanup()
+    def handle_dashboard(self):
+        """Страница мониторинга: готовая оболочка из кэша, данные подгружает JavaScript"""
+        body, etag = get_dashboard_page()
+        if self.is_not_modified(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
             return
+        
+        self.send_response(200)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_payload(body, cache=True)
 
-        if self.path == '/restart_tracking':
-            self.handle_restart_tracking()
+    def handle_static_asset(self):
+        """CSS/JS страницы мониторинга: адрес содержит хэш, поэтому кэшируются надолго"""
+        asset = DASHBOARD_ASSETS.get(urlsplit(self.path).path)
+        if asset is None:
+            self.send_error(404, "File not found")
             return
+        content_type, body = asset
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_payload(body, cache=True)
 
-        if self.path == '/create_excel':
-            self.handle_create_excel()
-            return
+    def do_GET(self):
+        # Неизвестные адреса, как и раньше, показывают страницу мониторинга
+        self.dispatch(self.GET_ROUTES, self.GET_PREFIX_ROUTES, 'handle_dashboard')
 
-        if self.path == '/api/data':
-            self.handle_api_data()
-            return
+    def do_OPTIONS(self):
+        self.dispatch({}, [], 'handle_options')
 
-        # Обновляем неактивные устройства прочерками
-        update_inactive_devices()
-        
+    def handle_options(self):
+        """Ответ на CORS preflight"""
         self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
         self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-        self.send_header('Pragma', 'no-cache')
-        self.send_header('Expires', '0')
+        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Device-Name')
+        self.send_header('Content-Length', '0')
         self.end_headers()
-        
-        # Читаем данные из файлов устройств
-        device_files = []
-        if os.path.exists(DATA_DIR):
-            device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
-        
-        devices_html = ""
-        if not device_files:
-            devices_html = '<div>Нет данных от устройств. Подключите Android приложения.</div>'
-        else:
-            for filename in sorted(device_files):
-                filepath = os.path.join(DATA_DIR, filename)
-                try:
-                    with open(filepath, 'r') as f:
-                        file_content = f.read().strip()
-                    
-                    # Парсим содержимое файла (скорость и время)
-                    lines = file_content.split('\n')
-                    if len(lines) >= 2:
-                        speed = lines[0]
-                        data_timestamp = lines[1]
-                    else:
-                        speed = file_content
-                        data_timestamp = "Неизвестно"
-                    
-                    device_name = filename.replace('device_', '').replace('.txt', '').replace('_', ' ')
-                    safe_name = device_name.replace(' ', '_')
-                    
-                    current_time = get_moscow_time()
-                    last_update_time = datetime.fromtimestamp(os.path.getmtime(filepath), tz=pytz.timezone('Europe/Moscow'))
-                    time_diff = (current_time - last_update_time).total_seconds()
-                    
-                    if time_diff > 10:
-                        status_text = "🔴 Device not Tracking"
-                        status_color = "#dc3545"
-                        speed_display = "—"
-                    else:
-                        status_text = "🟢 Device Tracking"
-                        status_color = "#28a745"
-                        speed_display = f"{speed} км/ч"
-                    
-                    devices_html += f'''
-                    <div style="background: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-bottom: 15px;">
-                        <h2>📱 Устройство: {device_name}</h2>
-                        <div style="color: {status_color}; font-weight: bold; margin-bottom: 10px;">{status_text}</div>
-                        <div style="font-size: 2em; font-weight: bold; color: #28a745; margin: 10px 0;">{speed_display}</div>
-                        <div style="font-size: 0.9em; color: #6c757d; margin: 5px 0;">
-                            ⏰ Последние данные: {data_timestamp} (МСК)
-                        </div>
-                        <div style="margin-top: 15px; display: flex; gap: 10px; flex-wrap: wrap;">
-                            <a href="/download/device_{safe_name}.txt" style="color: #007bff; text-decoration: none; padding: 8px 12px; background: #e3f2fd; border-radius: 5px; font-size: 0.9em;">📄 Текущая скорость</a>
-                            <a href="/download/device_{safe_name}_log.txt" style="color: #28a745; text-decoration: none; padding: 8px 12px; background: #e8f5e8; border-radius: 5px; font-size: 0.9em;">📊 История</a>
-                            <a href="/download/gps_speed_data.xlsx" style="color: #9c27b0; text-decoration: none; padding: 8px 12px; background: #f3e5f5; border-radius: 5px; font-size: 0.9em;">📊 Excel</a>
-                        </div>
-                        <div style="margin-top: 15px; padding: 10px; background: #fff; border: 1px solid #dee2e6; border-radius: 5px;">
-                            <div style="font-size: 0.9em; color: #495057; margin-bottom: 8px;">📋 Копировать ссылки:</div>
-                            <div style="display: flex; gap: 8px; flex-wrap: wrap;">
-                                <button onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_{safe_name}.txt')" 
-                                        style="background: #007bff; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 0.8em;">
-                                    📄 Скопировать ссылку на скорость
-                                </button>
-                                <button onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_{safe_name}_log.txt')" 
-                                        style="background: #28a745; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 0.8em;">
-                                    📊 Скопировать ссылку на историю
-                                </button>
-                                <button onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/gps_speed_data.xlsx')" 
-                                        style="background: #9c27b0; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 0.8em;">
-                                    📊 Скопировать ссылку на Excel
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                    '''
-                except Exception as e:
-                    devices_html += f'<div>❌ Ошибка чтения {filename}: {e}</div>'
 
-        html_content = f'''<!DOCTYPE html>
-<html>
-<head>
-    <title>⛵ 69F СКОРОСТЬ</title>
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        body {{ font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; margin: 0; padding: 20px; background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); min-height: 100vh; }}
-        .container {{ max-width: 1200px; margin: 0 auto; background: white; border-radius: 12px; box-shadow: 0 10px 30px rgba(0,0,0,0.2); overflow: hidden; }}
-        .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 30px; text-align: center; }}
-        .content {{ padding: 30px; }}
-        .status {{ text-align: center; color: #6c757d; margin-bottom: 20px; }}
-        .device-card {{ background: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-bottom: 15px; }}
-        .device-name {{ font-size: 1.2em; font-weight: bold; margin-bottom: 10px; }}
-        .device-status {{ font-weight: bold; margin-bottom: 10px; }}
-        .device-speed {{ font-size: 2em; font-weight: bold; color: #28a745; margin: 10px 0; }}
-        .device-timestamp {{ font-size: 0.9em; color: #6c757d; margin: 5px 0; }}
-        .device-links {{ margin-top: 15px; display: flex; gap: 10px; flex-wrap: wrap; }}
-        .device-links a {{ color: #007bff; text-decoration: none; padding: 8px 12px; background: #e3f2fd; border-radius: 5px; font-size: 0.9em; }}
-        .copy-section {{ margin-top: 15px; padding: 10px; background: #fff; border: 1px solid #dee2e6; border-radius: 5px; }}
-        .copy-buttons {{ display: flex; gap: 8px; flex-wrap: wrap; }}
-        .copy-btn {{ background: #007bff; color: white; border: none; padding: 6px 12px; border-radius: 4px; cursor: pointer; font-size: 0.8em; }}
-        .loading {{ text-align: center; color: #6c757d; font-style: italic; padding: 20px; }}
-    </style>
-    <script>
-        // Переменные для хранения данных
-        let devicesData = [];
-        let updateInterval;
-        
-        // Функция для загрузки данных с сервера
-        async function loadDevicesData() {{
-            try {{
-                const response = await fetch('/api/data');
-                if (!response.ok) throw new Error('Network response was not ok');
-                
-                const data = await response.json();
-                devicesData = data.devices;
-                updateDevicesDisplay(data);
-            }} catch (error) {{
-                console.error('Ошибка загрузки данных:', error);
-                document.getElementById('devices-container').innerHTML = 
-                    '<div class="loading">❌ Ошибка загрузки данных. Проверьте подключение к серверу.</div>';
-            }}
-        }}
-        
-        // Функция для обновления отображения устройств
-        function updateDevicesDisplay(data) {{
-            const container = document.getElementById('devices-container');
-            const timestampElement = document.getElementById('timestamp');
-            
-            // Обновляем временную метку
-            if (timestampElement) {{
-                timestampElement.textContent = `Обновлено: ${{data.timestamp}} (МСК)`;
-            }}
-            
-            if (!data.devices || data.devices.length === 0) {{
-                container.innerHTML = '<div class="loading">Нет данных от устройств. Подключите Android приложения.</div>';
-                return;
-            }}
-            
-            // Генерируем HTML для устройств
-            let devicesHtml = '';
-            data.devices.forEach(device => {{
-                devicesHtml += `
-                    <div class="device-card">
-                        <div class="device-name">📱 Устройство: ${{device.name}}</div>
-                        <div class="device-status" style="color: ${{device.status_color}};">${{device.status_text}}</div>
-                        <div class="device-speed">${{device.speed}}</div>
-                        <div class="device-timestamp">⏰ Последние данные: ${{device.timestamp}} (МСК)</div>
-                        <div class="device-links">
-                            <a href="/download/device_${{device.safe_name}}.txt">📄 Текущая скорость</a>
-                            <a href="/download/device_${{device.safe_name}}_log.txt">📊 История</a>
-                            <a href="/download/gps_speed_data.xlsx">📊 Excel</a>
-                        </div>
-                        <div class="copy-section">
-                            <div style="font-size: 0.9em; color: #495057; margin-bottom: 8px;">📋 Копировать ссылки:</div>
-                            <div class="copy-buttons">
-                                <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_${{device.safe_name}}.txt')">
-                                    📄 Скопировать ссылку на скорость
-                                </button>
-                                <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/device_${{device.safe_name}}_log.txt')">
-                                    📊 Скопировать ссылку на историю
-                                </button>
-                                <button class="copy-btn" onclick="copyToClipboard('https://gps-speed-tracker.vercel.app/download/gps_speed_data.xlsx')">
-                                    📊 Скопировать ссылку на Excel
-                                </button>
-                            </div>
-                        </div>
-                    </div>
-                `;
-            }});
-            
-            container.innerHTML = devicesHtml;
-        }}
-        
-        // Функция для копирования в буфер обмена
-        function copyToClipboard(text) {{
-            navigator.clipboard.writeText(text).then(function() {{
-                // Показываем уведомление об успешном копировании
-                const notification = document.createElement('div');
-                notification.style.cssText = `
-                    position: fixed;
-                    top: 20px;
-                    right: 20px;
-                    background: #28a745;
-                    color: white;
-                    padding: 12px 20px;
-                    border-radius: 5px;
-                    font-size: 14px;
-                    z-index: 1000;
-                    box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-                `;
-                notification.textContent = '✅ Ссылка скопирована в буфер обмена!';
-                document.body.appendChild(notification);
-                
-                // Удаляем уведомление через 3 секунды
-                setTimeout(() => {{
-                    document.body.removeChild(notification);
-                }}, 3000);
-            }}).catch(function(err) {{
-                console.error('Ошибка копирования: ', err);
-                // Fallback для старых браузеров
-                const textArea = document.createElement('textarea');
-                textArea.value = text;
-                document.body.appendChild(textArea);
-                textArea.select();
-                try {{
-                    document.execCommand('copy');
-                    alert('Ссылка скопирована в буфер обмена!');
-                }} catch (err) {{
-                    alert('Не удалось скопировать ссылку. Скопируйте вручную: ' + text);
-                }}
-                document.body.removeChild(textArea);
-            }});
-        }}
-        
-        // Инициализация при загрузке страницы
-        document.addEventListener('DOMContentLoaded', function() {{
-            // Загружаем данные сразу
-            loadDevicesData();
-            
-            // Устанавливаем интервал обновления каждую секунду
-            updateInterval = setInterval(loadDevicesData, 1000);
-        }});
-        
-        // Очистка интервала при закрытии страницы
-        window.addEventListener('beforeunload', function() {{
-            if (updateInterval) {{
-                clearInterval(updateInterval);
-            }}
-        }});
-    </script>
-</head>
-<body>
-    <div class="container">
-        <div class="header">
-            <h1>⛵ 69F СКОРОСТЬ</h1>
-            <p>Отслеживание скорости всех устройств</p>
-            <div style="margin-top: 15px;">
-                <a href="/cleanup" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">🧹 Очистить старые данные</a>
-                <a href="/restart_tracking" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">🔄 Перезапустить Tracking</a>
-                <a href="/download/all_devices.txt" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em; margin-right: 10px;">📥 Скачать все данные</a>
-                <a href="/download/GPS-Speed-69F-v3.0-With-Remote-Restart.apk" style="background: rgba(255,255,255,0.2); color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-size: 0.9em;">📱 Скачать APK</a>
-            </div>
-        </div>
-        <div class="content">
-            <div class="status" id="timestamp">Обновлено: {get_moscow_time().strftime('%Y-%m-%d %H:%M:%S')} (МСК)</div>
-            <div id="devices-container">
-                <div class="loading">Загрузка данных...</div>
-            </div>
-            
-            <div style="background: #f8f9fa; border: 1px solid #e9ecef; border-radius: 8px; padding: 20px; margin-top: 30px;">
-                <h2>📁 Прямые ссылки на файлы</h2>
-                <div style="background: white; padding: 20px; border-radius: 8px;">
-                    
-                    <!-- APK файл -->
-                    <div style="margin-bottom: 25px; padding: 15px; background: #e3f2fd; border-radius: 8px; border-left: 4px solid #2196f3;">
-                        <h3 style="margin: 0 0 10px 0; color: #1976d2;">📱 Android приложение</h3>
-                        <a href="/download/GPS-Speed-69F-v3.0-With-Remote-Restart.apk" 
-                           style="display: inline-block; background: #2196f3; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
-                            📥 Скачать APK
-                        </a>
-                    </div>
-                    
-                    <!-- Общий лог -->
-                    <div style="margin-bottom: 25px; padding: 15px; background: #f3e5f5; border-radius: 8px; border-left: 4px solid #9c27b0;">
-                        <h3 style="margin: 0 0 10px 0; color: #7b1fa2;">📋 Общий лог всех устройств</h3>
-                        <a href="/download/all_devices.txt" 
-                           style="display: inline-block; background: #9c27b0; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
-                            📥 Скачать лог
-                        </a>
-                    </div>
-                    
-                    <!-- Файлы устройств -->
-                    <div style="margin-bottom: 20px;">
-                        <h3 style="margin: 0 0 15px 0; color: #2e7d32;">📊 Файлы отдельных устройств</h3>
-                        {self.get_device_links_html()}
-                    </div>
-                    
-                    <!-- Excel файл -->
-                    <div style="margin-bottom: 25px; padding: 15px; background: #e8f5e8; border-radius: 8px; border-left: 4px solid #4caf50;">
-                        <h3 style="margin: 0 0 10px 0; color: #2e7d32;">📊 Excel отчет</h3>
-                        <a href="/download/gps_speed_data.xlsx" 
-                           style="display: inline-block; background: #4caf50; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px;">
-                            📊 Скачать Excel файл
-                        </a>
-                    </div>
-                    
-                    <!-- Служебные файлы -->
-                    <div style="margin-top: 25px; padding: 15px; background: #fff3e0; border-radius: 8px; border-left: 4px solid #ff9800;">
-                        <h3 style="margin: 0 0 10px 0; color: #f57c00;">🔧 Служебные файлы</h3>
-                        <div style="margin: 10px 0;">
-                            <a href="/download/restart_signal.txt" 
-                               style="display: inline-block; background: #ff9800; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; margin-right: 10px; margin-bottom: 5px;">
-                                🔄 Файл-сигнал перезапуска
-                            </a>
-                            <span style="color: #666; font-size: 0.9em;">Для удаленного перезапуска tracking</span>
-                        </div>
-                    </div>
-                    
-                </div>
-            </div>
-        </div>
-    </div>
-</body>
-</html>'''
-        
-        self.wfile.write(html_content.encode('utf-8'))
+class PooledHTTPServer(ThreadingHTTPServer):
+    """HTTP сервер с ограниченным пулом рабочих потоков"""
 
-    def get_device_links_html(self):
-        """Генерирует HTML со ссылками на файлы устройств"""
+    def __init__(self, server_address, handler_class, workers):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='http-worker')
+        self.workers = workers
+        # Принятые соединения: обслуживаемые и ждущие свободного потока
+        self.open_connections = 0
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.open_connections += 1
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
         try:
-            device_files = []
-            if os.path.exists(DATA_DIR):
-                device_files = [f for f in os.listdir(DATA_DIR) if f.startswith('device_') and f.endswith('.txt') and not f.endswith('_log.txt')]
+            super().process_request_thread(request, client_address)
+        finally:
+            with self.connections_lock:
+                self.open_connections -= 1
 
-            if not device_files:
-                return '<div style="color: #6c757d; font-style: italic; padding: 20px; text-align: center; background: #f8f9fa; border-radius: 5px;">Нет файлов устройств</div>'
+    def keepalive_allowed(self):
+        """Постоянное соединение занимает поток на все время жизни: держим их
+        меньше, чем потоков, чтобы новым соединениям всегда оставался поток"""
+        return self.open_connections < self.workers
 
-            links_html = ""
-            for filename in sorted(device_files):
-                device_name = filename.replace('device_', '').replace('.txt', '').replace('_', ' ')
-                safe_name = device_name.replace(' ', '_')
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
 
-                # Получаем информацию о файле
-                device_file = os.path.join(DATA_DIR, filename)
-                log_file = os.path.join(DATA_DIR, f'device_{safe_name}_log.txt')
-                
-                device_size = os.path.getsize(device_file) if os.path.exists(device_file) else 0
-                log_size = os.path.getsize(log_file) if os.path.exists(log_file) else 0
+def run_server(host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS):
+    """Запускает сервер как долгоживущий процесс с корректной остановкой"""
+    httpd = PooledHTTPServer((host, port), handler, workers)
 
-                links_html += f'''
-                <div style="margin-bottom: 20px; padding: 15px; background: #f8f9fa; border-radius: 8px; border-left: 4px solid #4caf50;">
-                    <h4 style="margin: 0 0 10px 0; color: #2e7d32;">🚤 {device_name}</h4>
-                    <div style="display: flex; gap: 10px; flex-wrap: wrap;">
-                        <a href="/download/device_{safe_name}.txt" 
-                           style="display: inline-block; background: #4caf50; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
-                            📄 Текущая скорость
-                        </a>
-                        <a href="/download/device_{safe_name}_log.txt" 
-                           style="display: inline-block; background: #8bc34a; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
-                            📊 История данных
-                        </a>
-                        <a href="/download/gps_speed_data.xlsx" 
-                           style="display: inline-block; background: #9c27b0; color: white; padding: 8px 16px; text-decoration: none; border-radius: 5px; font-weight: bold; font-size: 0.9em;">
-                            📊 Excel файл
-                        </a>
-                    </div>
-                    <div style="margin-top: 8px; color: #666; font-size: 0.8em;">
-                        Размеры: скорость {device_size} байт, история {log_size} байт
-                    </div>
-                </div>
-                '''
+    def stop(signum, frame):
+        log_event('info', f'🛑 Получен сигнал {signum}, останавливаем сервер...')
+        server_shutdown_event.set()
+        # shutdown() ждет завершения serve_forever, поэтому вызывается из другого потока
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
 
-            return links_html
-        except Exception as e:
-            return f'<div style="color: #dc3545; padding: 15px; background: #f8d7da; border-radius: 5px;">Ошибка: {e}</div>'
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
 
-    def do_OPTIONS(self):
-        self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Device-Name')
-        self.end_headers()
+    # Прогреваем состояние до первого запроса; пирамиды и индекс треков строятся в фоне
+    load_devices_registry()
+    load_history_store()
+    load_spatial_index()
+    threading.Thread(target=build_history_pyramids, name='history-pyramids', daemon=True).start()
+
+    log_event('info', f'🚀 Сервер запущен на http://{host}:{port} (рабочих потоков: {workers})')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        flush_logs(fsync=True)
+        log_event('info', '✅ Сервер остановлен, логи сохранены')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='GPS Speed Tracker сервер')
+    parser.add_argument('--serve', action='store_true', help='запустить автономный HTTP сервер')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help='число рабочих потоков')
+    args = parser.parse_args()
+
+    if args.serve:
+        run_server(args.host, args.port, args.workers)
+    else:
+        parser.print_help()